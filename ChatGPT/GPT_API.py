@@ -3,9 +3,8 @@ import sys
 import re
 import uuid
 import time
+from collections import deque
 from pathlib import Path
-from flask import Flask, request, jsonify
-import atexit
 
 # Playwright importok
 try:
@@ -15,15 +14,136 @@ except ImportError:
     print("A Playwright nincs telepítve. (pip install playwright && playwright install)")
     sys.exit(1)
 
+# A backend-független közös rész (Flask API, hedge, run_many, korlátok, tokenizálás,
+# beszélgetés index, profilozás, háttérfeladatok) a repó gyökerében van
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import driver_common as common
+from driver_common import (
+    CANCELLED_RESPONSE,
+    LAST_RESPONSE_JS,
+    LATENCY_SAMPLES,
+    METRICS,
+    _apply_limits,
+    _apply_pinned_system,
+    _cancel_generation,
+    _close_browser_session,
+    _deadline_generation,
+    _limit_reached,
+    _metric_add,
+    _record_snapshot,
+    _sel,
+    probe_selectors,
+)
+
 
 # ==========================================
-# GLOBÁLIS PLAYWRIGHT ÁLLAPOT
+# BEÁLLÍTÁSOK
 # ==========================================
-PLAYWRIGHT_INSTANCE = None
-BROWSER_CONTEXT = None
-CHAT_PAGE = None
 DEVICE_ID = str(uuid.uuid4())  # Alapértelmezett Device ID, ha nem találunk a localstorage.txt-ben
 
+CHATGPT_URL = "https://chatgpt.com"
+# Persistent Chrome profil (a router workerenként külön másolatot ad át: --profile-dir)
+PROFILE_DIR = Path.cwd() / "chrome_profile"
+MODEL_ID = "gpt-4o-playwright"
+BACKEND_LABEL = "ChatGPT"  # a közös kód (driver_common) naplóüzeneteiben
+
+# Session keep-alive (driver_common._keepalive_session): ennél közelebbi lejáratnál előre frissítünk
+SESSION_REFRESH_MARGIN_S = 24 * 3600
+
+# Hedge kérések: a "<modell>-hedged" id ugyanazt a promptot két helyre küldi, a
+# common.HEDGE_PEER_URL megadásakor a másik proxy példány ezzel a modellel kapja.
+HEDGED_MODEL_ID = f"{MODEL_ID}-hedged"
+HEDGE_PEER_MODEL = "gemini-playwright"
+
+# Web UI modell-változatok: /v1/models id -> a ChatGPT modellválasztó menüpontjának
+# lehetséges feliratai (nyelvi variánsok). A MODEL_ID a web UI alapértelmezése: ha a választó
+# gomb egyik másik változatot sem mutatja, nem kattintunk, különben az UI_DEFAULT_MODEL_LABELS
+# elemet választjuk. A kiválasztást tabonként cache-eljük (MODEL_STATE).
+UI_MODELS = {
+    MODEL_ID: None,
+    "gpt-instant-playwright": ["Instant", "Azonnali"],
+    "gpt-thinking-playwright": ["Thinking", "Gondolkodó"],
+}
+UI_DEFAULT_MODEL_LABELS = ["Auto", "Automatikus"]
+MODEL_STATE = {}  # page -> {"model": kiválasztott id vagy None, "dirty": bool}
+MODEL_LATENCY = {}  # modell id -> deque a sikeres generálások idejével (mp)
+
+# "auto": kis prompt -> a mért leggyorsabb gyors változat, nagy prompt -> a legerősebb
+AUTO_MODEL_ID = "auto"
+AUTO_LARGE_PROMPT_TOKENS = 8000
+AUTO_STRONGEST_MODEL = "gpt-thinking-playwright"
+AUTO_FAST_CANDIDATES = ["gpt-instant-playwright", MODEL_ID]
+AUTO_MIN_SAMPLES = 5  # ennyi mérés alatt a jelöltet előbb kipróbáljuk
+MODEL_IDS = (*UI_MODELS, AUTO_MODEL_ID, HEDGED_MODEL_ID)  # a /v1/models lista
+
+# Beszélgetés index (driver_common): a backend neve és az indexelhető chat URL-ek
+CONVERSATION_BACKEND = "chatgpt"
+CONVERSATION_URL_RE = re.compile(r"/c/[0-9a-f-]+")  # csak a konkrét beszélgetés URL-je indexelhető
+
+# ChatGPT DOM szelektorok
+SEND_BUTTON_SELECTOR = 'button[data-testid="send-button"]'
+STOP_BUTTON_SELECTOR = 'button[data-testid="stop-button"]'
+RESPONSE_CONTAINER_SELECTOR = 'div[data-message-author-role="assistant"]'
+REGENERATE_BUTTON_SELECTOR = 'button[aria-label="Regenerate response"]'
+VOICE_MODE_BUTTON_SVG_PATH = 'path[d^="M7.167 15.416V4.583"]'
+VOICE_MODE_BUTTON_SELECTOR = f"button:has({VOICE_MODE_BUTTON_SVG_PATH})"
+MODEL_PICKER_BUTTON_SELECTOR = 'button[data-testid="model-switcher-dropdown-button"]'
+MODEL_PICKER_ITEM_SELECTOR = '[role="menuitem"], [role="menuitemradio"]'
+
+# Szelektor regiszter (driver_common.bind): kulcs -> jelöltek sorrendben (elsődleges, majd
+# fallback / nyelvi változatok)
+SELECTOR_REGISTRY = {
+    "composer": ["#prompt-textarea", "div.ProseMirror[contenteditable='true']"],
+    "send_button": [
+        SEND_BUTTON_SELECTOR,
+        "button#composer-submit-button",
+        'button[aria-label="Send prompt"]',
+    ],
+    "stop_button": [STOP_BUTTON_SELECTOR, 'button[aria-label="Stop streaming"]'],
+    "response": [RESPONSE_CONTAINER_SELECTOR],
+    # Bármelyik jelenléte a kész állapotot jelzi (mindig unióként használjuk)
+    "completion": [REGENERATE_BUTTON_SELECTOR, VOICE_MODE_BUTTON_SELECTOR],
+    "model_picker": [MODEL_PICKER_BUTTON_SELECTOR, 'button[aria-label^="Model selector"]'],
+}
+SELECTOR_PROBE_KEYS = ["composer", "model_picker"]  # egy üres chaten mindig látszanak
+
+common.bind(sys.modules[__name__], CHATGPT_URL, SELECTOR_REGISTRY, SELECTOR_PROBE_KEYS)
+common.SELECTOR_BUDGET_MS["completion"] = 20.0  # :has() – a teljes DOM-ot bejárhatja
+
+# Ha nincs stop gomb és a válasz sem nő ennyi ideig, de a kész-jelző sem talál, azt
+# szelektor-driftnek vesszük: a választ kiolvassuk (nem várjuk ki a ~100 perces timeoutot)
+SELECTOR_DRIFT_GRACE_S = 60
+
+# Kész-e a generálás: megjelent az ÚJ válasz (a kérés előtti számhoz képest), nincs stop
+# gomb, és látszik a regenerate / voice mode gomb. A voice mode gomb egy tétlen lapon is
+# ott van, ezért új válasz nélkül sosem kész. A stop gomb és az új válasz hossza a
+# drift-védelemhez kell; withText esetén ugyanebben a hívásban az új válasz eddigi
+# szövegét is kiolvassuk (korlátok figyelése).
+GENERATION_STATE_JS = """
+([stopSel, doneSel, respSel, initialCount, withText]) => {
+    const msgs = document.querySelectorAll(respSel);
+    const stop = !!document.querySelector(stopSel);
+    const done = msgs.length > initialCount && !stop && !!document.querySelector(doneSel);
+    let text = null;
+    let progress = -1;
+    if (msgs.length > initialCount) {
+        const last = msgs[msgs.length - 1];
+        progress = last.textContent.length;
+        if (withText) text = (last.querySelector('.markdown') || last).innerText;
+    }
+    return { done, stop, progress, text };
+}
+"""
+
+# A ChatGPT-specifikus metrikák a közös METRICS mellett (GET /metrics)
+METRICS.update(
+    {
+        "ui_model_switches": 0,
+        "ui_model_switch_failures": 0,
+        "selector_drift": 0,
+    }
+)
+
 
 # ==========================================
 # SEGÉDFÜGGVÉNYEK (A "MOCSKOS" PARSOLÁSHOZ)
@@ -104,387 +224,452 @@ def load_raw_data():
 # ==========================================
 # PLAYWRIGHT LOGIKA (VISSZATÉRÍTI A VÁLASZT)
 # ==========================================
-def run_with_playwright(prompt: str) -> str:
+
+def ensure_browser_session():
     """
-    Kiküldi a promptot a ChatGPT-nek Playwright segítségével,
-    és egy meglévő, globális munkamenetet használ.
+    Első híváskor elindítja a böngészőt, beinjektálja a cookie-kat / oai-did-et,
+    és megnyitja a fő chat tabot (CHAT_PAGE).
+    Visszatérés: None, ha a munkamenet kész, különben "HIBA: ..." szöveg.
     """
-    global PLAYWRIGHT_INSTANCE, BROWSER_CONTEXT, CHAT_PAGE, DEVICE_ID
+    global DEVICE_ID
 
-    response_text = "HIBA: A kérés nem futott le."  # Alapértelmezett hibaüzenet
+    if common.CHAT_PAGE is not None:
+        return None
 
-    # ------------------------------------------
-    # 1. Munkamenet inicializálása (csak az első híváskor)
-    # ------------------------------------------
-    if CHAT_PAGE is None:
-        print("Böngésző inicializálása (első kérés)...")
+    print("Böngésző inicializálása (első kérés)...")
 
-        PLAYWRIGHT_INSTANCE = sync_playwright().start()
+    common.PLAYWRIGHT_INSTANCE = sync_playwright().start()
 
-        raw_cookies_text, raw_ls_text = load_raw_data()
-        session_token = parse_value_from_dump(raw_cookies_text, "session-token")
-        cf_clearance = parse_value_from_dump(raw_cookies_text, "cf_clearance")
-        puid = parse_value_from_dump(raw_cookies_text, "_puid")
+    raw_cookies_text, raw_ls_text = load_raw_data()
+    session_token = parse_value_from_dump(raw_cookies_text, "session-token")
+    cf_clearance = parse_value_from_dump(raw_cookies_text, "cf_clearance")
+    puid = parse_value_from_dump(raw_cookies_text, "_puid")
 
-        device_id_ls = parse_value_from_dump(raw_ls_text, "oai-did")
-        if device_id_ls:
-            DEVICE_ID = device_id_ls
+    device_id_ls = parse_value_from_dump(raw_ls_text, "oai-did")
+    if device_id_ls:
+        DEVICE_ID = device_id_ls
 
-        print(f"Session Token: {'IGEN' if session_token else 'NEM'}")
-        print(f"Cloudflare Clearance: {'IGEN' if cf_clearance else 'NEM'}")
-        print(f"Device ID: {DEVICE_ID}")
+    print(f"Session Token: {'IGEN' if session_token else 'NEM'}")
+    print(f"Cloudflare Clearance: {'IGEN' if cf_clearance else 'NEM'}")
+    print(f"Device ID: {DEVICE_ID}")
 
-        profile_path = Path.cwd() / "chrome_profile"
+    profile_path = PROFILE_DIR
+    try:
+        context = common.PLAYWRIGHT_INSTANCE.chromium.launch_persistent_context(
+            user_data_dir=str(profile_path),
+            headless=False,
+            channel="chrome",
+            args=["--disable-blink-features=AutomationControlled"],
+        )
+    except Exception as e:
+        return f"HIBA: Böngésző indítási hiba: {e}"
+    common.BROWSER_CONTEXT = context
+
+    cookies_to_add = []
+    if session_token:
+        cookies_to_add.append(
+            {
+                "name": "__Secure-next-auth.session-token",
+                "value": session_token,
+                "domain": ".chatgpt.com",
+                "path": "/",
+                "secure": True,
+                "sameSite": "Lax",
+            }
+        )
+    if cf_clearance:
+        cookies_to_add.append(
+            {
+                "name": "cf_clearance",
+                "value": cf_clearance,
+                "domain": ".chatgpt.com",
+                "path": "/",
+                "secure": True,
+                "sameSite": "None",
+            }
+        )
+    if puid:
+        cookies_to_add.append(
+            {
+                "name": "_puid",
+                "value": puid,
+                "domain": ".chatgpt.com",
+                "path": "/",
+                "secure": True,
+                "sameSite": "Lax",
+            }
+        )
+
+    if cookies_to_add:
         try:
-            BROWSER_CONTEXT = PLAYWRIGHT_INSTANCE.chromium.launch_persistent_context(
-                user_data_dir=str(profile_path),
-                headless=False,
-                channel="chrome",
-                args=["--disable-blink-features=AutomationControlled"],
-            )
+            context.add_cookies(cookies_to_add)
+            print(f"{len(cookies_to_add)} db kritikus cookie hozzáadva.")
         except Exception as e:
-            return f"HIBA: Böngésző indítási hiba: {e}"
-
-        cookies_to_add = []
-        if session_token:
-            cookies_to_add.append(
-                {
-                    "name": "__Secure-next-auth.session-token",
-                    "value": session_token,
-                    "domain": ".chatgpt.com",
-                    "path": "/",
-                    "secure": True,
-                    "sameSite": "Lax",
-                }
-            )
-        if cf_clearance:
-            cookies_to_add.append(
-                {
-                    "name": "cf_clearance",
-                    "value": cf_clearance,
-                    "domain": ".chatgpt.com",
-                    "path": "/",
-                    "secure": True,
-                    "sameSite": "None",
-                }
-            )
-        if puid:
-            cookies_to_add.append(
-                {
-                    "name": "_puid",
-                    "value": puid,
-                    "domain": ".chatgpt.com",
-                    "path": "/",
-                    "secure": True,
-                    "sameSite": "Lax",
-                }
-            )
-
-        if cookies_to_add:
-            try:
-                BROWSER_CONTEXT.add_cookies(cookies_to_add)
-                print(f"{len(cookies_to_add)} db kritikus cookie hozzáadva.")
-            except Exception as e:
-                print(f"HIBA cookie hozzáadáskor: {e}")
-        else:
-            print("FIGYELEM: Nem sikerült cookie-kat kinyerni a dumpból!")
+            print(f"HIBA cookie hozzáadáskor: {e}")
+    else:
+        print("FIGYELEM: Nem sikerült cookie-kat kinyerni a dumpból!")
 
-        CHAT_PAGE = BROWSER_CONTEXT.new_page()
+    page = common.CHAT_PAGE = context.new_page()
+    register_tab(page)
 
-        print("Navigálás a chatgpt.com-ra...")
-        CHAT_PAGE.goto("https://chatgpt.com")
+    print("Navigálás a chatgpt.com-ra...")
+    page.goto(CHATGPT_URL)
 
-        print(f"LocalStorage 'oai-did' beállítása: {DEVICE_ID}")
-        CHAT_PAGE.evaluate(
-            f"""() => {{
-            localStorage.setItem('oai-did', '{DEVICE_ID}');
-        }}"""
-        )
+    print(f"LocalStorage 'oai-did' beállítása: {DEVICE_ID}")
+    page.evaluate(
+        f"""() => {{
+        localStorage.setItem('oai-did', '{DEVICE_ID}');
+    }}"""
+    )
 
-        print("Oldal frissítése a beállítások érvényesítéséhez...")
-        CHAT_PAGE.reload()
+    print("Oldal frissítése a beállítások érvényesítéséhez...")
+    page.reload()
 
-        try:
-            print("Várakozás a prompt mezőre (max 600s)...")
-            CHAT_PAGE.wait_for_selector("#prompt-textarea", timeout=600000)
-        except Exception as e:
-            print(
-                f"KRITIKUS HIBA az inicializáláskor: {e}. Valószínűleg lejártak a cookie-k."
-            )
-            try:
-                if BROWSER_CONTEXT:
-                    BROWSER_CONTEXT.close()
-                if PLAYWRIGHT_INSTANCE:
-                    PLAYWRIGHT_INSTANCE.stop()
-            except Exception:
-                pass
-
-            CHAT_PAGE = None
-            BROWSER_CONTEXT = None
-            PLAYWRIGHT_INSTANCE = None
-
-            return (
-                "HIBA: A böngésző inicializálása sikertelen. "
-                f"Hiba: {e}. Kérem, frissítse a 'cookies.txt' és 'localstorage.txt' fájlokat."
-            )
+    try:
+        print("Várakozás a prompt mezőre (max 600s)...")
+        page.wait_for_selector(_sel("composer"), timeout=600000)
+    except Exception as e:
+        print(
+            f"KRITIKUS HIBA az inicializáláskor: {e}. Valószínűleg lejártak a cookie-k."
+        )
+        _close_browser_session()
 
-    if CHAT_PAGE is None:
         return (
-            "HIBA: A böngésző munkamenet az előző kérés során leállt. "
-            "Kérem indítsa újra a szervert."
+            "HIBA: A böngésző inicializálása sikertelen. "
+            f"Hiba: {e}. Kérem, frissítse a 'cookies.txt' és 'localstorage.txt' fájlokat."
         )
 
-    page = CHAT_PAGE
+    probe_selectors(page)
+    _record_snapshot(page, "idle")
+    return None
+
+
+def _start_generation(page, prompt, limits=None, system=None, model=None, timeout_ms=60000000):
+    """
+    Beírja és elküldi a promptot az adott tabon, és visszaad egy "job" dict-et,
+    amit a _poll_generation / _finish_generation használ.
+    """
+    initial_count = page.locator(_sel("response")).count()
+    prompt = _apply_pinned_system(page, prompt, system, initial_count)
+    ensure_ui_model(page, model)
+    print(f"Prompt küldése: {prompt[:50]}...")
+    page.fill(_sel("composer"), prompt)
 
     try:
-        print(f"Prompt küldése: {prompt[:50]}...")
-        page.fill("#prompt-textarea", prompt)
+        page.click(_sel("send_button"))
+    except PlaywrightTimeoutError:
+        page.keyboard.press("Enter")
+    started_at = time.time()
+
+    # A válasz-szelektor a szál korábbi válaszaira is talál: az ÚJ válasz megjelenését várjuk
+    page.wait_for_function(
+        "([sel, n]) => document.querySelectorAll(sel).length > n",
+        arg=[_sel("response"), initial_count],
+        timeout=10000,
+    )
+    print("Generálás elindult. Várjuk a befejezést (max. ~100 perc)...")
+    # A válasz-szelektor a korábbi válaszokra is talál: a generálást a stop gomb bizonyítja
+    _record_snapshot(
+        page, "generating", wait_for="stop_button", baseline={"initial_response_count": initial_count}
+    )
 
-        send_button_selector = 'button[data-testid="send-button"]'
-        response_container_selector = 'div[data-message-author-role="assistant"]'
-        regenerate_button_selector = 'button[aria-label="Regenerate response"]'
-        voice_mode_button_svg_path = 'path[d^="M7.167 15.416V4.583"]'
-        voice_mode_button_selector = f"button:has({voice_mode_button_svg_path})"
+    return {
+        "page": page,
+        "model": model or MODEL_ID,
+        "limits": limits,
+        "initial_count": initial_count,
+        "started_at": started_at,
+        "progress": -1,
+        "last_progress_at": started_at,
+        "deadline": started_at + timeout_ms / 1000,
+        "soft_deadline": (
+            started_at + limits["timeout"] if limits and limits["timeout"] else None
+        ),
+        "watch_text": bool(limits and (limits["max_tokens"] is not None or limits["stop"])),
+    }
 
-        try:
-            page.click(send_button_selector)
-        except PlaywrightTimeoutError:
-            page.keyboard.press("Enter")
 
-        page.wait_for_selector(response_container_selector, timeout=10000)
+def _poll_generation(job):
+    """
+    Egyetlen böngésző-hívással megnézi a job állapotát.
+    Visszatérés: (status, finish_reason),
+    status: "running" | "done" | "limit" | "deadline" (kliens timeout) | "timeout".
+    """
+    state = job["page"].evaluate(
+        GENERATION_STATE_JS,
+        [_sel("stop_button"), _sel("completion"), _sel("response"),
+         job["initial_count"], job["watch_text"]],
+    )
+    if state["done"]:
+        return "done", "stop"
+    reason = _limit_reached(state["text"], job["limits"])
+    if reason:
+        return "limit", reason
+
+    now = time.time()
+    if state["stop"] or state["progress"] != job["progress"]:
+        job["progress"] = state["progress"]
+        job["last_progress_at"] = now
+    elif state["progress"] >= 0 and now - job["last_progress_at"] >= SELECTOR_DRIFT_GRACE_S:
+        # Se stop gomb, se növekvő szöveg, mégsem "kész": a kész-jelző szelektor elavult
+        _metric_add("selector_drift")
+        print(
+            f"FIGYELEM: {SELECTOR_DRIFT_GRACE_S} mp óta nincs változás, de a kész-jelző "
+            f"nem talál ({SELECTOR_REGISTRY['completion']}) – a választ kiolvassuk."
+        )
+        return "done", "stop"
+    if job["soft_deadline"] is not None and now >= job["soft_deadline"]:
+        return "deadline", None
+    if now >= job["deadline"]:
+        return "timeout", None
+    return "running", None
+
 
-        print("Generálás elindult. Várjuk a befejezést (max. ~100 perc)...")
-        combined_completion_selector = f"{regenerate_button_selector}, {voice_mode_button_selector}"
-        page.wait_for_selector(combined_completion_selector, timeout=60000000)
+def _finish_generation(job, status, finish_reason):
+    """
+    Lezárja a jobot a _wait_for_generation / _poll_generation státusza alapján:
+    megszakításnál / korlátnál leállítja a generálást, egyébként kinyeri és csonkolja
+    a választ. Visszatérés: (válasz szöveg, finish_reason).
+    """
+    page = job["page"]
+    elapsed = time.time() - job["started_at"]
+
+    if status == "cancelled":
+        # A kliens már nem olvassa a választ: leállítjuk a generálást,
+        # a kinyerést kihagyjuk, a tab azonnal újra használható.
+        _cancel_generation(job)
+        print(f"Kliens lecsatlakozott – generálás leállítva ({elapsed:.1f} mp elpazarolva).")
+        return CANCELLED_RESPONSE, None
+
+    if status == "deadline":
+        # A kliens timeoutja előtt nincs kész válasz: külön jelezzük, nem "length"-ként
+        return _deadline_generation(job)
+
+    if status == "timeout":
+        raise PlaywrightTimeoutError("A generálás nem fejeződött be az időkorláton belül.")
+
+    if status == "limit":
+        # Megvan, amit a kliens kért: nem várjuk ki a teljes generálást
+        _stop_generation(page)
+        _metric_add("requests_truncated")
+        print(f"Korlát elérve ({finish_reason}) – generálás korán leállítva.")
+    else:
+        LATENCY_SAMPLES.append(elapsed)
+        MODEL_LATENCY.setdefault(job["model"], deque(maxlen=50)).append(elapsed)
         print("Válasz sikeresen befejeződött.")
+        _record_snapshot(page, "done", baseline={"initial_response_count": job["initial_count"]})
+    _metric_add("generation_seconds_total", elapsed)
 
-        # --- VÁLASZ KINYERÉSE (RAW) ---
-        # Nem vágunk diff-et, nem pucolunk semmit, ami a ChatGPT UI-ban
-        # az utolsó asszisztens üzenetben van, az megy vissza stringként.
-        text = ""
+    text = _extract_last_response(page)
 
-        try:
-            # Elsődlegesen a markdown tartalmat olvassuk ki az utolsó asszisztens üzenetből.
-            response_locator = page.locator(f"{response_container_selector} .markdown").last
-            if response_locator:
-                raw = response_locator.inner_text() or ""
-                text = raw
-                print("RAW markdown szöveg kinyerve az utolsó asszisztens üzenetből.")
-        except Exception as e:
-            print(f"HIBA a markdown szöveg kiolvasásakor: {e}")
-
-        if not text:
-            # Ha valamiért nincs .markdown, essünk vissza az egész konténer szövegére.
-            try:
-                response_container = page.locator(response_container_selector).last
-                if response_container:
-                    raw = response_container.inner_text() or ""
-                    text = raw
-                    print("RAW szöveg kinyerve az asszisztens konténerből (fallback).")
-            except Exception as e:
-                print(f"További hiba a fallback során: {e}")
-
-        if text:
-            response_text = text
-        else:
-            print("HIBA: A kinyert szöveg üres maradt.")
-            response_text = "HIBA: A kinyert szöveg üres maradt."
+    if not text:
+        print("HIBA: A kinyert szöveg üres maradt.")
+        return "HIBA: A kinyert szöveg üres maradt.", None
+
+    return _apply_limits(text, job["limits"], finish_reason)
 
+
+def _stop_generation(page):
+    """Megnyomja a web UI stop gombját, ha a generálás még fut."""
+    try:
+        page.click(_sel("stop_button"), timeout=2000)
+        print("Stop gomb megnyomva.")
     except Exception as e:
-        print(f"HIBA a folyamat közben: {e}. Munkamenet lezárva.")
+        print(f"Stop gomb nem elérhető (valószínűleg már kész a generálás): {e}")
 
-        try:
-            if BROWSER_CONTEXT:
-                BROWSER_CONTEXT.close()
-            if PLAYWRIGHT_INSTANCE:
-                PLAYWRIGHT_INSTANCE.stop()
-        except Exception:
-            pass
-
-        CHAT_PAGE = None
-        BROWSER_CONTEXT = None
-        PLAYWRIGHT_INSTANCE = None
-
-        response_text = (
-            "HIBA: A Playwright nem tudta elküldeni a kérést. "
-            f"Hiba: {e}"
-        )
 
-    return response_text
+def _extract_last_response(page):
+    """
+    Az utolsó asszisztens üzenet szövege ("" ha nem sikerült). Egyetlen evaluate
+    hívás: a .markdown tartalmat (ha nincs, az egész konténert) markdownként adja
+    vissza, kódblokk-nyelvekkel, listákkal, táblázatokkal; diff-et nem vágunk,
+    nem pucolunk semmit.
+    """
+    try:
+        text = page.evaluate(
+            LAST_RESPONSE_JS, [_sel("response"), ".markdown", common.MARKDOWN_EXTRACTION]
+        ) or ""
+        print(f"Válasz kinyerve ({len(text)} karakter, markdown: {common.MARKDOWN_EXTRACTION}).")
+    except Exception as e:
+        print(f"HIBA a válasz kiolvasásakor: {e}")
+        text = ""
+    return text
 
 
 # ==========================================
-# FLASK API
+# WEB UI MODELL-VÁLASZTÁS
 # ==========================================
 
-app = Flask(__name__)
+def _invalidate_model_state(page):
+    """Navigáció / új chat után a tab modell-állapota újraellenőrzendő."""
+    state = MODEL_STATE.get(page)
+    if state is not None:
+        state["dirty"] = True
 
 
-def _extract_text_from_content(content):
+def register_tab(page):
     """
-    LiteLLM / OpenAI üzenet `content` mezőből kiszedi a szöveget.
+    Új tab felvétele a modell-állapot cache-be (a driver_common minden új tabnál hívja).
+    A fő frame navigációja (új chat, reload, URL váltás) piszkosra jelöli a cache-t.
     """
-    if isinstance(content, str):
-        return content
-
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, str):
-                parts.append(item)
-            elif isinstance(item, dict):
-                txt = (
-                    item.get("text")
-                    or item.get("input_text")
-                    or item.get("content")
-                    or ""
-                )
-                if txt:
-                    parts.append(str(txt))
-            else:
-                parts.append(str(item))
-        return "\n".join(parts)
-
-    return str(content)
-
-
-def _build_prompt_from_messages(messages):
+    MODEL_STATE[page] = {"model": None, "dirty": True}
+
+    def _on_navigated(frame):
+        if frame == page.main_frame:
+            _invalidate_model_state(page)
+
+    page.on("framenavigated", _on_navigated)
+    page.on("close", lambda _: MODEL_STATE.pop(page, None))
+
+
+def ensure_ui_model(page, model=None):
     """
-    Az egész messages[] tömböt "kilapítja" egy darab nagy prompttá,
-    hogy Aider összes korábbi user/assistant üzenete, fájltartalma stb.
-    ténylegesen eljusson a ChatGPT web felülethez.
+    Beállítja a kért UI_MODELS változatot a ChatGPT modellválasztóban az adott tabon.
+    - Tiszta cache + egyező modell -> nincs DOM hívás.
+    - Navigáció után (és egy még nem ellenőrzött tabon) egy olvasással (a választó gomb
+      felirata) ellenőrzünk, és csak eltérésnél kattintunk – a MODEL_ID-nál is, mert a web
+      UI a tabon kívül (másik tab, kézi váltás) választott modellt is megjegyzi.
+    Sikertelen váltásnál a generálás a tab aktuális modelljével megy tovább.
     """
-    blocks = []
-
-    for msg in messages:
-        role = msg.get("role", "user")
-        text = _extract_text_from_content(msg.get("content", ""))
-
-        if not text:
-            continue
-        if role == "tool":
-            continue
-
-        if role == "system":
-            blocks.append(text)
-        elif role == "user":
-            blocks.append(text)
-        elif role == "assistant":
-            blocks.append(f"Assistant: {text}")
-        else:
-            blocks.append(text)
+    model = model or MODEL_ID
 
-    return "\n\n".join(blocks).strip()
+    state = MODEL_STATE.get(page)
+    if state is None:
+        register_tab(page)
+        state = MODEL_STATE[page]
 
+    if state["model"] == model and not state["dirty"]:
+        return "cached"
 
-@app.route("/v1/chat/completions", methods=["POST"])
-@app.route("/chat/completions", methods=["POST"])
-def chat_completions():
-    data = request.json or {}
+    labels = UI_MODELS[model] or UI_DEFAULT_MODEL_LABELS
     try:
-        print(f"REQUEST PATH: {request.path}")
-    except Exception:
-        pass
+        current = page.eval_on_selector(
+            _sel("model_picker"), "el => (el.textContent || '').trim()"
+        )
+        if model == MODEL_ID:
+            # Az alapértelmezett (Auto) modell neve nem látszik a gombon: azon vagyunk, ha a
+            # gomb egyik másik változat feliratát sem mutatja
+            selected = not any(
+                label in current for other in UI_MODELS.values() if other for label in other
+            )
+        else:
+            selected = any(label in current for label in labels)
+        if selected:
+            state["model"] = model
+            state["dirty"] = False
+            print(f"UI modell: {model} (ellenőrizve)")
+            return "already-on"
+
+        # A Radix menü pointer eseményre nyílik: valódi Playwright kattintás kell
+        page.click(_sel("model_picker"), timeout=5000)
+        items = page.locator(MODEL_PICKER_ITEM_SELECTOR)
+        for label in labels:
+            item = items.filter(has_text=label).first
+            if item.count():
+                item.click(timeout=5000)
+                break
+        else:
+            page.keyboard.press("Escape")
+            raise RuntimeError(f"nincs {labels} feliratú menüpont a modellválasztóban")
+    except Exception as e:
+        print(f"FIGYELEM: UI modell váltás sikertelen ({model}): {e}")
+        _metric_add("ui_model_switch_failures")
+        state["model"] = None
+        state["dirty"] = True
+        return "error"
 
-    messages = data.get("messages", [])
-    prompt = _build_prompt_from_messages(messages)
+    _metric_add("ui_model_switches")
+    state["model"] = model
+    state["dirty"] = False
+    print(f"UI modell beállítva: {model}")
+    return "switched"
 
-    if not prompt:
-        return jsonify({"error": "Nincs értelmezhető szöveg a 'messages' mezőben."}), 400
 
-    print(f"\n--- ÚJ KÉRÉS (összefűzött): {prompt[:60]}... ---")
-    generated_content = run_with_playwright(prompt)
-    print(f"--- KÉSZ, válasz hossza: {len(generated_content)} karakter ---")
+def _pick_auto_model(prompt_tokens):
+    """
+    Az "auto" id feloldása: nagy prompt -> AUTO_STRONGEST_MODEL; kicsi -> az
+    AUTO_FAST_CANDIDATES közül a legkisebb medián generálási idejű. Amíg egy
+    jelöltnek nincs AUTO_MIN_SAMPLES mérése, azt próbáljuk ki.
+    """
+    if prompt_tokens >= AUTO_LARGE_PROMPT_TOKENS:
+        return AUTO_STRONGEST_MODEL
 
-    if generated_content.startswith("HIBA:"):
-        error_message = generated_content.replace("HIBA: ", "")
-        return (
-            jsonify(
-                {
-                    "error": {
-                        "message": error_message,
-                        "type": "browser_error",
-                        "code": "500",
-                    }
-                }
-            ),
-            500,
-        )
+    medians = {}
+    for model in AUTO_FAST_CANDIDATES:
+        samples = MODEL_LATENCY.get(model, ())
+        if len(samples) < AUTO_MIN_SAMPLES:
+            return model
+        medians[model] = sorted(samples)[len(samples) // 2]
+    return min(medians, key=medians.get)
 
-    # OpenAI /v1/chat/completions-szerű válasz – formátum pontosan a doksi szerint
-    response_data = {
-        "id": "chatcmpl-" + str(uuid.uuid4()).replace("-", ""),
-        "object": "chat.completion",
-        "created": int(time.time()),
-        "model": "gpt-4o-playwright",
-        "choices": [
-            {
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": generated_content,
-                },
-                "logprobs": None,
-                "finish_reason": "stop",
-            }
-        ],
-        "usage": {
-            "prompt_tokens": len(prompt.split()),
-            "completion_tokens": len(generated_content.split()),
-            "total_tokens": len(prompt.split()) + len(generated_content.split()),
-        },
-    }
-    print(response_data)
-    return jsonify(response_data)
-
-
-@app.route("/v1/models", methods=["GET"])
-@app.route("/models", methods=["GET"])
-def list_models():
-    return jsonify(
-        {
-            "object": "list",
-            "data": [
-                {
-                    "id": "gpt-4o-playwright",
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "user-host",
-                }
-            ],
-        }
-    )
+
+def _resolve_ui_model(model, prompt_tokens):
+    """A kérés `model` mezőjéből (pl. "openai/auto") a használandó UI_MODELS id."""
+    name = model.split("/")[-1]
+    if name == AUTO_MODEL_ID:
+        return _pick_auto_model(prompt_tokens)
+    return name if name in UI_MODELS else MODEL_ID
+
+
+def _request_options(data, prompt_tokens, hedged):
+    """
+    A kérés ChatGPT-specifikus generálási opciói (a run_with_playwright / run_many
+    kulcsszavas argumentumai) és a válasz model id-ja. Hedge-nél a MODEL_ID megy.
+    Nem string `model` mezőnél ValueError.
+    """
+    if hedged:
+        return {"model": MODEL_ID}, HEDGED_MODEL_ID
+    model = data.get("model") or MODEL_ID
+    if not isinstance(model, str):
+        raise ValueError("A 'model' értéke string kell legyen.")
+    ui_model = _resolve_ui_model(model, prompt_tokens)
+    return {"model": ui_model}, ui_model
+
+
+def _prepare_spare_tab(page):
+    """
+    Betöltött hot-spare tab előkészítése (driver_common._refill_spare_tabs). ChatGPT-nél
+    nincs mit előre beállítani: a UI modellt kéréskor, a tab cache-e alapján ellenőrizzük.
+    """
 
 
 # ==========================================
-# LEZÁRÁSI LOGIKA
+# SESSION ELLENŐRZÉS (KEEP-ALIVE)
 # ==========================================
 
-def shutdown_playwright():
+def _check_session(now):
     """
-    Lefut, amikor a Flask szerver leáll (pl. CTRL+C).
+    A driver_common._keepalive_session ChatGPT-s lépése: olcsó, hitelesített hívás a lap
+    kontextusából; a NextAuth session végpont megmondja, él-e még a session és mikor jár le.
+    Visszatérés: ({"status", "authenticated"}, a lejáratig hátralévő mp vagy None).
     """
-    global BROWSER_CONTEXT, PLAYWRIGHT_INSTANCE
-    if BROWSER_CONTEXT:
-        print("\n🤖 Lezárás: Playwright böngésző bezárása (folyamatos munkamenet vége)...")
-        try:
-            BROWSER_CONTEXT.close()
-        except Exception as e:
-            print(f"Lezárási hiba: {e}")
-
-    if PLAYWRIGHT_INSTANCE:
-        try:
-            PLAYWRIGHT_INSTANCE.stop()
-        except Exception as e:
-            print(f"Playwright stop hiba: {e}")
+    state = common.CHAT_PAGE.evaluate(
+        """async () => {
+            try {
+                const r = await fetch('/api/auth/session', { credentials: 'include' });
+                const body = r.ok ? await r.json() : null;
+                return {
+                    status: r.status,
+                    authenticated: !!(body && body.accessToken),
+                    expires: body && body.expires ? Date.parse(body.expires) / 1000 : null,
+                };
+            } catch (e) {
+                return { status: 0, authenticated: false, expires: null };
+            }
+        }"""
+    )
+    return state, state["expires"] - now if state["expires"] else None
 
 
 # ==========================================
 # INDÍTÁS
 # ==========================================
 if __name__ == "__main__":
-    atexit.register(shutdown_playwright)
+    parser = common.build_arg_parser("Playwright-alapú OpenAI-kompatibilis proxy (ChatGPT).", PROFILE_DIR)
+    args = parser.parse_args()
+    PROFILE_DIR = args.profile_dir
+    common.apply_arguments(args)
 
-    print("🤖 Playwright-alapú Aider API szerver indítása a http://127.0.0.1:5000 címen...")
+    print(f"🤖 Playwright-alapú Aider API szerver indítása a http://127.0.0.1:{args.port} címen...")
     print("--- NE FELEJTSD EL KÉSZÍTENI AZ aider számára a 'cookies.txt' és 'localstorage.txt' fájlokat! ---")
-    app.run(debug=False, port=5000, threaded=False)
+    common.serve(args.port)
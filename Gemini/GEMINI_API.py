@@ -1,11 +1,8 @@
 #!/usr/bin/env python3
 import sys
 import re
-import uuid
 import time
 from pathlib import Path
-from flask import Flask, request, jsonify
-import atexit
 
 # Playwright importok
 try:
@@ -15,15 +12,52 @@ except ImportError:
     print("A Playwright nincs telepítve. (pip install playwright && playwright install)")
     sys.exit(1)
 
+# A backend-független közös rész (Flask API, hedge, run_many, korlátok, tokenizálás,
+# beszélgetés index, profilozás, háttérfeladatok) a repó gyökerében van
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent))
+import driver_common as common
+from driver_common import (
+    CANCELLED_RESPONSE,
+    LAST_RESPONSE_JS,
+    LATENCY_SAMPLES,
+    GenerationError,
+    _apply_limits,
+    _apply_pinned_system,
+    _cancel_generation,
+    _close_browser_session,
+    _deadline_generation,
+    _limit_reached,
+    _metric_add,
+    _record_snapshot,
+    _sel,
+    probe_selectors,
+)
+
 
 # ==========================================
-# GLOBÁLIS PLAYWRIGHT ÁLLAPOT
+# BEÁLLÍTÁSOK
 # ==========================================
-PLAYWRIGHT_INSTANCE = None
-BROWSER_CONTEXT = None
-CHAT_PAGE = None
 
 GEMINI_URL = "https://gemini.google.com/app"
+# Persistent Chrome profil (a router workerenként külön másolatot ad át: --profile-dir)
+PROFILE_DIR = Path.cwd() / "gemini_profile"
+MODEL_ID = "gemini-playwright"
+BACKEND_LABEL = "Gemini"  # a közös kód (driver_common) naplóüzeneteiben
+
+# Session keep-alive (driver_common._keepalive_session): a Gemini sessionnek nincs ismert
+# lejárata, SESSION_REFRESH_INTERVAL_S időnként reloadolunk a Google cookie-k forgatásához
+SESSION_REFRESH_MARGIN_S = 0
+SESSION_REFRESH_INTERVAL_S = 6 * 3600
+
+# Hedge kérések: a "<modell>-hedged" id ugyanazt a promptot két helyre küldi, a
+# common.HEDGE_PEER_URL megadásakor a másik proxy példány ezzel a modellel kapja.
+HEDGED_MODEL_ID = f"{MODEL_ID}-hedged"
+HEDGE_PEER_MODEL = "gpt-4o-playwright"
+MODEL_IDS = (MODEL_ID, HEDGED_MODEL_ID)  # a /v1/models lista
+
+# Beszélgetés index (driver_common): a backend neve és az indexelhető chat URL-ek
+CONVERSATION_BACKEND = "gemini"
+CONVERSATION_URL_RE = re.compile(r"/app/[0-9a-f]+")  # csak a konkrét beszélgetés URL-je indexelhető
 
 # Gemini DOM szelektorok
 GEMINI_EDITOR_SELECTOR = "div.ql-editor.textarea.new-input-ui[contenteditable='true']"
@@ -31,6 +65,111 @@ GEMINI_SEND_BUTTON_SELECTOR = 'button[aria-label="Üzenet küldése"]'
 GEMINI_RESPONSE_MARKDOWN_SELECTOR = "div.markdown.markdown-main-panel"
 GEMINI_COMPLETION_FOOTER_SELECTOR = "div.response-footer.gap.complete"
 
+# Szelektor regiszter (driver_common.bind): kulcs -> jelöltek sorrendben (elsődleges, majd
+# fallback / nyelvi változatok)
+SELECTOR_REGISTRY = {
+    "composer": [
+        GEMINI_EDITOR_SELECTOR,
+        "rich-textarea div.ql-editor[contenteditable='true']",
+        "div[contenteditable='true'][role='textbox']",
+    ],
+    "send_button": [
+        GEMINI_SEND_BUTTON_SELECTOR,
+        'button[aria-label="Send message"]',
+        "button.send-button",
+    ],
+    "stop_button": [
+        'button[aria-label="Válasz leállítása"]',
+        'button[aria-label="Stop response"]',
+        "button.send-button.stop",
+    ],
+    "response": [GEMINI_RESPONSE_MARKDOWN_SELECTOR],
+    "completion": [GEMINI_COMPLETION_FOOTER_SELECTOR, "div.response-footer.complete"],
+    "tools_button": [
+        "toolbox-drawer button.toolbox-drawer-button",
+        'button[aria-label="Eszközök"]',
+        'button[aria-label="Tools"]',
+    ],
+    # Bejelentkezve a Google fiók gomb, kijelentkezve a bejelentkezés link (_check_session)
+    "account": [
+        'a[href^="https://accounts.google.com/SignOutOptions"]',
+        'a[aria-label^="Google-fiók"]',
+        'a[aria-label^="Google Account"]',
+    ],
+    "sign_in": [
+        'a[href^="https://accounts.google.com/ServiceLogin"]',
+        'a[aria-label="Bejelentkezés"]',
+        'a[aria-label="Sign in"]',
+    ],
+}
+SELECTOR_PROBE_KEYS = ["composer", "tools_button", "account"]  # egy üres chaten mindig látszanak
+
+common.bind(sys.modules[__name__], GEMINI_URL, SELECTOR_REGISTRY, SELECTOR_PROBE_KEYS)
+
+# Kész-e az ÚJ válasz (a kérés előtti blokk/footer számhoz képest); withText esetén
+# ugyanebben a hívásban az új blokk eddigi szövegét is visszaadja
+GEMINI_GENERATION_STATE_JS = """
+(arg) => {
+    const {
+        markdownSelector,
+        footerSelector,
+        initialBlockCount,
+        initialFooterCount,
+        withText
+    } = arg;
+
+    const blocks = Array.from(document.querySelectorAll(markdownSelector));
+    const footers = footerSelector
+        ? Array.from(document.querySelectorAll(footerSelector))
+        : [];
+
+    // Csak akkor kész, ha ÚJ blokk és/vagy ÚJ footer is van
+    if (blocks.length <= initialBlockCount) {
+        return { done: false, text: null };
+    }
+
+    const last = blocks[blocks.length - 1];
+    const text = withText ? last.innerText : null;
+    const busy = last.getAttribute('aria-busy');
+
+    if (busy === 'true') return { done: false, text };
+
+    if (footerSelector) {
+        if (footers.length <= initialFooterCount) {
+            return { done: false, text };
+        }
+    }
+
+    return { done: true, text };
+}
+"""
+
+# Gemini eszközök (Tools menü): kulcs -> lehetséges UI feliratok (nyelvi variánsok).
+# Egyszerre legfeljebb egy lehet aktív (egy új választása lecseréli az előzőt).
+GEMINI_TOOL_LABELS = {
+    "canvas": ["Canvas"],
+    "deep_research": ["Deep Research", "Mélykutatás"],
+    "image": ["Képek létrehozása", "Create images", "Képek", "Images"],
+    "video": ["Videó létrehozása", "Create videos", "Videó", "Video"],
+    "guided_learning": ["Irányított tanulás", "Guided Learning"],
+}
+GEMINI_DEFAULT_TOOLS = ["canvas"]
+
+# Aktív eszköz chip (kikapcsoló gomb felirata) – ebből olvassuk ki az állapotot
+GEMINI_TOOL_CHIP_SELECTOR = "span.toolbox-drawer-item-deselect-button-label"
+GEMINI_TOOLS_BUTTON_LABELS = ["Eszközök", "Tools"]
+# Ha a regiszter egyik tools_button jelöltje sem talál, a feliratot csak ebben a
+# konténerben keressük (a lap többi gombjának felirata is tartalmazhatja az eszköz nevét)
+GEMINI_TOOLS_CONTAINER_SELECTOR = "toolbox-drawer"
+# A Tools menü az Angular overlay konténerben jelenik meg, csak ott keresünk
+GEMINI_TOOLS_MENU_ITEM_SELECTOR = (
+    ".cdk-overlay-container button, .cdk-overlay-container [role='menuitem'], "
+    "toolbox-drawer-item button"
+)
+
+# Tabonkénti eszköz-állapot cache: page -> {"tools": frozenset | None, "dirty": bool}
+TOOL_STATE = {}
+
 
 # ==========================================
 # SEGÉDFÜGGVÉNYEK – COOKIES/LOCALSTORAGE PARSOLÁS
@@ -143,453 +282,489 @@ def apply_localstorage_from_text(page, raw_ls: str):
 
 
 # ==========================================
-# CANVAS MÓD BEKAPCSOLÁSA
+# ESZKÖZ (TOOLS) MÓDOK – TABONKÉNTI CACHE
 # ==========================================
 
-def ensure_canvas_enabled(page):
+def _normalize_tools(tools):
     """
-    Bekapcsolja a Canvas módot, ha még nincs.
-    - Ha van 'span.toolbox-drawer-item-deselect-button-label' 'Canvas' szöveggel -> már aktív.
-    - Különben rákattint a 'Eszközök'/'Tools' gombra, majd a 'Canvas' elemre.
+    A kérésben kapott eszközlistát (pl. ["canvas"]) validálja és frozenset-té alakítja.
+    None -> GEMINI_DEFAULT_TOOLS. Nem string / stringek listája értéknél, ismeretlen
+    kulcsnál és egynél több eszköznél (a Gemini egyszerre csak egyet aktivál) ValueError.
     """
+    if tools is None:
+        tools = GEMINI_DEFAULT_TOOLS
+    if isinstance(tools, str):
+        tools = [tools]
+    # frozenset: a _request_options által már normalizált érték (ensure_tool_mode)
+    if not isinstance(tools, (list, tuple, frozenset)) or not all(isinstance(tool, str) for tool in tools):
+        raise ValueError("A 'gemini_tools' string vagy stringek listája kell legyen.")
+
+    normalized = set()
+    for tool in tools:
+        key = tool.strip().lower()
+        if key not in GEMINI_TOOL_LABELS:
+            raise ValueError(
+                f"Ismeretlen Gemini eszköz: '{tool}'. "
+                f"Választható: {', '.join(sorted(GEMINI_TOOL_LABELS))}"
+            )
+        normalized.add(key)
+    if len(normalized) > 1:
+        raise ValueError(
+            f"A Gemini egyszerre csak egy eszközt aktivál, kapott: {', '.join(sorted(normalized))}"
+        )
+    return frozenset(normalized)
+
+
+def _request_options(data, prompt_tokens, hedged):
+    """
+    A kérés Gemini-specifikus generálási opciói (a run_with_playwright / run_many
+    kulcsszavas argumentumai) és a válasz model id-ja. Opcionális: kérésenként
+    választható eszközök, pl. {"gemini_tools": []} = Canvas ki. Hibás listánál ValueError.
+    """
+    tools = _normalize_tools(data.get("gemini_tools"))
+    return {"tools": tools}, HEDGED_MODEL_ID if hedged else MODEL_ID
+
+
+def _invalidate_tool_state(page):
+    """Navigáció / új chat után a tab eszköz-állapota újraellenőrzendő."""
+    state = TOOL_STATE.get(page)
+    if state is not None:
+        state["dirty"] = True
+
+
+def register_tab(page):
+    """
+    Új tab felvétele az eszköz-állapot cache-be (a driver_common minden új tabnál hívja).
+    A fő frame navigációja (új chat, reload, URL váltás) piszkosra jelöli a cache-t.
+    """
+    TOOL_STATE[page] = {"tools": None, "dirty": True}
+
+    def _on_navigated(frame):
+        if frame == page.main_frame:
+            _invalidate_tool_state(page)
+
+    page.on("framenavigated", _on_navigated)
+    page.on("close", lambda _: TOOL_STATE.pop(page, None))
+
+
+def _probe_active_tools(page):
+    """
+    Egyetlen olcsó szelektorral kiolvassa az aktív eszközök chipjeit,
+    és visszaadja a hozzájuk tartozó kulcsokat.
+    """
+    labels = page.eval_on_selector_all(
+        GEMINI_TOOL_CHIP_SELECTOR,
+        "els => els.map(el => (el.textContent || '').trim())",
+    )
+    active = set()
+    for key, variants in GEMINI_TOOL_LABELS.items():
+        if any(label in variants for label in labels):
+            active.add(key)
+    return frozenset(active)
+
+
+def ensure_tool_mode(page, tools=None):
+    """
+    Beállítja a kért Gemini eszközöket (pl. Canvas be/ki) az adott tabon.
+    - Tiszta cache + egyező állapot -> nincs DOM hívás.
+    - Navigáció után egy chip-szelektorral ellenőrzünk, és csak eltérésnél kattintunk.
+    A kattintás a Tools gombra és a menü (overlay) elemeire szűkített kereséssel megy,
+    nem a teljes DOM szövegére: a Tools gombot a regiszter szelektorai, ezek hiányában
+    csak a GEMINI_TOOLS_CONTAINER_SELECTOR konténer gombjainak felirata alapján keressük.
+    """
+    wanted = _normalize_tools(tools)
+
+    state = TOOL_STATE.get(page)
+    if state is None:
+        register_tab(page)
+        state = TOOL_STATE[page]
+
+    if not state["dirty"] and state["tools"] == wanted:
+        return "cached"
+
     try:
+        active = _probe_active_tools(page)
+        if active == wanted:
+            state["tools"] = active
+            state["dirty"] = False
+            print(f"Gemini eszközök állapota: {sorted(active) or 'nincs'} (ellenőrizve)")
+            return "already-on"
+
         result = page.evaluate(
             """
-            () => {
-              // Ha már látszik a "Canvas" kikapcsoló gomb (deselect), akkor aktív
-              const hasDeselectCanvas = Array.from(
-                document.querySelectorAll('span.toolbox-drawer-item-deselect-button-label')
-              ).some(el => (el.textContent || '').trim() === 'Canvas');
-              if (hasDeselectCanvas) return 'already-on';
-
-              const findButtonByText = (texts) => {
-                const buttons = Array.from(document.querySelectorAll('button'));
-                for (const b of buttons) {
-                  const t = (b.textContent || '').trim();
-                  if (!t) continue;
-                  for (const wanted of texts) {
-                    if (t.includes(wanted)) return b;
-                  }
-                }
-                return null;
-              };
-
-              // Eszközök / Tools gomb megnyitása
-              const toolsBtn = findButtonByText(['Eszközök', 'Tools']);
-              if (toolsBtn) toolsBtn.click();
-
-              // Keressük a "Canvas" feliratot
-              const all = Array.from(document.querySelectorAll('button, span, div'));
-              const canvasLabel = all.find(el => (el.textContent || '').trim() === 'Canvas');
-              if (!canvasLabel) return 'canvas-not-found';
-
-              const clickable = canvasLabel.closest('button') || canvasLabel;
-              if (clickable instanceof HTMLElement) {
-                  clickable.click();
-                  return 'toggled-on';
+            async (arg) => {
+              const { chipSelector, toolsButtonSelector, toolsContainerSelector,
+                      menuItemSelector, toolsButtonLabels, enable, disable } = arg;
+              const sleep = (ms) => new Promise(r => setTimeout(r, ms));
+              const textOf = (el) => (el.textContent || '').trim();
+              const status = {};
+
+              // Kikapcsolás: a felesleges chipek "deselect" gombja
+              for (const [key, labels] of disable) {
+                const chip = Array.from(document.querySelectorAll(chipSelector))
+                  .find(el => labels.includes(textOf(el)));
+                const btn = chip && (chip.closest('button') || chip);
+                if (btn instanceof HTMLElement) { btn.click(); status[key] = 'off'; }
+                else status[key] = 'chip-not-found';
               }
 
-              return 'no-clickable';
+              // Bekapcsolás: Tools gomb -> menüelem a felirat alapján
+              for (const [key, labels] of enable) {
+                let toolsBtn = document.querySelector(toolsButtonSelector);
+                const container = toolsBtn ? null : document.querySelector(toolsContainerSelector);
+                if (container) {
+                  toolsBtn = Array.from(container.querySelectorAll('button'))
+                    .find(b => toolsButtonLabels.some(t => textOf(b).includes(t)));
+                }
+                if (!toolsBtn) { status[key] = 'tools-button-not-found'; continue; }
+                toolsBtn.click();
+
+                let item = null;
+                for (let i = 0; i < 20 && !item; i++) {
+                  await sleep(100);
+                  item = Array.from(document.querySelectorAll(menuItemSelector))
+                    .find(el => labels.some(l => textOf(el).includes(l)));
+                }
+                if (!item) { status[key] = 'menu-item-not-found'; continue; }
+                const clickable = item.closest('button') || item;
+                clickable.click();
+                status[key] = 'on';
+              }
+              return status;
             }
-            """
+            """,
+            {
+                "chipSelector": GEMINI_TOOL_CHIP_SELECTOR,
+                "toolsButtonSelector": _sel("tools_button"),
+                "toolsContainerSelector": GEMINI_TOOLS_CONTAINER_SELECTOR,
+                "menuItemSelector": GEMINI_TOOLS_MENU_ITEM_SELECTOR,
+                "toolsButtonLabels": GEMINI_TOOLS_BUTTON_LABELS,
+                "enable": [[k, GEMINI_TOOL_LABELS[k]] for k in sorted(wanted - active)],
+                "disable": [[k, GEMINI_TOOL_LABELS[k]] for k in sorted(active - wanted)],
+            },
         )
-        print(f"Canvas mód állapota: {result}")
+        print(f"Gemini eszközök beállítva: {result}")
+        if "tools-button-not-found" in result.values():
+            _metric_add("selector_misses")
+            print(
+                "HIBA: a Tools gomb egyik jelöltje sem talál "
+                f"({common.SELECTOR_REGISTRY['tools_button']}), és a {GEMINI_TOOLS_CONTAINER_SELECTOR} "
+                "konténerben sincs ilyen feliratú gomb."
+            )
+
+        if all(v in ("on", "off") for v in result.values()):
+            state["tools"] = wanted
+            state["dirty"] = False
+        else:
+            # Sikertelen váltásnál a következő kérés újra ellenőriz
+            state["tools"] = None
+            state["dirty"] = True
+        return result
     except Exception as e:
-        print(f"Canvas mód beállítási hiba: {e}")
+        print(f"Gemini eszköz mód beállítási hiba: {e}")
+        state["dirty"] = True
+        return "error"
+
+
+def _prepare_spare_tab(page):
+    """
+    Betöltött hot-spare tab előkészítése (driver_common._refill_spare_tabs): az
+    alapértelmezett eszközök (Canvas) is előre beállítva várnak.
+    """
+    ensure_tool_mode(page)
 
 
 # ==========================================
 # PLAYWRIGHT LOGIKA (VISSZATÉRÍTI A VÁLASZT)
 # ==========================================
 
-def run_with_playwright(prompt: str) -> str:
+def ensure_browser_session():
     """
-    Kiküldi a promptot a Google Gemini-nek Playwright segítségével,
-    és egy meglévő, globális munkamenetet használ.
+    Első híváskor elindítja a böngészőt, beinjektálja a Google cookie-kat és
+    a localStorage-ot, és megnyitja a fő chat tabot (CHAT_PAGE).
+    Visszatérés: None, ha a munkamenet kész, különben "HIBA: ..." szöveg.
     """
-    global PLAYWRIGHT_INSTANCE, BROWSER_CONTEXT, CHAT_PAGE
+    if common.CHAT_PAGE is not None:
+        return None
 
-    response_text = "HIBA: A kérés nem futott le."
+    print("Böngésző inicializálása (első kérés, Gemini)...")
 
-    # -------- 1. Inicializálás csak első kérésnél --------
-    if CHAT_PAGE is None:
-        print("Böngésző inicializálása (első kérés, Gemini)...")
+    common.PLAYWRIGHT_INSTANCE = sync_playwright().start()
+    raw_cookies_text, raw_ls_text = load_raw_data()
+    cookies_to_add = build_google_cookies(raw_cookies_text)
 
-        PLAYWRIGHT_INSTANCE = sync_playwright().start()
-        raw_cookies_text, raw_ls_text = load_raw_data()
-        cookies_to_add = build_google_cookies(raw_cookies_text)
+    profile_path = PROFILE_DIR
+    try:
+        context = common.PLAYWRIGHT_INSTANCE.chromium.launch_persistent_context(
+            user_data_dir=str(profile_path),
+            headless=False,
+            channel="chrome",
+            args=["--disable-blink-features=AutomationControlled"],
+        )
+    except Exception as e:
+        return f"HIBA: Böngésző indítási hiba (Gemini): {e}"
+    common.BROWSER_CONTEXT = context
 
-        profile_path = Path.cwd() / "gemini_profile"
+    if cookies_to_add:
         try:
-            BROWSER_CONTEXT = PLAYWRIGHT_INSTANCE.chromium.launch_persistent_context(
-                user_data_dir=str(profile_path),
-                headless=False,
-                channel="chrome",
-                args=["--disable-blink-features=AutomationControlled"],
-            )
+            context.add_cookies(cookies_to_add)
         except Exception as e:
-            return f"HIBA: Böngésző indítási hiba (Gemini): {e}"
-
-        if cookies_to_add:
-            try:
-                BROWSER_CONTEXT.add_cookies(cookies_to_add)
-            except Exception as e:
-                print(f"HIBA cookie hozzáadáskor: {e}")
-        else:
-            print("FIGYELEM: Nem sikerült Google cookie-kat kinyerni a cookies.txt-ből!")
+            print(f"HIBA cookie hozzáadáskor: {e}")
+    else:
+        print("FIGYELEM: Nem sikerült Google cookie-kat kinyerni a cookies.txt-ből!")
 
-        CHAT_PAGE = BROWSER_CONTEXT.new_page()
+    page = common.CHAT_PAGE = context.new_page()
+    register_tab(page)
 
-        print(f"Navigálás a Gemini-re: {GEMINI_URL} ...")
-        CHAT_PAGE.goto(GEMINI_URL)
-        print("Aktuális URL a navigation után:", CHAT_PAGE.url)
+    print(f"Navigálás a Gemini-re: {GEMINI_URL} ...")
+    page.goto(GEMINI_URL)
+    print("Aktuális URL a navigation után:", page.url)
 
-        if raw_ls_text:
-            apply_localstorage_from_text(CHAT_PAGE, raw_ls_text)
-            CHAT_PAGE.reload()
-            print("Oldal újratöltve a localStorage injektálás után.")
-            print("Aktuális URL reload után:", CHAT_PAGE.url)
+    if raw_ls_text:
+        apply_localstorage_from_text(page, raw_ls_text)
+        page.reload()
+        print("Oldal újratöltve a localStorage injektálás után.")
+        print("Aktuális URL reload után:", page.url)
 
-        try:
-            print("Várakozás a Gemini chat inputra (max 600s)...")
-            CHAT_PAGE.wait_for_selector(GEMINI_EDITOR_SELECTOR, timeout=600_000)
-        except Exception as e:
-            print(
-                f"KRITIKUS HIBA az inicializáláskor: {e}. "
-                "Valószínűleg nem valid a cookie/localStorage dump, vagy login képernyőre dob."
-            )
-            try:
-                if BROWSER_CONTEXT:
-                    BROWSER_CONTEXT.close()
-                if PLAYWRIGHT_INSTANCE:
-                    PLAYWRIGHT_INSTANCE.stop()
-            except Exception:
-                pass
-
-            CHAT_PAGE = None
-            BROWSER_CONTEXT = None
-            PLAYWRIGHT_INSTANCE = None
-
-            return (
-                "HIBA: A böngésző inicializálása sikertelen a Gemini-hez. "
-                "Frissítsd a 'cookies.txt' és 'localstorage.txt' tartalmát."
-            )
-
-        # Canvas bekapcsolása az első betöltés után
-        print("Canvas mód ellenőrzése/bekapcsolása (init)...")
-        ensure_canvas_enabled(CHAT_PAGE)
+    try:
+        print("Várakozás a Gemini chat inputra (max 600s)...")
+        page.wait_for_selector(_sel("composer"), timeout=600_000)
+    except Exception as e:
+        print(
+            f"KRITIKUS HIBA az inicializáláskor: {e}. "
+            "Valószínűleg nem valid a cookie/localStorage dump, vagy login képernyőre dob."
+        )
+        _close_browser_session()
 
-    if CHAT_PAGE is None:
         return (
-            "HIBA: A böngésző munkamenet az előző kérés során leállt. "
-            "Indítsd újra a szervert."
+            "HIBA: A böngésző inicializálása sikertelen a Gemini-hez. "
+            "Frissítsd a 'cookies.txt' és 'localstorage.txt' tartalmát."
         )
 
-    page = CHAT_PAGE
+    probe_selectors(page)
+    _record_snapshot(page, "idle")
+    return None
+
 
-    # -------- 2. Baseline válasz-blokkok száma --------
+def _start_generation(page, prompt, tools=None, limits=None, system=None, timeout_ms=120_000):
+    """
+    Beállítja az eszközöket, beírja és elküldi a promptot az adott tabon, és
+    visszaad egy "job" dict-et a _poll_generation / _finish_generation számára.
+    """
+    # -------- Baseline válasz-blokkok száma --------
     try:
-        initial_blocks = page.query_selector_all(GEMINI_RESPONSE_MARKDOWN_SELECTOR)
-        initial_block_count = len(initial_blocks)
+        initial_block_count = len(page.query_selector_all(_sel("response")))
     except Exception:
         initial_block_count = 0
 
     try:
-        initial_footers = page.query_selector_all(GEMINI_COMPLETION_FOOTER_SELECTOR)
-        initial_footer_count = len(initial_footers)
+        initial_footer_count = len(page.query_selector_all(_sel("completion")))
     except Exception:
         initial_footer_count = 0
 
     print(f"Baseline: {initial_block_count} markdown blokk, {initial_footer_count} footer.")
+    prompt = _apply_pinned_system(page, prompt, system, initial_block_count)
+
+    # Kérésenként csak a cache-t nézzük; navigáció után egy olcsó chip-ellenőrzés
+    ensure_tool_mode(page, tools)
 
-    # Canvas-t kérésenként is biztosítjuk, ha esetleg kikapcsoltad UI-ból
-    print("Canvas mód ellenőrzése/bekapcsolása (request)...")
-    ensure_canvas_enabled(page)
+    # -------- Prompt elküldése a Gemini UI-nak --------
+    print(f"Prompt küldése Gemini-nek: {prompt[:80]}...")
 
-    # -------- 3. Prompt elküldése a Gemini UI-nak --------
     try:
-        print(f"Prompt küldése Gemini-nek: {prompt[:80]}...")
+        editor = page.wait_for_selector(_sel("composer"), timeout=30_000)
+    except PlaywrightTimeoutError:
+        raise GenerationError(
+            "HIBA: Nem találom a Gemini szövegmezőt. "
+            "Ellenőrizd a SELECTOR_REGISTRY['composer'] jelöltjeit a GEMINI_API.py-ben."
+        )
 
-        try:
-            editor = page.wait_for_selector(GEMINI_EDITOR_SELECTOR, timeout=30_000)
-        except PlaywrightTimeoutError:
-            return (
-                "HIBA: Nem találom a Gemini szövegmezőt. "
-                "Ellenőrizd a GEMINI_EDITOR_SELECTOR értékét a GEMINI_API.py-ben."
-            )
+    editor.click()
+    editor.fill("")
+    editor.fill(prompt)
 
-        editor.click()
-        editor.fill("")
-        editor.fill(prompt)
+    try:
+        send_button = page.wait_for_selector(_sel("send_button"), timeout=10_000)
 
-        try:
-            send_button = page.wait_for_selector(GEMINI_SEND_BUTTON_SELECTOR, timeout=10_000)
+        page.wait_for_function(
+            "(btn) => !btn.hasAttribute('aria-disabled') || "
+            "btn.getAttribute('aria-disabled') === 'false'",
+            arg=send_button,
+            timeout=10_000,
+        )
 
-            page.wait_for_function(
-                "(btn) => !btn.hasAttribute('aria-disabled') || "
-                "btn.getAttribute('aria-disabled') === 'false'",
-                arg=send_button,
-                timeout=10_000,
-            )
+        send_button.click()
+    except Exception as e:
+        print(f"Send gomb hiba, fallback Enter: {e}")
+        page.keyboard.press("Enter")
+    started_at = time.time()
 
-            send_button.click()
-        except Exception as e:
-            print(f"Send gomb hiba, fallback Enter: {e}")
-            page.keyboard.press("Enter")
+    # -------- Várakozás az ÚJ válaszra (nem a régire!) --------
+    print("Várakozás a Gemini válaszára (ÚJ markdown + ÚJ footer)...")
+
+    try:
+        page.wait_for_function(
+            "([sel, n]) => document.querySelectorAll(sel).length > n",
+            arg=[_sel("response"), initial_block_count],
+            timeout=60_000,
+        )
+    except PlaywrightTimeoutError:
+        print("HIBA: Nem jelent meg válasz-markdown blokk.")
+        raise GenerationError(
+            "HIBA: Nem sikerült a Gemini válaszát kiolvasni (nincs markdown blokk)."
+        )
+    # A válasz-szelektor a korábbi válaszokra is talál: a generálást a stop gomb bizonyítja
+    _record_snapshot(
+        page,
+        "generating",
+        wait_for="stop_button",
+        baseline={
+            "initial_response_count": initial_block_count,
+            "initial_completion_count": initial_footer_count,
+        },
+    )
 
-        # -------- 4. Várakozás az ÚJ válaszra (nem a régire!) --------
-        print("Várakozás a Gemini válaszára (ÚJ markdown + ÚJ footer)...")
+    return {
+        "page": page,
+        "limits": limits,
+        "started_at": started_at,
+        "deadline": started_at + timeout_ms / 1000,
+        "soft_deadline": (
+            started_at + limits["timeout"] if limits and limits["timeout"] else None
+        ),
+        "state_arg": {
+            "markdownSelector": _sel("response"),
+            "footerSelector": _sel("completion"),
+            "initialBlockCount": initial_block_count,
+            "initialFooterCount": initial_footer_count,
+            "withText": bool(limits and (limits["max_tokens"] is not None or limits["stop"])),
+        },
+    }
 
-        try:
-            page.wait_for_selector(GEMINI_RESPONSE_MARKDOWN_SELECTOR, timeout=60_000)
-        except PlaywrightTimeoutError:
-            print("HIBA: Nem jelent meg válasz-markdown blokk.")
-            return "HIBA: Nem sikerült a Gemini válaszát kiolvasni (nincs markdown blokk)."
 
-        try:
-            page.wait_for_function(
-                """
-                (arg) => {
-                    const {
-                        markdownSelector,
-                        footerSelector,
-                        initialBlockCount,
-                        initialFooterCount
-                    } = arg;
-
-                    const blocks = Array.from(document.querySelectorAll(markdownSelector));
-                    const footers = footerSelector
-                        ? Array.from(document.querySelectorAll(footerSelector))
-                        : [];
-
-                    // Csak akkor kész, ha ÚJ blokk és/vagy ÚJ footer is van
-                    if (blocks.length <= initialBlockCount) {
-                        return false;
-                    }
-
-                    const last = blocks[blocks.length - 1];
-                    const busy = last.getAttribute('aria-busy');
-
-                    if (busy === 'true') return false;
-
-                    if (footerSelector) {
-                        if (footers.length <= initialFooterCount) {
-                            return false;
-                        }
-                    }
-
-                    return true;
-                }
-                """,
-                arg={
-                    "markdownSelector": GEMINI_RESPONSE_MARKDOWN_SELECTOR,
-                    "footerSelector": GEMINI_COMPLETION_FOOTER_SELECTOR,
-                    "initialBlockCount": initial_block_count,
-                    "initialFooterCount": initial_footer_count,
+def _poll_generation(job):
+    """
+    Egyetlen böngésző-hívással (GEMINI_GENERATION_STATE_JS) megnézi a job állapotát.
+    Visszatérés: (status, finish_reason),
+    status: "running" | "done" | "limit" | "deadline" (kliens timeout) | "timeout".
+    """
+    state = job["page"].evaluate(GEMINI_GENERATION_STATE_JS, job["state_arg"])
+    if state["done"]:
+        return "done", "stop"
+    reason = _limit_reached(state["text"], job["limits"])
+    if reason:
+        return "limit", reason
+
+    now = time.time()
+    if job["soft_deadline"] is not None and now >= job["soft_deadline"]:
+        return "deadline", None
+    if now >= job["deadline"]:
+        return "timeout", None
+    return "running", None
+
+
+def _finish_generation(job, status, finish_reason):
+    """
+    Lezárja a jobot: megszakításnál / korlátnál leállítja a generálást, egyébként
+    kiolvassa az ÚJ utolsó markdown blokkot és csonkolja.
+    Visszatérés: (válasz szöveg, finish_reason).
+    """
+    page = job["page"]
+    elapsed = time.time() - job["started_at"]
+
+    if status == "cancelled":
+        # A kliens már nem olvassa a választ: stop, kinyerés kihagyva, a tab marad
+        _cancel_generation(job)
+        print(f"Kliens lecsatlakozott – Gemini generálás leállítva ({elapsed:.1f} mp elpazarolva).")
+        return CANCELLED_RESPONSE, None
+
+    if status == "deadline":
+        # A kliens timeoutja előtt nincs kész válasz: külön jelezzük, nem "length"-ként
+        return _deadline_generation(job)
+
+    if status == "timeout":
+        print("FIGYELEM: Timeout a generálás befejezésének detektálásánál – a legutolsó szöveget olvassuk ki.")
+        finish_reason = "stop"
+    else:
+        if status == "limit":
+            # Megvan, amit a kliens kért: nem várjuk ki a teljes generálást
+            _stop_generation(page)
+            _metric_add("requests_truncated")
+            print(f"Korlát elérve ({finish_reason}) – Gemini generálás korán leállítva.")
+        else:
+            LATENCY_SAMPLES.append(elapsed)
+            _record_snapshot(
+                page,
+                "done",
+                baseline={
+                    "initial_response_count": job["state_arg"]["initialBlockCount"],
+                    "initial_completion_count": job["state_arg"]["initialFooterCount"],
                 },
-                timeout=120_000,
             )
-        except PlaywrightTimeoutError:
-            print("FIGYELEM: Timeout a generálás befejezésének detektálásánál – a legutolsó szöveget olvassuk ki.")
-
-        # -------- 5. Az ÚJ utolsó markdown blokk szövegének kiolvasása --------
-        try:
-            blocks_after = page.query_selector_all(GEMINI_RESPONSE_MARKDOWN_SELECTOR)
-            if blocks_after:
-                last_block = blocks_after[-1]
-                text = last_block.inner_text() or ""
-            else:
-                text = ""
-
-            if not text.strip():
-                print("HIBA: Az utolsó markdown blokk üres szöveget adott.")
-                response_text = "HIBA: A kinyert Gemini szöveg üres maradt."
-            else:
-                response_text = text
-        except Exception as e:
-            print(f"HIBA a válasz kiolvasásakor: {e}")
-            response_text = f"HIBA: A Gemini válasz kiolvasása közben hiba történt: {e}"
+        _metric_add("generation_seconds_total", elapsed)
 
+    # -------- Az ÚJ utolsó markdown blokk kiolvasása (markdownként, egy hívással) --------
+    try:
+        text = page.evaluate(
+            LAST_RESPONSE_JS, [_sel("response"), None, common.MARKDOWN_EXTRACTION]
+        ) or ""
     except Exception as e:
-        print(f"HIBA a folyamat közben (Gemini): {e}. Munkamenet lezárva.")
-
-        try:
-            if BROWSER_CONTEXT:
-                BROWSER_CONTEXT.close()
-            if PLAYWRIGHT_INSTANCE:
-                PLAYWRIGHT_INSTANCE.stop()
-        except Exception:
-            pass
-
-        CHAT_PAGE = None
-        BROWSER_CONTEXT = None
-        PLAYWRIGHT_INSTANCE = None
-
-        response_text = (
-            "HIBA: A Playwright nem tudta elküldeni a kérést a Gemini-nek. "
-            f"Hiba: {e}"
-        )
-
-    return response_text
-
-
-# ==========================================
-# FLASK API – OpenAI-kompatibilis wrapper
-# ==========================================
+        print(f"HIBA a válasz kiolvasásakor: {e}")
+        return f"HIBA: A Gemini válasz kiolvasása közben hiba történt: {e}", None
 
-app = Flask(__name__)
-
-
-def _extract_text_from_content(content):
-    if isinstance(content, str):
-        return content
-
-    if isinstance(content, list):
-        parts = []
-        for item in content:
-            if isinstance(item, str):
-                parts.append(item)
-            elif isinstance(item, dict):
-                txt = (
-                    item.get("text")
-                    or item.get("input_text")
-                    or item.get("content")
-                    or ""
-                )
-                if txt:
-                    parts.append(str(txt))
-            else:
-                parts.append(str(item))
-        return "\n".join(parts)
-
-    return str(content)
-
-
-def _build_prompt_from_messages(messages):
-    blocks = []
-
-    for msg in messages:
-        role = msg.get("role", "user")
-        text = _extract_text_from_content(msg.get("content", ""))
-
-        if not text:
-            continue
-        if role == "tool":
-            continue
-
-        if role == "system":
-            blocks.append(text)
-        elif role == "user":
-            blocks.append(text)
-        elif role == "assistant":
-            blocks.append(f"Assistant: {text}")
-        else:
-            blocks.append(text)
+    if not text.strip():
+        print("HIBA: Az utolsó markdown blokk üres szöveget adott.")
+        return "HIBA: A kinyert Gemini szöveg üres maradt.", None
 
-    return "\n\n".join(blocks).strip()
+    return _apply_limits(text, job["limits"], finish_reason)
 
 
-@app.route("/v1/chat/completions", methods=["POST"])
-@app.route("/chat/completions", methods=["POST"])
-def chat_completions():
-    data = request.json or {}
+def _stop_generation(page):
+    """Megnyomja a Gemini UI stop gombját, ha a generálás még fut."""
     try:
-        print(f"REQUEST PATH: {request.path}")
-    except Exception:
-        pass
-
-    messages = data.get("messages", [])
-    prompt = _build_prompt_from_messages(messages)
-
-    if not prompt:
-        return jsonify({"error": "Nincs értelmezhető szöveg a 'messages' mezőben."}), 400
+        page.click(_sel("stop_button"), timeout=2000)
+        print("Gemini stop gomb megnyomva.")
+    except Exception as e:
+        print(f"Gemini stop gomb nem elérhető (valószínűleg már kész): {e}")
 
-    print(f"\n--- ÚJ KÉRÉS (összefűzött, Gemini): {prompt[:60]}... ---")
-    generated_content = run_with_playwright(prompt)
-    print(f"--- KÉSZ, válasz hossza: {len(generated_content)} karakter ---")
 
-    if generated_content.startswith("HIBA:"):
-        error_message = generated_content.replace("HIBA: ", "")
-        return (
-            jsonify(
-                {
-                    "error": {
-                        "message": error_message,
-                        "type": "browser_error",
-                        "code": "500",
-                    }
-                }
-            ),
-            500,
-        )
+# ==========================================
+# SESSION ELLENŐRZÉS (KEEP-ALIVE)
+# ==========================================
 
-    response_data = {
-        "id": "chatcmpl-" + str(uuid.uuid4()).replace("-", ""),
-        "object": "chat.completion",
-        "created": int(time.time()),
-        "model": "gemini-playwright",
-        "choices": [
-            {
-                "index": 0,
-                "message": {
-                    "role": "assistant",
-                    "content": generated_content,
-                },
-                "logprobs": None,
-                "finish_reason": "stop",
-            }
-        ],
-        "usage": {
-            "prompt_tokens": len(prompt.split()),
-            "completion_tokens": len(generated_content.split()),
-            "total_tokens": len(prompt.split()) + len(generated_content.split()),
-        },
-    }
-    print(response_data)
-    return jsonify(response_data)
-
-
-@app.route("/v1/models", methods=["GET"])
-@app.route("/models", methods=["GET"])
-def list_models():
-    return jsonify(
-        {
-            "object": "list",
-            "data": [
-                {
-                    "id": "gemini-playwright",
-                    "object": "model",
-                    "created": int(time.time()),
-                    "owned_by": "user-host",
-                }
-            ],
-        }
+def _check_session(now):
+    """
+    A driver_common._keepalive_session Gemini-s lépése, hálózati hívás nélkül: a lapon
+    bejelentkezve a Google fiók gomb ("account"), kijelentkezve a bejelentkezés link
+    ("sign_in") látszik. (A Gemini app HTML-je kijelentkezve is 200-zal jön, és minden
+    ellenőrzésnél letöltené a teljes appot.) A DOM a legutóbbi betöltés állapota: a
+    SESSION_REFRESH_INTERVAL_S időnkénti reload frissíti a cookie-kat és vele ezt is.
+    Lejárat helyett a következő esedékes reloadig hátralévő időt adja.
+    Visszatérés: ({"status", "authenticated"}, mp).
+    """
+    state = common.CHAT_PAGE.evaluate(
+        """([accountSelector, signInSelector]) => {
+            const account = !!document.querySelector(accountSelector);
+            const signIn = !!document.querySelector(signInSelector);
+            return {
+                status: account ? 'account' : (signIn ? 'signed_out' : 'no_account'),
+                authenticated: account && !signIn,
+            };
+        }""",
+        [_sel("account"), _sel("sign_in")],
     )
+    return state, common.LAST_SESSION_REFRESH + SESSION_REFRESH_INTERVAL_S - now
 
 
 # ==========================================
-# LEZÁRÁSI LOGIKA
+# INDÍTÁS
 # ==========================================
-
-def shutdown_playwright():
-    global BROWSER_CONTEXT, PLAYWRIGHT_INSTANCE
-    if BROWSER_CONTEXT:
-        print("\n🤖 Lezárás: Playwright böngésző bezárása (Gemini munkamenet vége)...")
-        try:
-            BROWSER_CONTEXT.close()
-        except Exception as e:
-            print(f"Lezárási hiba: {e}")
-
-    if PLAYWRIGHT_INSTANCE:
-        try:
-            PLAYWRIGHT_INSTANCE.stop()
-        except Exception as e:
-            print(f"Playwright stop hiba: {e}")
-
-
 if __name__ == "__main__":
-    atexit.register(shutdown_playwright)
+    parser = common.build_arg_parser("Playwright-alapú OpenAI-kompatibilis proxy (Gemini).", PROFILE_DIR)
+    args = parser.parse_args()
+    PROFILE_DIR = args.profile_dir
+    common.apply_arguments(args)
 
-    print("🤖 Playwright-alapú Gemini API szerver indítása a http://127.0.0.1:5000 címen...")
+    print(f"🤖 Playwright-alapú Gemini API szerver indítása a http://127.0.0.1:{args.port} címen...")
     print("Használd a cookies.txt + localstorage.txt injektálást a meglévő Google/Gemini sessionödhöz.")
-    app.run(debug=False, port=5000, threaded=False)
+    common.serve(args.port)
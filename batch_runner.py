@@ -0,0 +1,229 @@
+#!/usr/bin/env python3
+"""
+Offline batch futtató: egy JSONL fájl kéréseit párhuzamosan, a böngésző összes
+tabján futtatja a ChatGPT vagy Gemini driverrel, az eredményeket soronként egy
+kimeneti JSONL-be írja (OpenAI Batch output formátum).
+
+Bemeneti sorok (bármelyik):
+    {"custom_id": "...", "method": "POST", "url": "/v1/chat/completions", "body": {...}}
+    {"custom_id": "...", "messages": [...], "max_tokens": ...}        (nyers kérés törzs)
+    {"request_id": "...", "title": "...", "body": "szöveg"}           (mint a requests.jsonl)
+
+A kimeneti fájl egyben a checkpoint: újraindításkor a már sikeresen (200) lefutott
+custom_id-kat kihagyjuk, a hibás rekordokat töröljük a fájlból és újra futtatjuk, így
+custom_id-nként mindig egy rekord marad.
+
+Használat:
+    python batch_runner.py --backend chatgpt input.jsonl output.jsonl --tabs 4
+"""
+import sys
+import os
+import json
+import uuid
+import argparse
+from pathlib import Path
+
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import driver_common as common
+
+
+def load_done_ids(output_path):
+    """
+    A kimeneti fájlból (checkpoint) a már sikeresen lefutott custom_id-k. A hibás és
+    félbeszakadt rekordokat a fájlból kivesszük (újrafuttatjuk őket), hogy a folytatás
+    ne írjon ugyanahhoz a custom_id-hoz még egy rekordot.
+    """
+    done = set()
+    if not output_path.exists():
+        return done
+
+    kept = []
+    dropped = 0
+    with open(output_path, "r", encoding="utf-8") as f:
+        for line in f:
+            try:
+                record = json.loads(line)
+            except json.JSONDecodeError:
+                # Félbeszakadt utolsó sor (crash) – újrafuttatjuk
+                dropped += 1
+                continue
+            response = record.get("response") or {}
+            custom_id = record.get("custom_id")
+            if response.get("status_code") == 200 and custom_id not in done:
+                done.add(custom_id)
+                kept.append(line if line.endswith("\n") else line + "\n")
+            else:
+                dropped += 1
+
+    if dropped:
+        # Atomikus csere: crash esetén a régi checkpoint marad meg
+        tmp_path = output_path.with_name(output_path.name + ".tmp")
+        with open(tmp_path, "w", encoding="utf-8") as f:
+            f.writelines(kept)
+            f.flush()
+            os.fsync(f.fileno())
+        os.replace(tmp_path, output_path)
+        print(f"Checkpoint: {dropped} hibás / félbeszakadt rekord törölve, újrafuttatjuk.")
+    return done
+
+
+def parse_request_line(line, line_no):
+    """Egy bemeneti sorból (custom_id, chat completion body) pár. Hibás sornál ValueError."""
+    record = json.loads(line)
+    if not isinstance(record, dict):
+        raise ValueError(f"JSON objektum kell, kapott: {type(record).__name__}")
+    custom_id = str(
+        record.get("custom_id") or record.get("request_id") or f"line-{line_no}"
+    )
+
+    body = record.get("body")
+    if isinstance(body, dict):
+        return custom_id, body
+    if isinstance(body, str):
+        # requests.jsonl-szerű sor: cím + szöveg egy user üzenetként
+        content = f"{record['title']}\n\n{body}" if record.get("title") else body
+        return custom_id, {"messages": [{"role": "user", "content": content}]}
+    return custom_id, record
+
+
+def validate_body(body):
+    """A chat completion body alakjának ellenőrzése, mielőtt a promptot építjük. Hibánál ValueError."""
+    messages = body.get("messages")
+    if not isinstance(messages, list) or not all(isinstance(msg, dict) for msg in messages):
+        raise ValueError("A 'messages' mező üzenet objektumok listája kell legyen.")
+
+
+def iter_jobs(driver, input_path, done_ids, writer):
+    """
+    Lusta iterátor a még le nem futott kérésekre (run_many item-ek).
+    A hibás sorokat azonnal hibaként írja ki, és kihagyja: egy rossz sor nem állíthatja
+    meg a batch-et (a kivétel a run_many-n át a futást is leállítaná).
+    """
+    with open(input_path, "r", encoding="utf-8") as f:
+        for line_no, line in enumerate(f, start=1):
+            if not line.strip():
+                continue
+            try:
+                custom_id, body = parse_request_line(line, line_no)
+            except (ValueError, KeyError) as e:
+                writer.write_error(f"line-{line_no}", f"Hibás JSON sor: {e}")
+                continue
+
+            if custom_id in done_ids:
+                continue
+
+            try:
+                validate_body(body)
+                prompt = common._build_prompt_from_messages(body["messages"])
+                if not prompt:
+                    raise ValueError("Nincs értelmezhető szöveg a 'messages' mezőben.")
+
+                # Túl hosszú prompt: hibaként rögzítjük, nem küldjük a böngészőbe
+                prompt_tokens, context_error = common._check_context_length(body["messages"])
+                if context_error:
+                    raise ValueError(context_error)
+
+                # Backend-specifikus opciók (ChatGPT: UI modell, Gemini: eszközök)
+                options, response_model = driver._request_options(body, prompt_tokens, False)
+                item = {"prompt": prompt, "limits": common._parse_generation_limits(body), **options}
+            except (TypeError, AttributeError, ValueError) as e:
+                writer.write_error(custom_id, str(e))
+                continue
+
+            item["custom_id"] = custom_id
+            item["prompt_tokens"] = prompt_tokens
+            item["response_model"] = response_model
+            yield item
+
+
+class ResultWriter:
+    """Soronként, azonnal (flush + fsync) írja a kimeneti JSONL-t."""
+
+    def __init__(self, path):
+        self.file = open(path, "a", encoding="utf-8")
+        self.ok = 0
+        self.failed = 0
+
+    def _write(self, record):
+        self.file.write(json.dumps(record, ensure_ascii=False) + "\n")
+        self.file.flush()
+        os.fsync(self.file.fileno())
+
+    def write_result(self, custom_id, body):
+        self.ok += 1
+        self._write(
+            {
+                "id": "batch_req_" + uuid.uuid4().hex,
+                "custom_id": custom_id,
+                "response": {"status_code": 200, "body": body},
+                "error": None,
+            }
+        )
+
+    def write_error(self, custom_id, message):
+        self.failed += 1
+        self._write(
+            {
+                "id": "batch_req_" + uuid.uuid4().hex,
+                "custom_id": custom_id,
+                "response": None,
+                "error": {"code": "batch_error", "message": message},
+            }
+        )
+
+    def close(self):
+        self.file.close()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="JSONL batch futtatása a Playwright proxy driverekkel.")
+    parser.add_argument("input", type=Path, help="bemeneti JSONL (kérés törzsek)")
+    parser.add_argument("output", type=Path, help="kimeneti JSONL (egyben checkpoint)")
+    parser.add_argument("--backend", choices=sorted(common.DRIVER_SCRIPTS), default="chatgpt")
+    parser.add_argument("--tabs", type=int, default=4, help="extra tabok száma a fő tab mellett")
+    args = parser.parse_args()
+
+    driver = common.load_backend(args.backend)
+    common.MAX_EXTRA_TABS = args.tabs
+    common._get_token_encoder()  # a tiktoken letöltése (ha kell) a batch előtt
+
+    done_ids = load_done_ids(args.output)
+    if done_ids:
+        print(f"Folytatás checkpointból: {len(done_ids)} kérés már kész, kihagyjuk.")
+
+    writer = ResultWriter(args.output)
+    jobs = []  # index -> (custom_id, prompt, prompt_tokens, model), a run_many indexei szerint
+
+    def tracked_jobs():
+        for item in iter_jobs(driver, args.input, done_ids, writer):
+            jobs.append(
+                (item.pop("custom_id"), item["prompt"], item.pop("prompt_tokens"), item.pop("response_model"))
+            )
+            yield item
+
+    def on_result(index, text, finish_reason):
+        custom_id, prompt, prompt_tokens, model = jobs[index]
+        if text.startswith("HIBA:"):
+            writer.write_error(custom_id, text.replace("HIBA: ", ""))
+        else:
+            body = common._build_completion_response(
+                model, prompt, [(text, finish_reason)], prompt_tokens
+            )
+            writer.write_result(custom_id, body)
+        print(f"[{writer.ok} kész / {writer.failed} hibás] {custom_id}")
+
+    try:
+        common.run_many(tracked_jobs(), on_result=on_result)
+    except KeyboardInterrupt:
+        print("\nMegszakítva – a kimeneti fájlból a futás folytatható.")
+    finally:
+        writer.close()
+        common.shutdown_playwright()
+
+    print(f"Batch vége: {writer.ok} sikeres, {writer.failed} hibás -> {args.output}")
+    return 0 if writer.failed == 0 else 1
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,99 @@
+#!/usr/bin/env python3
+"""
+Benchmark a válasz-kinyeréshez: egy szintetikus, nagyon hosszú asszisztens választ
+(címek, bekezdések, listák, kódblokkok, táblázatok) tölt be egy headless böngészőbe,
+és összeméri a régi kinyerést (Playwright locator / element handle + inner_text, több
+protokoll-hívás) az egyhívásos driver_common.LAST_RESPONSE_JS-sel (markdown és nyers innerText).
+
+Használat:
+    python bench_extract.py --backend chatgpt --sections 10 100 1000 --repeat 5
+"""
+import sys
+import argparse
+from pathlib import Path
+
+from playwright.sync_api import sync_playwright
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import driver_common as common
+
+
+def build_answer_html(sections):
+    """Szintetikus válasz: szakaszonként cím, bekezdés, lista, 40 soros kódblokk, táblázat."""
+    code = "\n".join(f"    value_{i} = compute({i}, 'x' * {i})  # sor {i}" for i in range(40))
+    parts = []
+    for n in range(sections):
+        parts.append(
+            f"<h3>{n}. szakasz</h3>"
+            f"<p>Magyarázat <strong>fontos</strong> részekkel és <code>inline_{n}()</code> hívással.</p>"
+            "<ol><li><p>első lépés</p><ul><li>al-lépés</li><li>még egy</li></ul></li>"
+            "<li>második lépés</li></ol>"
+            f'<pre><div>python</div><code class="language-python">def f_{n}():\n{code}\n</code></pre>'
+            "<table><thead><tr><th>név</th><th>érték</th></tr></thead>"
+            f"<tbody><tr><td>a</td><td>{n}</td></tr><tr><td>b</td><td>{n * 2}</td></tr></tbody></table>"
+        )
+    return "".join(parts)
+
+
+def page_html(backend, answer):
+    if backend == "chatgpt":
+        return (
+            '<div data-message-author-role="assistant"><div class="markdown">előző</div></div>'
+            f'<div data-message-author-role="assistant"><div class="markdown">{answer}</div></div>'
+        )
+    return (
+        '<div class="markdown markdown-main-panel">előző</div>'
+        f'<div class="markdown markdown-main-panel">{answer}</div>'
+    )
+
+
+def old_extract(driver, backend, page):
+    """A korábbi kinyerés, ahogy a driverek használták."""
+    if backend == "chatgpt":
+        return page.locator(f"{driver.RESPONSE_CONTAINER_SELECTOR} .markdown").last.inner_text()
+    return page.query_selector_all(driver.GEMINI_RESPONSE_MARKDOWN_SELECTOR)[-1].inner_text()
+
+
+def new_extract(driver, backend, page, as_markdown):
+    if backend == "chatgpt":
+        arg = [driver.RESPONSE_CONTAINER_SELECTOR, ".markdown", as_markdown]
+    else:
+        arg = [driver.GEMINI_RESPONSE_MARKDOWN_SELECTOR, None, as_markdown]
+    return page.evaluate(common.LAST_RESPONSE_JS, arg)
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Válasz-kinyerés benchmark (inner_text vs. egyhívásos markdown).")
+    parser.add_argument("--backend", choices=sorted(common.DRIVER_SCRIPTS), default="chatgpt")
+    parser.add_argument("--sections", type=int, nargs="+", default=[10, 100, 1000])
+    parser.add_argument("--repeat", type=int, default=5)
+    args = parser.parse_args()
+
+    driver = common.load_backend(args.backend)
+
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True)
+        page = browser.new_page()
+
+        print(f"{'szakasz':>8} {'HTML (kB)':>10} {'régi (ms)':>10} {'innerText (ms)':>15} "
+              f"{'markdown (ms)':>14} {'markdown (kB)':>14}")
+        for sections in args.sections:
+            answer = build_answer_html(sections)
+            page.set_content(page_html(args.backend, answer))
+
+            old_ms, _ = common.measure(lambda: old_extract(driver, args.backend, page), args.repeat)
+            raw_ms, _ = common.measure(lambda: new_extract(driver, args.backend, page, False), args.repeat)
+            md_ms, markdown = common.measure(lambda: new_extract(driver, args.backend, page, True), args.repeat)
+
+            if markdown.count("```python") != sections:
+                print(f"HIBA: {sections} kódblokk helyett {markdown.count('```python')} jött vissza.")
+                return 1
+            print(f"{sections:>8} {len(answer) / 1024:>10.0f} {old_ms:>10.1f} {raw_ms:>15.1f} "
+                  f"{md_ms:>14.1f} {len(markdown) / 1024:>14.0f}")
+
+        browser.close()
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
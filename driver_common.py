@@ -0,0 +1,2225 @@
+#!/usr/bin/env python3
+"""
+A ChatGPT és a Gemini driver közös, backend-független része: a Flask API, a hedge
+kérések, a párhuzamos generálás (run_many), a generálási korlátok, a tokenizálás, a
+prompt tömörítés, a beszélgetés index, a metrikák, a profilozás és a háttérfeladatok
+(meleg indítás, session keep-alive).
+
+Itt van a böngésző állapota (CHAT_PAGE, BROWSER_CONTEXT), a tab pool, a hot-spare tabok,
+a szelektor regiszter kezelése, a válasz markdownná alakítása és a közös parancssor is.
+A driver (GPT_API.py / GEMINI_API.py) importkor a bind()-dal köti be magát (chat URL,
+szelektor regiszter); a közös kód a BACKEND modulon át éri el a DOM-specifikus lépéseket
+(_start_generation, _poll_generation, _finish_generation, session ellenőrzés).
+Folyamatonként egy driver fut.
+"""
+import sys
+import re
+import uuid
+import time
+import select
+import socket
+import json
+import io
+import hashlib
+import sqlite3
+import threading
+import pstats
+import cProfile
+import tempfile
+import inspect
+import functools
+import importlib.util
+import contextlib
+import http.client
+import urllib.parse
+import atexit
+import signal
+import argparse
+from collections import deque
+from pathlib import Path
+from flask import Flask, request, jsonify, Response
+from werkzeug.serving import make_server
+
+# Opcionális: a Playwright protokoll-hívások számlálása profilozáskor (belső API,
+# verziónként változhat – ha nincs meg, a riportból csak ez a rész marad ki)
+try:
+    from playwright._impl._connection import Channel as PlaywrightChannel
+except ImportError:
+    PlaywrightChannel = None
+
+# Opcionális: pontos tokenizálás (pip install tiktoken), enélkül karakter-alapú becslés
+try:
+    import tiktoken
+except ImportError:
+    tiktoken = None
+
+
+# ==========================================
+# A DRIVER BEKÖTÉSE
+# ==========================================
+BACKEND = None  # a bekötött driver modul (GPT_API / GEMINI_API)
+
+
+def bind(backend, chat_url, selector_registry, probe_keys):
+    """
+    A driver modul bekötése (importkor hívja). `chat_url`: az üres új chat URL-je,
+    `selector_registry`: a driver SELECTOR_REGISTRY-je, `probe_keys`: az üres chaten
+    mindig látszó kulcsok (probe_selectors). A driver adja:
+    - azonosítók: BACKEND_LABEL, MODEL_ID, MODEL_IDS, HEDGED_MODEL_ID, HEDGE_PEER_MODEL,
+      CONVERSATION_BACKEND, CONVERSATION_URL_RE, SESSION_REFRESH_MARGIN_S,
+    - munkamenet: ensure_browser_session (kitölti a CHAT_PAGE / BROWSER_CONTEXT állapotot),
+      _check_session,
+    - generálás: _start_generation, _poll_generation, _finish_generation, _stop_generation,
+    - tabok: register_tab (új tab a driver tabonkénti cache-ébe), _prepare_spare_tab,
+    - kérés: _request_options (backend-specifikus generálási opciók és a válasz model id-ja).
+    """
+    global BACKEND, CHAT_URL, SELECTOR_REGISTRY, SELECTOR_PROBE_KEYS, SELECTOR_BUDGET_MS
+    BACKEND = backend
+    CHAT_URL = chat_url
+    SELECTOR_REGISTRY = selector_registry
+    SELECTOR_PROBE_KEYS = probe_keys
+    SELECTOR_BUDGET_MS = {key: 5.0 for key in selector_registry}
+
+
+# A driver szkriptek az offline eszközöknek (batch_runner, selector_replay, bench_extract)
+DRIVER_SCRIPTS = {
+    "chatgpt": Path(__file__).parent / "ChatGPT" / "GPT_API.py",
+    "gemini": Path(__file__).parent / "Gemini" / "GEMINI_API.py",
+}
+
+
+def load_backend(name):
+    """A driver szkript betöltése modulként (a Flask szerver nem indul el), bekötve ide."""
+    spec = importlib.util.spec_from_file_location(f"{name}_driver", DRIVER_SCRIPTS[name])
+    module = importlib.util.module_from_spec(spec)
+    sys.modules[spec.name] = module  # a driver sys.modules-on át köti be magát (bind)
+    spec.loader.exec_module(module)
+    return module
+
+
+def measure(func, repeat):
+    """(legjobb idő ms-ben, utolsó eredmény) – az offline mérésekhez."""
+    best, result = None, None
+    for _ in range(repeat):
+        started = time.perf_counter()
+        result = func()
+        elapsed = (time.perf_counter() - started) * 1000
+        best = elapsed if best is None else min(best, elapsed)
+    return best, result
+
+
+# ==========================================
+# KÖZÖS BEÁLLÍTÁSOK ÉS ÁLLAPOT
+# ==========================================
+MAX_CHOICES = 8  # n > 1 esetén legfeljebb ennyi párhuzamos választ kérhet a kliens
+
+# Háttérfeladatok (spare tabok feltöltése) legfeljebb ilyen gyakran futnak (mp)
+BACKGROUND_INTERVAL_S = 1.0
+LAST_BACKGROUND_RUN = 0.0
+
+# Session keep-alive: tétlen időben ennyi időnként ellenőrizzük / frissítjük a sessiont
+KEEPALIVE_INTERVAL_S = 300
+LAST_KEEPALIVE = 0.0
+LAST_SESSION_REFRESH = time.time()  # a legutóbbi keep-alive reload ideje
+WARM_START = True  # a böngészőt induláskor, az első kérés előtt inicializáljuk
+LAST_WARM_START = 0.0
+
+# Hedge kérések: a "<modell>-hedged" id ugyanazt a promptot két helyre küldi.
+# HEDGE_PEER_URL megadásakor a másik proxy példány kapja (BACKEND.HEDGE_PEER_MODEL
+# modellel), különben egy második tab ebben a böngészőben.
+HEDGE_PEER_URL = None  # pl. "http://127.0.0.1:5001/v1/chat/completions" (--hedge-peer-url)
+HEDGE_AFTER_P95 = True  # elég minta után csak a p95 generálási idő után hedge-elünk
+HEDGE_MIN_SAMPLES = 20
+LATENCY_SAMPLES = deque(maxlen=200)  # sikeres generálások ideje (mp)
+
+# System prompt rögzítése: a messages[] elején álló (stabil, azonos hash-ű) system
+# promptot chatenként csak egyszer, az első körben küldjük el; a későbbi körök a
+# böngészőben már csak a változó részt gépelik be.
+PIN_SYSTEM_PROMPT = False
+PINNED_SYSTEM = {}  # page -> {"hash": ..., "turns": válaszok száma a rögzítő kör után}
+
+# Tokenizálás: a GPT-4o kódolása (tiktoken); a prompt_tokens és a kontextus-korlát
+# ellenőrzése ezzel számol, nem a szavak számával. A Gemini tokenizere nem érhető el
+# lokálisan, ahhoz is az o200k_base a közelítés.
+TOKENIZER_ENCODING = "o200k_base"
+TOKEN_ENCODER = None  # induláskor töltjük be (serve()); False, ha a tiktoken nem elérhető
+# Üzenetenkénti tokenszám cache: a szöveg hash-e -> tokenek (LRU). A kulcs a hash, nem a
+# szöveg: az Aider repo-map / teljes fájl üzenetei akár több száz kB-osak
+MESSAGE_TOKEN_CACHE = {}
+MESSAGE_TOKEN_CACHE_SIZE = 4096
+# A kontextus-korlát (max_input_tokens) az Aider modell-metaadatából; e nélkül 128k
+MODEL_METADATA_PATH = Path(__file__).resolve().parent / ".aider.model.metadata.json"
+MAX_INPUT_TOKENS = None  # None: betöltés a MODEL_METADATA_PATH-ból az első kérésnél
+
+# Beszélgetés index (SQLite): a messages[] prefixek ujjlenyomata -> web chat URL + fiók.
+# Újraindítás / router failover után a meglévő szálat nyitjuk meg, és csak az új
+# üzeneteket gépeljük be. None: kikapcsolva (--conversation-db).
+CONVERSATION_DB = None
+CONVERSATION_INDEX = None  # nyitott sqlite3 kapcsolat
+CONVERSATION_TTL_S = 30 * 24 * 3600
+ACCOUNT_ID = "default"  # a bejelentkezett fiók azonosítója (--account), a profil-másolatok közösek
+
+# Prompt tömörítés: az Aider ugyanazt a fájltartalmat többször is elküldi (korábbi
+# körök, újraküldött szerkesztések). A második előfordulástól rövid visszautalás megy.
+# 0 = kikapcsolva, 1 = azonos kódblokkok (``` ... ```), 2 = azonos bekezdések is.
+# Alapból ki: a kliens promptját csak kérésre (--dedup-level) írjuk át.
+PROMPT_DEDUP_LEVEL = 0
+PROMPT_DEDUP_MIN_CHARS = 400  # ennél rövidebb blokkot nem érdemes kiváltani
+FENCED_BLOCK_RE = re.compile(r"^(`{3,}|~{3,})[^\n]*\n.*?^\1[ \t]*$", re.M | re.S)
+
+# Generálás pollozása (ms) – ennyi időnként nézzük a befejezést és a kliens kapcsolatát
+POLL_INTERVAL_MS = 500
+
+# A kliens timeoutja: az openai-python (LiteLLM, Aider) kliens-opcióként kapja, és ebben
+# a fejlécben küldi (mp). A body "timeout" mezője felülírja. Ennyivel a lejárta előtt
+# állunk le, hogy a kliens még időben választ (DEADLINE_RESPONSE, 504) kapjon.
+CLIENT_TIMEOUT_HEADER = "X-Stainless-Timeout"
+CLIENT_TIMEOUT_MARGIN_S = 5.0
+
+# Ezt adja vissza a run_with_playwright, ha a kliens menet közben lecsatlakozott
+CANCELLED_RESPONSE = "HIBA: A kliens bontotta a kapcsolatot, a generálás leállítva."
+
+# Ezt adja vissza, ha a generálás a kliens timeoutja előtt nem fejeződött be. Nem csonkolt
+# "length" válasz: az a kliensnek (Aider) azt jelentené, hogy a modell a max_tokens-be ütközött
+DEADLINE_RESPONSE = "HIBA: A generálás nem fejeződött be a kliens timeoutja előtt, leállítva."
+
+# Egyszerű folyamaton belüli metrikák (GET /metrics); a driverek a saját kulcsaikkal bővítik
+METRICS = {
+    "requests_total": 0,
+    "requests_failed": 0,
+    "requests_cancelled": 0,
+    "requests_truncated": 0,
+    "requests_deadline": 0,
+    "generation_seconds_total": 0.0,
+    "cancelled_generation_seconds_total": 0.0,
+    "hedges_started": 0,
+    "hedge_wins": 0,
+    "hedge_losses": 0,
+    "hedge_loss_seconds_total": 0.0,
+    "spare_tab_hits": 0,
+    "spare_tab_misses": 0,
+    "system_prompt_sent": 0,
+    "system_prompt_pinned": 0,
+    "system_prompt_chars_saved": 0,
+    "prompt_dedup_blocks": 0,
+    "prompt_dedup_chars_saved": 0,
+    "requests_rejected_context": 0,
+    "conversation_resumes": 0,
+    "conversation_resume_failures": 0,
+    "selector_fallbacks": 0,
+    "selector_misses": 0,
+    "session_ok": 0,
+    "session_authenticated": None,
+    "session_last_check": None,
+    "session_last_ok": None,
+    "session_expires_in_s": None,
+    "session_refreshes": 0,
+    "session_keepalive_failures": 0,
+}
+
+# On-demand profilozás (POST /admin/profile): a következő N chat kérés cProfile-lal,
+# fázisonkénti Playwright protokoll-hívás számlálással és a fő tab Performance API
+# időzítéseivel fut; a riport a GET /admin/profile/report címről tölthető le.
+PROFILE_REMAINING = 0
+PROFILE_MAX_REQUESTS = 100
+PROFILE_ACTIVE = None  # az éppen profilozott kérés állapota
+PROFILE_REPORTS = deque(maxlen=20)
+PROFILE_TOP_FUNCTIONS = 30
+
+# A lap oldali mérés kezdete: long task figyelő (egyszer lapbetöltésenként) + kezdőidő
+PAGE_PERF_START_JS = """
+() => {
+    if (!window.__proxyPerf) {
+        window.__proxyPerf = { longTasks: [], start: 0 };
+        try {
+            new PerformanceObserver((list) => {
+                for (const e of list.getEntries()) window.__proxyPerf.longTasks.push([e.startTime, e.duration]);
+            }).observe({ type: 'longtask', buffered: true });
+        } catch (e) {
+            // a böngésző nem támogatja: long task adat nélkül
+        }
+    }
+    window.__proxyPerf.start = performance.now();
+}
+"""
+
+# A kezdet óta eltelt lap oldali idők összesítése (long taskok, hálózati erőforrások, heap)
+PAGE_PERF_REPORT_JS = """
+() => {
+    const perf = window.__proxyPerf || { longTasks: [], start: 0 };
+    const longTasks = perf.longTasks.filter(([start]) => start >= perf.start);
+    const resources = performance.getEntriesByType('resource').filter((e) => e.startTime >= perf.start);
+    const nav = performance.getEntriesByType('navigation')[0];
+    return {
+        window_ms: performance.now() - perf.start,
+        long_tasks: longTasks.length,
+        long_task_ms: longTasks.reduce((sum, [, duration]) => sum + duration, 0),
+        resources: resources.length,
+        resource_ms: resources.reduce((sum, e) => sum + e.duration, 0),
+        transfer_bytes: resources.reduce((sum, e) => sum + (e.transferSize || 0), 0),
+        navigation_load_ms: nav ? nav.loadEventEnd : null,
+        heap_bytes: performance.memory ? performance.memory.usedJSHeapSize : null,
+    };
+}
+"""
+
+
+# ==========================================
+# BÖNGÉSZŐ ÁLLAPOT, TAB POOL, SZELEKTOR REGISZTER
+# ==========================================
+# A driver ensure_browser_session-je tölti ki, a _close_browser_session törli
+PLAYWRIGHT_INSTANCE = None
+BROWSER_CONTEXT = None
+CHAT_PAGE = None  # a fő chat tab
+CHAT_URL = None  # az üres új chat URL-je (bind())
+
+# Extra tabok (hedge, párhuzamos generálás) – a fő CHAT_PAGE mellett ennyi nyitható
+MAX_EXTRA_TABS = 4
+TAB_POOL = []  # szabad (használt) extra tabok – használat előtt új chatre navigálunk
+
+# Hot-spare tabok: üres chatre előre betöltve, kész szövegmezővel várnak (háttérben töltjük)
+SPARE_TAB_TARGET = 1
+SPARE_LOAD_TIMEOUT_S = 120
+SPARE_TABS = []  # {"page": ..., "ready": bool, "since": időbélyeg}
+
+# Szelektor regiszter (bind()): kulcs -> jelöltek sorrendben (elsődleges, majd fallback /
+# nyelvi változatok). Tab inicializáláskor a probe_selectors() megjegyzi az első találatot;
+# addig (és a nem próbált kulcsoknál) a jelöltek CSS uniója megy, így bármelyik változat talál.
+SELECTOR_REGISTRY = {}
+SELECTOR_PROBE_KEYS = []  # egy üres chaten mindig látszó kulcsok
+RESOLVED_SELECTORS = {}  # kulcs -> a próbán talált jelölt
+# Késleltetési keret (ms, a lapon belül mérve) kulcsonként – a selector_replay.py ezt kéri számon
+SELECTOR_BUDGET_MS = {}
+GENERATION_STATE_BUDGET_MS = 50.0  # egy _poll_generation evaluate teljes körideje
+# DOM snapshotok (idle / generating / done) a selector_replay.py offline visszajátszásához
+# (--record-snapshots). Privát beszélgetést tartalmaznak: nem kerülnek a repóba.
+SNAPSHOT_DIR = None
+
+# A válasz DOM-jának markdownná alakítása a böngészőben, egyetlen evaluate hívással:
+# kódblokkok nyelvvel (```python), listák, táblázatok, idézetek, képletek. Az innerText
+# ezeket ellapítja (pl. elvész a kódblokk nyelve és határa), amin az Aider diff-jei elbuknak.
+DOM_TO_MARKDOWN_JS = r"""
+(root) => {
+    const SKIP = new Set(['BUTTON', 'SVG', 'STYLE', 'SCRIPT', 'NOSCRIPT', 'TEMPLATE', 'TEXTAREA']);
+    const codeBlocks = [];
+
+    const fenceFor = (text, ch) => {
+        let size = 3;
+        for (const run of text.match(new RegExp('\\' + ch + '+', 'g')) || []) {
+            size = Math.max(size, run.length + 1);
+        }
+        return ch.repeat(size);
+    };
+
+    const codeLanguage = (pre, code) => {
+        const classes = `${code ? code.className : ''} ${pre.className}`;
+        const match = classes.match(/language-([\w+#.-]+)/);
+        if (match) return match[1];
+        // Gemini: a nyelv a kódblokk fejlécében van (pl. "Python")
+        const block = pre.closest('code-block, .code-block');
+        const label = block && block.querySelector('.code-block-decoration span, .code-block-decoration');
+        return label ? (label.textContent.trim().split(/\s+/)[0] || '').toLowerCase() : '';
+    };
+
+    const inlineCode = (text) => {
+        const longest = Math.max(0, ...(text.match(/`+/g) || []).map((run) => run.length));
+        const fence = '`'.repeat(longest + 1);
+        const pad = text.startsWith('`') || text.endsWith('`') ? ' ' : '';
+        return fence + pad + text + pad + fence;
+    };
+
+    const indent = (text, first, rest) => text
+        .split('\n')
+        .map((line, i) => (i === 0 ? first : (line ? rest : '')) + line)
+        .join('\n');
+
+    const children = (node) => Array.from(node.childNodes).map(serialize).join('');
+
+    const list = (node, ordered) => {
+        let number = parseInt(node.getAttribute('start') || '1', 10);
+        const items = Array.from(node.children)
+            .filter((child) => child.tagName === 'LI')
+            .map((li) => {
+                const marker = ordered ? `${number++}. ` : '- ';
+                const content = children(li).replace(/^\n+|\s+$/g, '');
+                return indent(content, marker, ' '.repeat(marker.length));
+            });
+        const nested = node.parentElement && node.parentElement.tagName === 'LI';
+        return (nested ? '\n' : '\n\n') + items.join('\n') + '\n\n';
+    };
+
+    const table = (node) => {
+        const rows = Array.from(node.querySelectorAll('tr')).map((tr) =>
+            Array.from(tr.children)
+                .filter((cell) => cell.tagName === 'TH' || cell.tagName === 'TD')
+                .map((cell) => children(cell).trim().replace(/\s*\n\s*/g, ' ').replace(/\|/g, '\\|'))
+        );
+        if (!rows.length) return '';
+        const width = Math.max(...rows.map((row) => row.length));
+        const line = (row) => '| ' + Array.from({ length: width }, (_, i) => row[i] || '').join(' | ') + ' |';
+        const out = [line(rows[0]), line(Array(width).fill('---')), ...rows.slice(1).map(line)];
+        return '\n\n' + out.join('\n') + '\n\n';
+    };
+
+    const wrap = (node, mark) => {
+        const inner = children(node);
+        return inner.trim() ? mark + inner.trim() + mark : inner;
+    };
+
+    function serialize(node) {
+        if (node.nodeType === Node.TEXT_NODE) {
+            return node.nodeValue.replace(/\s+/g, ' ');
+        }
+        if (node.nodeType !== Node.ELEMENT_NODE) return '';
+
+        const tag = node.tagName.toUpperCase();
+        // A Gemini kódblokk fejléce (nyelv, másolás gomb) – a nyelvet a PRE-nél olvassuk ki
+        if (SKIP.has(tag) || node.classList.contains('code-block-decoration')) return '';
+
+        // KaTeX képlet: az eredeti TeX forrás az annotation elemben van
+        if (node.classList.contains('katex')) {
+            const tex = node.querySelector('annotation[encoding="application/x-tex"]');
+            if (!tex) return node.textContent;
+            return node.closest('.katex-display')
+                ? `\n\n$$\n${tex.textContent.trim()}\n$$\n\n`
+                : `$${tex.textContent.trim()}$`;
+        }
+
+        switch (tag) {
+            case 'H1': case 'H2': case 'H3': case 'H4': case 'H5': case 'H6':
+                return `\n\n${'#'.repeat(Number(tag[1]))} ${children(node).trim()}\n\n`;
+            case 'P':
+                return `\n\n${children(node).trim()}\n\n`;
+            case 'BR':
+                return '\n';
+            case 'HR':
+                return '\n\n---\n\n';
+            case 'STRONG': case 'B':
+                return wrap(node, '**');
+            case 'EM': case 'I':
+                return wrap(node, '*');
+            case 'DEL': case 'S':
+                return wrap(node, '~~');
+            case 'CODE':
+                return inlineCode(node.textContent);
+            case 'PRE': {
+                const code = node.querySelector('code');
+                const text = (code || node).textContent.replace(/\n$/, '');
+                const fence = fenceFor(text, '`');
+                // A kódblokk helyőrzőt kap, hogy a sortörés-tömörítés ne nyúljon bele
+                codeBlocks.push(`${fence}${codeLanguage(node, code)}\n${text}\n${fence}`);
+                return `\n\n\u0000${codeBlocks.length - 1}\u0000\n\n`;
+            }
+            case 'A': {
+                const text = children(node).trim();
+                const href = node.getAttribute('href');
+                if (!href || href.startsWith('#') || href === text) return text || href || '';
+                return `[${text}](${href})`;
+            }
+            case 'IMG':
+                return `![${node.getAttribute('alt') || ''}](${node.getAttribute('src') || ''})`;
+            case 'UL':
+                return list(node, false);
+            case 'OL':
+                return list(node, true);
+            case 'BLOCKQUOTE': {
+                const inner = children(node).trim().replace(/\n{3,}/g, '\n\n');
+                return '\n\n' + indent(inner, '> ', '> ').replace(/\n(?=\n)/g, '\n>') + '\n\n';
+            }
+            case 'TABLE':
+                return table(node);
+            default:
+                return children(node);
+        }
+    }
+
+    return serialize(root)
+        .replace(/[ \t]+\n/g, '\n')
+        .replace(/\n{3,}/g, '\n\n')
+        .trim()
+        // Kódblokkok vissza, a sor (lista / idézet) behúzásával
+        .replace(/^([ \t>]*)\u0000(\d+)\u0000/gm, (_, prefix, index) =>
+            indent(codeBlocks[Number(index)], prefix, prefix)
+        );
+}
+"""
+
+# Az utolsó (selector szerinti) válasz szövege egyetlen hívással: markdownként, vagy
+# MARKDOWN_EXTRACTION nélkül nyers innerText-ként. innerSelector: az utolsó válaszon belül
+# is az utolsó találat (egy gondolkodó modell válaszában több markdown blokk is lehet)
+LAST_RESPONSE_JS = """
+([selector, innerSelector, asMarkdown]) => {
+    const messages = document.querySelectorAll(selector);
+    if (!messages.length) return '';
+    const last = messages[messages.length - 1];
+    const inner = innerSelector ? last.querySelectorAll(innerSelector) : [];
+    const root = inner.length ? inner[inner.length - 1] : last;
+    return asMarkdown ? (__DOM_TO_MARKDOWN__)(root) : root.innerText;
+}
+""".replace("__DOM_TO_MARKDOWN__", DOM_TO_MARKDOWN_JS)
+MARKDOWN_EXTRACTION = True
+
+# A regiszter jelöltjeinek próbája egyetlen hívással: kulcsonként az első találó jelölt
+# indexe (-1: egyik sem) és a keresés ideje a lapon belül (ms)
+SELECTOR_PROBE_JS = """
+(registry) => {
+    const out = {};
+    for (const [key, candidates] of Object.entries(registry)) {
+        const started = performance.now();
+        let index = -1;
+        for (let i = 0; i < candidates.length && index < 0; i++) {
+            try {
+                if (document.querySelector(candidates[i])) index = i;
+            } catch (e) {
+                // érvénytelen szelektor: a következő jelölt jön
+            }
+        }
+        out[key] = { index, ms: performance.now() - started };
+    }
+    return out;
+}
+"""
+
+# A lap DOM-ja szkriptek / külső erőforrások nélkül (offline visszajátszható snapshot)
+SNAPSHOT_JS = """
+() => {
+    const root = document.documentElement.cloneNode(true);
+    root.querySelectorAll('script, noscript, iframe, link, object, embed').forEach((el) => el.remove());
+    return '<!DOCTYPE html>\\n' + root.outerHTML;
+}
+"""
+
+
+class GenerationError(Exception):
+    """Egy generálás nem indítható / olvasható ki; az üzenet a "HIBA: ..." szöveg."""
+
+
+# ==========================================
+# GENERÁLÁS (A DRIVER DOM-HOOKJAIVAL)
+# ==========================================
+
+def run_with_playwright(prompt: str, should_cancel=None, limits=None, system=None, **options):
+    """
+    Kiküldi a promptot a bekötött driver web UI-jának a fő tabon (CHAT_PAGE),
+    és egy meglévő, globális munkamenetet használ.
+    A `should_cancel()` callback True-ja esetén (kliens lecsatlakozott) a generálást
+    leállítja, és CANCELLED_RESPONSE-t ad vissza a munkamenet lezárása nélkül.
+    A `limits` (_parse_generation_limits) elérésekor a generálást a böngészőben
+    leállítja, és a csonkolt választ adja vissza; a kliens timeoutjának elérésekor
+    DEADLINE_RESPONSE-t.
+    A `system` (PIN_SYSTEM_PROMPT) csak akkor kerül a prompt elé, ha ebben a chatben
+    még nem ment el (_apply_pinned_system).
+    Az `options` a driver _start_generation-jének backend-specifikus argumentumai
+    (ChatGPT: model, Gemini: tools), lásd _request_options.
+    Visszatérés: (válasz szöveg, finish_reason); hibánál finish_reason None.
+    """
+    with _profile_phase("session"):
+        error = BACKEND.ensure_browser_session()
+    if error:
+        return error, None
+
+    try:
+        with _profile_phase("send"):
+            job = BACKEND._start_generation(CHAT_PAGE, prompt, limits=limits, system=system, **options)
+        with _profile_phase("wait"):
+            status, finish_reason = _wait_for_generation(job, should_cancel)
+        with _profile_phase("extract"):
+            return BACKEND._finish_generation(job, status, finish_reason)
+    except GenerationError as e:
+        return str(e), None
+    except Exception as e:
+        print(f"HIBA a folyamat közben ({BACKEND.BACKEND_LABEL}): {e}. Munkamenet lezárva.")
+        _close_browser_session()
+        return (
+            f"HIBA: A Playwright nem tudta elküldeni a kérést ({BACKEND.BACKEND_LABEL}). "
+            f"Hiba: {e}"
+        ), None
+
+
+def _wait_for_generation(job, should_cancel=None):
+    """
+    Rövid pollozással várja a generálás végét egyetlen nagy wait_for_selector helyett,
+    hogy közben észrevegyük, ha a kliens bontotta a kapcsolatot, vagy ha a növekvő
+    válasz elérte a kért max_tokens / stop korlátot, illetve a kliens timeoutját.
+    Visszatérés: (status, finish_reason),
+    status: "done" | "limit" | "deadline" (kliens timeout) | "cancelled" | "timeout".
+    """
+    while True:
+        status, finish_reason = BACKEND._poll_generation(job)
+        if status != "running":
+            return status, finish_reason
+        if should_cancel is not None and should_cancel():
+            return "cancelled", None
+        job["page"].wait_for_timeout(POLL_INTERVAL_MS)
+
+
+def _cancel_generation(job, hedge_loss=False):
+    """
+    Leállít egy futó jobot, a metrikákat frissíti. A kliens bontása a requests_cancelled,
+    egy vesztes / feleslegessé vált hedge ág (hedge_loss) a hedge_losses számlálóba kerül.
+    """
+    BACKEND._stop_generation(job["page"])
+    elapsed = time.time() - job["started_at"]
+    if hedge_loss:
+        _metric_add("hedge_losses")
+        _metric_add("hedge_loss_seconds_total", elapsed)
+    else:
+        _metric_add("requests_cancelled")
+        _metric_add("cancelled_generation_seconds_total", elapsed)
+
+
+def _deadline_generation(job):
+    """
+    A kliens timeoutja (soft deadline) előtt be nem fejeződött job leállítása: külön
+    metrika és DEADLINE_RESPONSE, nem "length" – a válasz nem a max_tokens miatt rövid.
+    """
+    BACKEND._stop_generation(job["page"])
+    elapsed = time.time() - job["started_at"]
+    _metric_add("requests_deadline")
+    _metric_add("generation_seconds_total", elapsed)
+    print(f"FIGYELEM: a generálás {elapsed:.1f} mp alatt nem fejeződött be – a kliens timeoutja előtt leállítva.")
+    return DEADLINE_RESPONSE, None
+
+
+# ==========================================
+# MUNKAMENET LEZÁRÁSA
+# ==========================================
+
+def _close_browser_session():
+    """Lezárja a böngészőt és a Playwrightot (hiba után), a globális állapotot törli."""
+    global PLAYWRIGHT_INSTANCE, BROWSER_CONTEXT, CHAT_PAGE
+
+    try:
+        if BROWSER_CONTEXT:
+            BROWSER_CONTEXT.close()
+        if PLAYWRIGHT_INSTANCE:
+            PLAYWRIGHT_INSTANCE.stop()
+    except Exception:
+        pass
+
+    CHAT_PAGE = None
+    BROWSER_CONTEXT = None
+    PLAYWRIGHT_INSTANCE = None
+    TAB_POOL.clear()
+    SPARE_TABS.clear()
+    PINNED_SYSTEM.clear()
+
+
+def shutdown_playwright():
+    """
+    Lefut, amikor a Flask szerver leáll (pl. CTRL+C, a router SIGTERM-je).
+    """
+    if BROWSER_CONTEXT:
+        print(f"\n🤖 Lezárás: Playwright böngésző bezárása ({BACKEND.BACKEND_LABEL} munkamenet vége)...")
+        try:
+            BROWSER_CONTEXT.close()
+        except Exception as e:
+            print(f"Lezárási hiba: {e}")
+
+    if PLAYWRIGHT_INSTANCE:
+        try:
+            PLAYWRIGHT_INSTANCE.stop()
+        except Exception as e:
+            print(f"Playwright stop hiba: {e}")
+
+
+# ==========================================
+# SZELEKTOR REGISZTER (FALLBACK, PRÓBA, SNAPSHOT)
+# ==========================================
+
+def _sel(key):
+    """A próbán talált jelölt, különben a regiszter összes jelöltje CSS unióként."""
+    return RESOLVED_SELECTORS.get(key) or ", ".join(SELECTOR_REGISTRY[key])
+
+
+def probe_selectors(page, keys=None):
+    """
+    Tab inicializáláskor egyetlen evaluate-tel végigpróbálja a regiszter jelöltjeit
+    (sorrendben), és megjegyzi az első találatot. Ha csak fallback vagy semmi sem talál,
+    azt azonnal jelezzük (szelektor-drift), nem a nagy timeoutok lejártakor.
+    Visszatérés: {kulcs: {"index": int, "ms": float}} (index -1: nincs találat).
+    """
+    keys = keys or SELECTOR_PROBE_KEYS
+    try:
+        result = page.evaluate(SELECTOR_PROBE_JS, {key: SELECTOR_REGISTRY[key] for key in keys})
+    except Exception as e:
+        print(f"HIBA a szelektorok próbájakor: {e}")
+        return {}
+
+    for key, hit in result.items():
+        candidates = SELECTOR_REGISTRY[key]
+        if hit["index"] < 0:
+            RESOLVED_SELECTORS.pop(key, None)
+            _metric_add("selector_misses")
+            print(f"FIGYELEM: a(z) '{key}' szelektor egyik jelöltje sem talál: {candidates}")
+            continue
+        RESOLVED_SELECTORS[key] = candidates[hit["index"]]
+        if hit["index"] > 0:
+            _metric_add("selector_fallbacks")
+            print(f"FIGYELEM: '{key}': az elsődleges szelektor elavult, fallback: {candidates[hit['index']]}")
+        if hit["ms"] > SELECTOR_BUDGET_MS[key]:
+            print(f"FIGYELEM: '{key}' keresése {hit['ms']:.1f} ms (keret: {SELECTOR_BUDGET_MS[key]} ms)")
+    return result
+
+
+def _record_snapshot(page, state, wait_for=None, baseline=None):
+    """
+    SNAPSHOT_DIR megadásakor a lap DOM-ját <state>.html néven menti (offline replay).
+    `wait_for`: előbb ennek a szelektor-kulcsnak a megjelenését várjuk meg, hogy a
+    snapshot tényleg az adott állapotot mutassa.
+    `baseline`: a küldés előtti állapot (pl. {"initial_response_count": 2}), a mellé írt
+    <state>.json metaadatba kerül; a selector_replay.py ezzel hívja a kész-detektálást.
+    """
+    if SNAPSHOT_DIR is None:
+        return
+    try:
+        if wait_for is not None:
+            page.wait_for_selector(_sel(wait_for), timeout=10_000)
+        SNAPSHOT_DIR.mkdir(parents=True, exist_ok=True)
+        (SNAPSHOT_DIR / f"{state}.html").write_text(page.evaluate(SNAPSHOT_JS), encoding="utf-8")
+        if baseline is not None:
+            meta = {"state": state, "synthetic": False, "captured": time.time(), **baseline}
+            (SNAPSHOT_DIR / f"{state}.json").write_text(json.dumps(meta, indent=2), encoding="utf-8")
+        print(f"DOM snapshot mentve: {SNAPSHOT_DIR / f'{state}.html'}")
+    except Exception as e:
+        print(f"HIBA a DOM snapshot mentésekor: {e}")
+
+
+# ==========================================
+# TAB POOL (EXTRA TABOK PÁRHUZAMOS GENERÁLÁSHOZ)
+# ==========================================
+
+def _open_new_chat(page):
+    """
+    Friss (üres) chatet nyit az adott tabon; ha a tab már egy üres új chaten áll,
+    nem navigál. False, ha nem sikerült.
+    """
+    try:
+        if page.url.rstrip("/") == CHAT_URL.rstrip("/") and page.locator(_sel("response")).count() == 0:
+            return True
+        page.goto(CHAT_URL)
+        page.wait_for_selector(_sel("composer"), timeout=60_000)
+    except Exception as e:
+        print(f"HIBA az új chat megnyitásakor: {e}")
+        return False
+    return True
+
+
+def _open_main_chat():
+    """
+    Friss (üres) chat a fő tabon. Ha a fő tab már üres chaten áll, nem navigálunk; különben
+    egy kész hot-spare tab lesz a fő tab (navigáció nélkül, a régi fő tab a poolba kerül),
+    és csak ha nincs kész spare, navigál a fő tab. False, ha nem sikerült.
+    """
+    global CHAT_PAGE
+
+    page = CHAT_PAGE
+    try:
+        if page.url.rstrip("/") == CHAT_URL.rstrip("/") and page.locator(_sel("response")).count() == 0:
+            return True
+    except Exception as e:
+        print(f"HIBA a fő tab állapotának olvasásakor: {e}")
+
+    spare = next((t for t in SPARE_TABS if t["ready"] and not t["page"].is_closed()), None)
+    if spare is None:
+        _metric_add("spare_tab_misses")
+        return _open_new_chat(page)
+
+    SPARE_TABS.remove(spare)
+    CHAT_PAGE = spare["page"]
+    _release_tab(page)
+    _metric_add("spare_tab_hits")
+    try:
+        # A háttérben lévő tab időzítőit a böngésző fojtja: a fő tab legyen elöl
+        CHAT_PAGE.bring_to_front()
+    except Exception as e:
+        print(f"FIGYELEM: a spare tab nem hozható előre: {e}")
+    print("Új chat a fő tabon: a hot-spare tabot vettük át.")
+    return True
+
+
+def _new_tab():
+    """Új extra tab (a driver tabonkénti cache-ébe felvéve), vagy None a MAX_EXTRA_TABS korlátnál."""
+    if len(BROWSER_CONTEXT.pages) - 1 >= MAX_EXTRA_TABS:
+        return None
+    page = BROWSER_CONTEXT.new_page()
+    BACKEND.register_tab(page)
+    return page
+
+
+def _acquire_tab():
+    """
+    Szabad extra tab egy friss (üres) chattel. Elsőként a háttérben előre betöltött
+    hot-spare tabot adja (nincs navigáció a kérés útján); ha nincs, a poolból vagy
+    egy új tabból navigál. None, ha elértük a MAX_EXTRA_TABS korlátot.
+    """
+    if SPARE_TABS:
+        # A kész spare tabot részesítjük előnyben, különben a legrégebben töltődőt
+        spare = next((t for t in SPARE_TABS if t["ready"]), SPARE_TABS[0])
+        SPARE_TABS.remove(spare)
+        page = spare["page"]
+        try:
+            page.wait_for_selector(_sel("composer"), timeout=60_000)
+            _metric_add("spare_tab_hits")
+            return page
+        except Exception as e:
+            print(f"HIBA: a spare tab nem töltődött be: {e}")
+            _discard_tab(page)
+
+    _metric_add("spare_tab_misses")
+    page = TAB_POOL.pop() if TAB_POOL else _new_tab()
+    if page is None:
+        return None
+
+    if not _open_new_chat(page):
+        _discard_tab(page)
+        return None
+    return page
+
+
+def _release_tab(page):
+    """Visszateszi az extra tabot a poolba (a következő használat új chatet nyit)."""
+    if not page.is_closed():
+        TAB_POOL.append(page)
+
+
+def _discard_tab(page):
+    """Hibás extra tab bezárása – a fő munkamenetet nem érinti."""
+    PINNED_SYSTEM.pop(page, None)
+    try:
+        page.close()
+    except Exception:
+        pass
+
+
+def _refill_spare_tabs():
+    """
+    Feltölti a hot-spare tabokat SPARE_TAB_TARGET darabra: a használt (pool) tabokat
+    vagy új tabokat egy üres chatre navigál (csak "commit"-ig vár, nem blokkol),
+    a töltődőket pedig késznek jelöli, ha megjelent a szövegmező (a driver ekkor
+    előkészítheti, pl. a Gemini az alapértelmezett eszközöket állítja be).
+    """
+    now = time.time()
+    for spare in list(SPARE_TABS):
+        page = spare["page"]
+        if page.is_closed():
+            SPARE_TABS.remove(spare)
+        elif not spare["ready"]:
+            spare["ready"] = page.query_selector(_sel("composer")) is not None
+            if spare["ready"]:
+                BACKEND._prepare_spare_tab(page)
+            elif now - spare["since"] > SPARE_LOAD_TIMEOUT_S:
+                print("FIGYELEM: spare tab nem töltődött be időben, eldobjuk.")
+                SPARE_TABS.remove(spare)
+                _discard_tab(page)
+
+    while len(SPARE_TABS) < SPARE_TAB_TARGET:
+        page = TAB_POOL.pop() if TAB_POOL else _new_tab()
+        if page is None:
+            break
+
+        try:
+            page.goto(CHAT_URL, wait_until="commit")
+        except Exception as e:
+            print(f"HIBA a spare tab navigálásakor: {e}")
+            _discard_tab(page)
+            break
+        SPARE_TABS.append({"page": page, "ready": False, "since": now})
+
+
+# ==========================================
+# SESSION KEEP-ALIVE
+# ==========================================
+
+def _keepalive_session():
+    """
+    KEEPALIVE_INTERVAL_S időnként, tétlen időben ellenőrzi és frissen tartja a
+    bejelentkezett sessiont, hogy idle után az első kérés ne fusson bele egy
+    Cloudflare / auth kihívásba vagy a lassú inicializálásba:
+    - a driver session ellenőrzése a lapból (_check_session: él-e, mikor jár le),
+    - a szövegmező (composer) jelenlétének ellenőrzése,
+    - lejárt / hamarosan lejáró sessionnél, vagy hiányzó composernél reload
+      (ez frissíti a session cookie-kat, ChatGPT-nél a Cloudflare cf_clearance-t is).
+    Az eredmény a /metrics session_* mezőiben látszik.
+    """
+    global LAST_KEEPALIVE, LAST_SESSION_REFRESH
+
+    now = time.time()
+    if now - LAST_KEEPALIVE < KEEPALIVE_INTERVAL_S:
+        return
+    LAST_KEEPALIVE = now
+    METRICS["session_last_check"] = now
+
+    page = CHAT_PAGE
+    state, expires_in = BACKEND._check_session(now)
+    composer_ok = page.query_selector(_sel("composer")) is not None
+    METRICS["session_expires_in_s"] = expires_in
+    METRICS["session_authenticated"] = state["authenticated"]
+
+    needs_refresh = (
+        not state["authenticated"]
+        or not composer_ok
+        or (expires_in is not None and expires_in < BACKEND.SESSION_REFRESH_MARGIN_S)
+    )
+    if needs_refresh:
+        print(
+            f"Session keep-alive: frissítés (auth: {state['authenticated']}, "
+            f"ellenőrzés: {state['status']}, composer: {composer_ok}, lejárat: {expires_in})..."
+        )
+        _metric_add("session_refreshes")
+        page.reload()
+        try:
+            page.wait_for_selector(_sel("composer"), timeout=60_000)
+            composer_ok = True
+            probe_selectors(page)
+        except Exception as e:
+            print(f"FIGYELEM: a session frissítés után sincs szövegmező: {e}")
+            composer_ok = False
+        LAST_SESSION_REFRESH = time.time()
+
+    if composer_ok:
+        METRICS["session_ok"] = 1
+        METRICS["session_last_ok"] = time.time()
+    else:
+        METRICS["session_ok"] = 0
+        _metric_add("session_keepalive_failures")
+        print("HIBA: Session keep-alive sikertelen – valószínűleg frissíteni kell a cookie-kat.")
+
+
+# ==========================================
+# HÁTTÉRFELADATOK (A SZERVER SZÁLÁN, KÉRÉSEK KÖZÖTT)
+# ==========================================
+
+def _run_background_tasks():
+    """
+    A werkzeug szerver minden kiszolgálási ciklusában (~0.5 mp) meghívja, ugyanazon
+    a szálon, mint a kéréseket – a sync Playwright objektumok így biztonságosan
+    használhatók. Csak tétlen időben fut, a kérések útját nem lassítja.
+    """
+    global LAST_BACKGROUND_RUN, LAST_WARM_START
+
+    now = time.time()
+    if now - LAST_BACKGROUND_RUN < BACKGROUND_INTERVAL_S:
+        return
+    LAST_BACKGROUND_RUN = now
+
+    if CHAT_PAGE is None:
+        # Meleg indítás: a lassú (akár 600 mp-es) inicializálás ne az első kérésre essen.
+        # Sikertelen init után csak KEEPALIVE_INTERVAL_S múlva próbáljuk újra.
+        if not WARM_START or now - LAST_WARM_START < KEEPALIVE_INTERVAL_S:
+            return
+        LAST_WARM_START = now
+        error = BACKEND.ensure_browser_session()
+        if error:
+            print(f"Meleg indítás sikertelen: {error}")
+            METRICS["session_ok"] = 0
+        return
+
+    try:
+        _keepalive_session()
+        _refill_spare_tabs()
+    except Exception as e:
+        print(f"HIBA a háttérfeladatokban: {e}")
+
+
+# ==========================================
+# HEDGE KÉRÉSEK (TAIL LATENCY)
+# ==========================================
+
+def _hedge_delay():
+    """
+    Mennyi idő után induljon a második (hedge) generálás: a sikeres generálások
+    p95 ideje, amíg nincs elég minta (vagy HEDGE_AFTER_P95 ki van kapcsolva) azonnal.
+    """
+    if not HEDGE_AFTER_P95 or len(LATENCY_SAMPLES) < HEDGE_MIN_SAMPLES:
+        return 0.0
+    ordered = sorted(LATENCY_SAMPLES)
+    return ordered[int(0.95 * (len(ordered) - 1))]
+
+
+class _PeerGeneration:
+    """
+    Hedge-kérés egy másik proxy példánynak (pl. a ChatGPT mellé a Gemini szervernek) háttérszálon.
+    A cancel() lezárja a socketet, amit a peer kliens-lecsatlakozásként érzékel.
+    """
+
+    def __init__(self, url, body):
+        self.result = None
+        self.error = None
+        self.done = threading.Event()
+        self._conn = None
+        threading.Thread(target=self._run, args=(url, body), daemon=True).start()
+
+    def _run(self, url, body):
+        try:
+            parts = urllib.parse.urlsplit(url)
+            conn = http.client.HTTPConnection(parts.hostname, parts.port or 80)
+            self._conn = conn
+            conn.request(
+                "POST",
+                parts.path or "/v1/chat/completions",
+                body=json.dumps(body),
+                headers={"Content-Type": "application/json"},
+            )
+            resp = conn.getresponse()
+            payload = json.loads(resp.read() or b"{}")
+            if resp.status != 200:
+                self.error = f"HIBA: Hedge peer válasz {resp.status}: {payload}"
+            else:
+                choice = payload["choices"][0]
+                self.result = (
+                    choice["message"]["content"],
+                    choice.get("finish_reason") or "stop",
+                )
+        except Exception as e:
+            self.error = f"HIBA: Hedge peer hiba: {e}"
+        finally:
+            self.done.set()
+
+    def cancel(self):
+        conn = self._conn
+        if conn is not None and conn.sock is not None:
+            try:
+                conn.sock.shutdown(socket.SHUT_RDWR)
+            except OSError:
+                pass
+
+
+def _start_hedge(prompt, limits, system=None, **options):
+    """A második (hedge) generálás indítása: peer proxy, vagy egy extra tab."""
+    if HEDGE_PEER_URL:
+        print(f"Hedge indítása a peer proxyn: {HEDGE_PEER_URL}")
+        content = _with_system(system, prompt)
+        body = {"model": BACKEND.HEDGE_PEER_MODEL, "messages": [{"role": "user", "content": content}]}
+        if limits:
+            if limits["max_tokens"] is not None:
+                body["max_tokens"] = limits["max_tokens"]
+            if limits["stop"]:
+                body["stop"] = limits["stop"]
+            if limits["timeout"]:
+                body["timeout"] = limits["timeout"]
+        return _PeerGeneration(HEDGE_PEER_URL, body)
+
+    page = _acquire_tab()
+    if page is None:
+        print("Hedge kihagyva: nincs szabad extra tab.")
+        return None
+    print("Hedge indítása egy második tabon...")
+    try:
+        return BACKEND._start_generation(page, prompt, limits=limits, system=system, **options)
+    except Exception as e:
+        print(f"HIBA a hedge indításakor: {e}")
+        _discard_tab(page)
+        return None
+
+
+def run_hedged(prompt: str, should_cancel=None, limits=None, system=None, **options):
+    """
+    Ugyanazt a promptot a fő tabon és (_hedge_delay() után) egy második tabon vagy
+    a peer proxyn is elindítja; a hamarabb kész választ adja vissza, a vesztest leállítja.
+    A vesztes ág a hedge_losses metrikába számít, nem a kliens-megszakítások közé.
+    Visszatérés: (válasz szöveg, finish_reason), mint a run_with_playwright-nál.
+    """
+    error = BACKEND.ensure_browser_session()
+    if error:
+        return error, None
+
+    try:
+        primary = BACKEND._start_generation(CHAT_PAGE, prompt, limits=limits, system=system, **options)
+    except GenerationError as e:
+        return str(e), None
+    except Exception as e:
+        print(f"HIBA a folyamat közben ({BACKEND.BACKEND_LABEL}): {e}. Munkamenet lezárva.")
+        _close_browser_session()
+        return f"HIBA: A Playwright nem tudta elküldeni a kérést ({BACKEND.BACKEND_LABEL}). Hiba: {e}", None
+
+    hedge_at = primary["started_at"] + _hedge_delay()
+    secondary = None  # None: még nem indult, False: nem indítható / elbukott
+
+    try:
+        while True:
+            status, finish_reason = BACKEND._poll_generation(primary)
+            if status != "running":
+                if secondary:
+                    _cancel_hedge(secondary)
+                return BACKEND._finish_generation(primary, status, finish_reason)
+
+            if secondary is None and time.time() >= hedge_at:
+                secondary = _start_hedge(prompt, limits, system, **options) or False
+                if secondary:
+                    _metric_add("hedges_started")
+
+            if isinstance(secondary, _PeerGeneration) and secondary.done.is_set():
+                if secondary.result:
+                    print("Hedge nyert (peer proxy), a fő generálás leállítva.")
+                    _metric_add("hedge_wins")
+                    _cancel_generation(primary, hedge_loss=True)
+                    return secondary.result
+                print(f"Hedge peer elbukott: {secondary.error}")
+                secondary = False
+            elif isinstance(secondary, dict):
+                try:
+                    hedge_status, hedge_reason = BACKEND._poll_generation(secondary)
+                except Exception as e:
+                    # Az összeomlott hedge tab csak magát buktatja el, a fő generálás fut tovább
+                    print(f"HIBA a hedge tab figyelésekor: {e}")
+                    _discard_tab(secondary["page"])
+                    hedge_status, secondary = "failed", False
+                if hedge_status in ("done", "limit"):
+                    print("Hedge nyert (második tab), a fő generálás leállítva.")
+                    _metric_add("hedge_wins")
+                    _cancel_generation(primary, hedge_loss=True)
+                    try:
+                        return BACKEND._finish_generation(secondary, hedge_status, hedge_reason)
+                    finally:
+                        _release_tab(secondary["page"])
+                if hedge_status in ("timeout", "deadline"):
+                    _cancel_hedge(secondary)
+                    secondary = False
+
+            if should_cancel is not None and should_cancel():
+                if secondary:
+                    _cancel_hedge(secondary)
+                return BACKEND._finish_generation(primary, "cancelled", None)
+
+            CHAT_PAGE.wait_for_timeout(POLL_INTERVAL_MS)
+    except GenerationError as e:
+        return str(e), None
+    except Exception as e:
+        print(f"HIBA a folyamat közben ({BACKEND.BACKEND_LABEL} hedge): {e}. Munkamenet lezárva.")
+        _close_browser_session()
+        return f"HIBA: A Playwright nem tudta elküldeni a kérést ({BACKEND.BACKEND_LABEL}). Hiba: {e}", None
+
+
+def _cancel_hedge(secondary):
+    """A vesztes hedge leállítása (peer: socket zárás, tab: stop gomb + vissza a poolba)."""
+    if isinstance(secondary, _PeerGeneration):
+        secondary.cancel()
+        _metric_add("hedge_losses")
+        return
+    try:
+        _cancel_generation(secondary, hedge_loss=True)
+    except Exception as e:
+        print(f"HIBA a hedge leállításakor: {e}")
+        _discard_tab(secondary["page"])
+        return
+    _release_tab(secondary["page"])
+
+
+# ==========================================
+# PÁRHUZAMOS GENERÁLÁS (n > 1, batch)
+# ==========================================
+
+def run_many(items, should_cancel=None, on_result=None, use_main_tab=True):
+    """
+    Több generálást futtat párhuzamosan: a fő tabon (use_main_tab) és az extra
+    tabokon egyszerre, a szabaddá váló tabokon a következő elemmel folytatva.
+    `items`: {"prompt", "limits", "system", ...} kulcsú dict-ek (akár lusta iterátor is);
+    a további kulcsok a driver _start_generation-jének opciói (ChatGPT: model, Gemini: tools).
+    `on_result(index, text, finish_reason)` minden elkészült elemnél meghívódik.
+    Visszatérés: [(válasz szöveg, finish_reason), ...] az elemek sorrendjében
+    (megszakításnál a még el nem indított elemek kimaradnak).
+    """
+    results = {}
+
+    def deliver(index, result):
+        results[index] = result
+        if on_result is not None:
+            on_result(index, *result)
+
+    pending = enumerate(items)
+    error = BACKEND.ensure_browser_session()
+    if error:
+        for index, _ in pending:
+            deliver(index, (error, None))
+        return [results[i] for i in sorted(results)]
+
+    running = []  # (index, job)
+    main_free = use_main_tab
+    next_entry = None
+    exhausted = False
+
+    while True:
+        # -------- Indítás minden szabad tabon --------
+        while not exhausted:
+            if next_entry is None:
+                next_entry = next(pending, None)
+                if next_entry is None:
+                    exhausted = True
+                    break
+
+            # A fő tab is minden elemnél friss chatet kap (mint a pool tabok az _acquire_tab-ban),
+            # különben a független promptok egymás kontextusává válnának egy egyre növő szálban.
+            # Kész hot-spare tab esetén az veszi át a fő tab szerepét (nincs navigáció).
+            if main_free and _open_main_chat():
+                page = CHAT_PAGE
+            else:
+                main_free = False
+                page = _acquire_tab()
+                if page is None:
+                    break
+
+            index, item = next_entry
+            next_entry = None
+            options = {key: value for key, value in item.items() if key not in ("prompt", "limits", "system")}
+            try:
+                job = BACKEND._start_generation(
+                    page, item["prompt"], limits=item.get("limits"), system=item.get("system"), **options
+                )
+            except Exception as e:
+                print(f"HIBA a(z) {index}. generálás indításakor: {e}")
+                deliver(index, (f"HIBA: A generálás nem indult el. Hiba: {e}", None))
+                if page is not CHAT_PAGE:
+                    _discard_tab(page)
+                continue
+
+            if page is CHAT_PAGE:
+                main_free = False
+            running.append((index, job))
+
+        if not running:
+            if exhausted:
+                break
+            # Egy tab sem szabad és nem is nyitható: a maradék nem futtatható
+            for index, _ in ([next_entry] if next_entry else []) + list(pending):
+                deliver(index, ("HIBA: Nincs szabad tab a generáláshoz.", None))
+            break
+
+        # -------- Futó jobok pollozása --------
+        for index, job in list(running):
+            page = job["page"]
+            try:
+                status, finish_reason = BACKEND._poll_generation(job)
+            except Exception as e:
+                # Egy összeomlott tab csak a saját jobját buktatja el, a többi fut tovább
+                print(f"HIBA a(z) {index}. generálás pollozásakor: {e}")
+                running.remove((index, job))
+                deliver(index, (f"HIBA: A generálás állapota nem olvasható. Hiba: {e}", None))
+                if page is CHAT_PAGE:
+                    main_free = True
+                else:
+                    _discard_tab(page)
+                continue
+            if status == "running":
+                continue
+
+            running.remove((index, job))
+            try:
+                deliver(index, BACKEND._finish_generation(job, status, finish_reason))
+            except Exception as e:
+                print(f"HIBA a(z) {index}. generálás lezárásakor: {e}")
+                deliver(index, (f"HIBA: A generálás kiolvasása sikertelen. Hiba: {e}", None))
+                if page is not CHAT_PAGE:
+                    _discard_tab(page)
+                    continue
+
+            if page is CHAT_PAGE:
+                main_free = True
+            else:
+                _release_tab(page)
+
+        if should_cancel is not None and should_cancel():
+            for index, job in running:
+                try:
+                    deliver(index, BACKEND._finish_generation(job, "cancelled", None))
+                except Exception as e:
+                    print(f"HIBA a(z) {index}. generálás leállításakor: {e}")
+                    deliver(index, (CANCELLED_RESPONSE, None))
+                if job["page"] is not CHAT_PAGE:
+                    _release_tab(job["page"])
+            break
+
+        if running:
+            try:
+                running[0][1]["page"].wait_for_timeout(POLL_INTERVAL_MS)
+            except Exception:
+                # A várakozó tab közben bezárult: a következő kör pollozása kezeli
+                time.sleep(POLL_INTERVAL_MS / 1000)
+
+    return [results[i] for i in sorted(results)]
+
+
+# ==========================================
+# BESZÉLGETÉS INDEX (SQLITE)
+# ==========================================
+
+def _conversation_index():
+    """A beszélgetés index kapcsolata (első híváskor megnyitja / létrehozza)."""
+    global CONVERSATION_INDEX
+
+    if CONVERSATION_INDEX is None:
+        # A router workerei ugyanazt a fájlt használhatják: rövid zárolási várakozás
+        CONVERSATION_INDEX = sqlite3.connect(str(CONVERSATION_DB), timeout=10)
+        CONVERSATION_INDEX.execute(
+            """CREATE TABLE IF NOT EXISTS conversations (
+                backend TEXT NOT NULL,
+                account TEXT NOT NULL,
+                fingerprint TEXT NOT NULL,
+                url TEXT NOT NULL,
+                updated REAL NOT NULL,
+                PRIMARY KEY (backend, account, fingerprint)
+            )"""
+        )
+        CONVERSATION_INDEX.commit()
+    return CONVERSATION_INDEX
+
+
+def _message_fingerprints(messages):
+    """Láncolt SHA-256 ujjlenyomat minden messages[:i + 1] prefixre."""
+    fingerprints = []
+    digest = ""
+    for msg in messages:
+        text = _extract_text_from_content(msg.get("content", ""))
+        key = f"{digest}\x00{msg.get('role', 'user')}\x00{text}"
+        digest = hashlib.sha256(key.encode("utf-8")).hexdigest()
+        fingerprints.append(digest)
+    return fingerprints
+
+
+def _find_conversation(messages):
+    """
+    A leghosszabb indexelt prefix beszélgetése.
+    Visszatérés: (url, a szálban még nem szereplő üzenetek), vagy (None, messages).
+    """
+    # Az utolsó üzenet mindig új; a túl hosszú előzményből csak a végét nézzük
+    fingerprints = _message_fingerprints(messages)[:-1][-500:]
+    offset = max(0, len(messages) - 1 - len(fingerprints))
+    if not fingerprints:
+        return None, messages
+
+    placeholders = ", ".join("?" * len(fingerprints))
+    rows = _conversation_index().execute(
+        "SELECT fingerprint, url FROM conversations "
+        f"WHERE backend = ? AND account = ? AND fingerprint IN ({placeholders})",
+        [BACKEND.CONVERSATION_BACKEND, ACCOUNT_ID, *fingerprints],
+    ).fetchall()
+    found = dict(rows)
+
+    for index in range(len(fingerprints) - 1, -1, -1):
+        url = found.get(fingerprints[index])
+        if url:
+            return url, messages[offset + index + 1:]
+    return None, messages
+
+
+def _open_conversation(url):
+    """
+    A fő tabon megnyitja az indexelt beszélgetést. False, ha nem sikerült; ha a szál
+    már nem létezik, az indexből is töröljük.
+    """
+    error = BACKEND.ensure_browser_session()
+    if error:
+        return False
+    page = CHAT_PAGE
+    try:
+        if page.url.rstrip("/") != url.rstrip("/"):
+            print(f"Beszélgetés megnyitása az indexből: {url}")
+            page.goto(url)
+        page.wait_for_selector(_sel("composer"), timeout=60_000)
+    except Exception as e:
+        print(f"HIBA a beszélgetés megnyitásakor: {e}")
+        return False
+    # Törölt / más fiókhoz tartozó szálnál a web UI a kezdőlapra irányít
+    if page.url.rstrip("/") != url.rstrip("/"):
+        print(f"A beszélgetés már nem elérhető, töröljük az indexből: {url}")
+        _forget_conversation(url)
+        return False
+    return True
+
+
+def _forget_conversation(url):
+    index = _conversation_index()
+    index.execute(
+        "DELETE FROM conversations WHERE backend = ? AND account = ? AND url = ?",
+        (BACKEND.CONVERSATION_BACKEND, ACCOUNT_ID, url),
+    )
+    index.commit()
+
+
+def _record_conversation(messages, answer):
+    """A kérés + válasz ujjlenyomatát a fő tab jelenlegi beszélgetés URL-jéhez köti."""
+    url = CHAT_PAGE.url if CHAT_PAGE is not None else ""
+    if not BACKEND.CONVERSATION_URL_RE.search(url):
+        return
+
+    fingerprint = _message_fingerprints(messages + [{"role": "assistant", "content": answer}])[-1]
+    now = time.time()
+    index = _conversation_index()
+    index.execute(
+        "INSERT OR REPLACE INTO conversations (backend, account, fingerprint, url, updated) "
+        "VALUES (?, ?, ?, ?, ?)",
+        (BACKEND.CONVERSATION_BACKEND, ACCOUNT_ID, fingerprint, url, now),
+    )
+    index.execute("DELETE FROM conversations WHERE updated < ?", (now - CONVERSATION_TTL_S,))
+    index.commit()
+
+
+# ==========================================
+# TOKENIZÁLÁS (usage, kontextus-korlát)
+# ==========================================
+
+def _get_token_encoder():
+    """
+    A tiktoken kódoló (egyszer töltjük be), vagy None, ha nem elérhető. Az első betöltés
+    a kódolást letöltheti: induláskor hívjuk, hogy hálózati hiba ne az első kérést akassza.
+    """
+    global TOKEN_ENCODER
+
+    if TOKEN_ENCODER is None:
+        TOKEN_ENCODER = False
+        if tiktoken is not None:
+            try:
+                TOKEN_ENCODER = tiktoken.get_encoding(TOKENIZER_ENCODING)
+            except Exception as e:
+                print(f"FIGYELEM: a tokenizer nem tölthető be ({e}), becsléssel számolunk.")
+    return TOKEN_ENCODER or None
+
+
+def _count_tokens(text):
+    """Tokenek száma (tiktoken; nélküle ~4 karakter / token, de legalább a szavak száma)."""
+    if not text:
+        return 0
+    encoder = _get_token_encoder()
+    if encoder:
+        return len(encoder.encode(text, disallowed_special=()))
+    return max(len(text.split()), (len(text) + 3) // 4)
+
+
+def _count_message_tokens(text):
+    """
+    Egy üzenet tokenjei, a szöveg hash-e szerint memoizálva (MESSAGE_TOKEN_CACHE): az Aider
+    minden körben a teljes előzményt küldi, így a korábbi üzeneteket nem tokenizáljuk újra.
+    """
+    key = hashlib.sha1(text.encode("utf-8")).digest()
+    count = MESSAGE_TOKEN_CACHE.pop(key, None)
+    if count is None:
+        count = _count_tokens(text)
+        if len(MESSAGE_TOKEN_CACHE) >= MESSAGE_TOKEN_CACHE_SIZE:
+            # A dict beszúrási sorrendje: az első elem a legrégebben használt
+            MESSAGE_TOKEN_CACHE.pop(next(iter(MESSAGE_TOKEN_CACHE)))
+    MESSAGE_TOKEN_CACHE[key] = count
+    return count
+
+
+def _count_prompt_tokens(messages):
+    """A messages[] tokenjei az OpenAI chat formátum szerint (üzenetenként +4, a végén +3)."""
+    total = 3
+    for msg in messages:
+        total += 4 + _count_message_tokens(_extract_text_from_content(msg.get("content", "")))
+    return total
+
+
+def _max_input_tokens():
+    """A modell kontextus-korlátja: MAX_INPUT_TOKENS, vagy az Aider metaadatából (128k)."""
+    global MAX_INPUT_TOKENS
+
+    if MAX_INPUT_TOKENS is None:
+        MAX_INPUT_TOKENS = 128_000
+        try:
+            metadata = json.loads(MODEL_METADATA_PATH.read_text(encoding="utf-8"))
+            MAX_INPUT_TOKENS = int(metadata[f"openai/{BACKEND.MODEL_ID}"]["max_input_tokens"])
+        except (OSError, ValueError, KeyError, TypeError) as e:
+            print(f"FIGYELEM: max_input_tokens nem olvasható ({e}), 128000-rel számolunk.")
+    return MAX_INPUT_TOKENS
+
+
+def _check_context_length(messages):
+    """
+    A messages[] tokenjei és a kontextus-korlát ellenőrzése, mielőtt a prompt a böngészőbe
+    kerülne. Visszatérés: (prompt_tokens, hibaüzenet vagy None). Az üzenet szövege az
+    OpenAI-é, hogy a LiteLLM / Aider kontextus-túllépésként ismerje fel.
+    """
+    prompt_tokens = _count_prompt_tokens(messages)
+    if prompt_tokens <= _max_input_tokens():
+        return prompt_tokens, None
+    _metric_add("requests_rejected_context")
+    return prompt_tokens, (
+        f"This model's maximum context length is {_max_input_tokens()} tokens. "
+        f"However, your messages resulted in {prompt_tokens} tokens."
+    )
+
+
+# ==========================================
+# GENERÁLÁSI KORLÁTOK (max_tokens / stop / timeout)
+# ==========================================
+
+def _parse_generation_limits(data, headers=None):
+    """
+    Az OpenAI kérés max_tokens / max_completion_tokens, stop és timeout mezőiből
+    korlát-dict-et épít. Hibás értéknél ValueError. A timeout a kliens
+    X-Stainless-Timeout fejlécéből jön (a biztonsági ráhagyással csökkentve),
+    a body "timeout" mezője ezt felülírja.
+    """
+    # "max_completion_tokens": null mellett a max_tokens érvényes
+    max_tokens = data.get("max_completion_tokens")
+    if max_tokens is None:
+        max_tokens = data.get("max_tokens")
+    if max_tokens is not None:
+        if isinstance(max_tokens, bool) or not isinstance(max_tokens, int) or max_tokens < 1:
+            raise ValueError("A 'max_tokens' pozitív egész szám kell legyen.")
+
+    stop = data.get("stop")
+    if stop is None:
+        stop = []
+    elif isinstance(stop, str):
+        stop = [stop]
+    elif not isinstance(stop, list) or not all(isinstance(s, str) for s in stop):
+        raise ValueError("A 'stop' string vagy stringek listája kell legyen.")
+    stop = [s for s in stop if s]
+
+    timeout = data.get("timeout")
+    if timeout is not None:
+        if isinstance(timeout, bool) or not isinstance(timeout, (int, float)) or timeout <= 0:
+            raise ValueError("A 'timeout' pozitív szám (másodperc) kell legyen.")
+    elif headers is not None and headers.get(CLIENT_TIMEOUT_HEADER):
+        try:
+            client_timeout = float(headers.get(CLIENT_TIMEOUT_HEADER))
+        except ValueError:
+            client_timeout = None  # hibás fejléc: nem a kliens hibája, figyelmen kívül hagyjuk
+        if client_timeout and client_timeout > 0:
+            timeout = max(client_timeout - CLIENT_TIMEOUT_MARGIN_S, client_timeout / 2)
+
+    return {"max_tokens": max_tokens, "stop": stop, "timeout": timeout}
+
+
+def _truncate_to_tokens(text, max_tokens):
+    """A szöveg leghosszabb eleje, ami még belefér max_tokens tokenbe."""
+    if _count_tokens(text) <= max_tokens:
+        return text
+
+    encoder = _get_token_encoder()
+    if encoder:
+        return encoder.decode(encoder.encode(text, disallowed_special=())[:max_tokens])
+
+    lo, hi = 0, len(text)
+    while lo < hi:
+        mid = (lo + hi + 1) // 2
+        if _count_tokens(text[:mid]) <= max_tokens:
+            lo = mid
+        else:
+            hi = mid - 1
+    return text[:lo]
+
+
+def _limit_reached(text, limits):
+    """Generálás közbeni ellenőrzés: "stop" / "length", ha elértük a korlátot, különben None."""
+    if not text or not limits:
+        return None
+    if any(s in text for s in limits["stop"]):
+        return "stop"
+    if limits["max_tokens"] is not None and _count_tokens(text) >= limits["max_tokens"]:
+        return "length"
+    return None
+
+
+def _apply_limits(text, limits, finish_reason="stop"):
+    """
+    A kész (vagy leállított) válaszra alkalmazza a stop szekvenciákat és a
+    max_tokens-t. Visszatérés: (csonkolt szöveg, finish_reason).
+    """
+    if not limits:
+        return text, finish_reason
+
+    cut = min((text.find(s) for s in limits["stop"] if s in text), default=-1)
+    if cut >= 0:
+        # A stop szekvenciát (OpenAI szerint) nem adjuk vissza
+        text, finish_reason = text[:cut], "stop"
+
+    if limits["max_tokens"] is not None and _count_tokens(text) > limits["max_tokens"]:
+        return _truncate_to_tokens(text, limits["max_tokens"]), "length"
+
+    return text, finish_reason
+
+
+# ==========================================
+# SYSTEM PROMPT RÖGZÍTÉSE
+# ==========================================
+
+def _split_system_prompt(messages):
+    """
+    A messages[] elején álló system üzenet(ek) szövege és a maradék üzenetek.
+    Csak a vezető system blokkot rögzítjük; a beszélgetés közbeni system üzenetek
+    (pl. Aider emlékeztetők) a változó részben maradnak.
+    """
+    index = 0
+    while index < len(messages) and messages[index].get("role") == "system":
+        index += 1
+    texts = [_extract_text_from_content(msg.get("content", "")) for msg in messages[:index]]
+    return "\n\n".join(text for text in texts if text).strip(), messages[index:]
+
+
+def _with_system(system, prompt):
+    """A teljes (system + változó rész) prompt, ahogy rögzítés nélkül menne ki."""
+    return f"{system}\n\n{prompt}" if system else prompt
+
+
+def _apply_pinned_system(page, prompt, system, turns):
+    """
+    A tabra ténylegesen begépelendő prompt. A system promptot csak akkor tesszük
+    elé, ha ebben a chatben még nem ment el: más a hash-e, vagy a tab azóta új
+    chatre váltott (kevesebb válasz látszik, mint a rögzítő kör után).
+    `turns`: a tabon már látható asszisztens válaszok száma.
+    """
+    if not system:
+        return prompt
+
+    digest = hashlib.sha256(system.encode("utf-8")).hexdigest()
+    pinned = PINNED_SYSTEM.get(page)
+    if pinned and pinned["hash"] == digest and turns >= pinned["turns"]:
+        _metric_add("system_prompt_pinned")
+        _metric_add("system_prompt_chars_saved", len(system))
+        return prompt
+
+    PINNED_SYSTEM[page] = {"hash": digest, "turns": turns + 1}
+    _metric_add("system_prompt_sent")
+    return _with_system(system, prompt)
+
+
+# ==========================================
+# METRIKÁK
+# ==========================================
+
+def _metric_add(name, value=1):
+    METRICS[name] = METRICS.get(name, 0) + value
+
+
+def _client_disconnected(environ):
+    """
+    True, ha a HTTP kliens (pl. aider timeout / Ctrl-C) bontotta a kapcsolatot.
+    A kérés törzsét már kiolvastuk, így olvasható socket + üres peek = EOF.
+    """
+    sock = environ.get("werkzeug.socket")
+    if sock is None:
+        return False
+    try:
+        readable, _, _ = select.select([sock], [], [], 0)
+        if not readable:
+            return False
+        return sock.recv(1, socket.MSG_PEEK) == b""
+    except (OSError, ValueError):
+        return True
+
+
+# ==========================================
+# PROFILOZÁS (ADMIN VÉGPONT)
+# ==========================================
+
+# A Playwright Channel protokoll-küldő metódusai (send_no_reply szinkron, a többi async)
+PROTOCOL_SEND_METHODS = ("send", "send_return_as_dict", "send_no_reply")
+
+
+def _count_protocol_call(channel, method):
+    """Profilozás alatt egy protokoll-hívás az aktuális fázishoz."""
+    if PROFILE_ACTIVE is not None:
+        name = f"{type(getattr(channel, '_object', channel)).__name__}.{method}"
+        calls = PROFILE_ACTIVE["calls"].setdefault(PROFILE_ACTIVE["phase"], {})
+        calls[name] = calls.get(name, 0) + 1
+
+
+def _install_protocol_counter():
+    """
+    A Playwright Channel küldő metódusai (PROTOCOL_SEND_METHODS) köré számlálót tesz:
+    profilozás alatt minden protokoll-hívás (pl. Frame.evaluateExpression) az aktuális
+    fázishoz számít. Egyszer települ, profilozás nélkül csak egy None-vizsgálat.
+    """
+    if PlaywrightChannel is None:
+        return
+    for attr in PROTOCOL_SEND_METHODS:
+        original = getattr(PlaywrightChannel, attr, None)
+        if original is None or getattr(original, "_counted", False):
+            continue
+        if inspect.iscoroutinefunction(original):
+            async def wrapper(self, method, *args, _original=original, **kwargs):
+                _count_protocol_call(self, method)
+                return await _original(self, method, *args, **kwargs)
+        else:
+            def wrapper(self, method, *args, _original=original, **kwargs):
+                _count_protocol_call(self, method)
+                return _original(self, method, *args, **kwargs)
+        wrapper._counted = True
+        setattr(PlaywrightChannel, attr, functools.wraps(original)(wrapper))
+
+
+def _profile_switch(active, phase):
+    """Az eddigi időt az aktuális fázishoz írja, és átvált `phase`-re (kizárólagos idők)."""
+    now = time.perf_counter()
+    current = active["phase"]
+    active["phases"][current] = active["phases"].get(current, 0.0) + now - active["phase_started"]
+    active["phase"], active["phase_started"] = phase, now
+
+
+@contextlib.contextmanager
+def _profile_phase(name):
+    """Profilozás alatt a blokk ideje és Playwright hívásai a `name` fázishoz számítanak."""
+    active = PROFILE_ACTIVE
+    if active is None:
+        yield
+        return
+    previous = active["phase"]
+    _profile_switch(active, name)
+    try:
+        yield
+    finally:
+        _profile_switch(active, previous)
+
+
+def _page_perf(script):
+    """Performance API mérés a fő tabon (None, ha nincs böngésző vagy hibázik)."""
+    if CHAT_PAGE is None:
+        return None
+    try:
+        return CHAT_PAGE.evaluate(script)
+    except Exception as e:
+        print(f"FIGYELEM: Performance API mérés sikertelen: {e}")
+        return None
+
+
+def _format_profile_report(report):
+    """Egy profilozott kérés szöveges riportja."""
+    lines = [
+        f"=== Profil #{report['id']} – {report['path']} ({report['status']}), "
+        f"{time.strftime('%Y-%m-%d %H:%M:%S', time.localtime(report['started']))}, "
+        f"{report['wall_s']:.3f} mp ===",
+        "Fázisok (mp, kizárólagos): " + ", ".join(
+            f"{phase} {seconds:.3f}" for phase, seconds in report["phases"].items()
+        ),
+        f"Playwright protokoll-hívások (összesen {report['protocol_calls_total']}):",
+    ]
+    for phase, calls in report["protocol_calls"].items():
+        ranked = sorted(calls.items(), key=lambda item: -item[1])
+        lines.append(f"  {phase}: " + ", ".join(f"{name} {count}" for name, count in ranked))
+    page = report["page_performance"]
+    if page:
+        lines.append(
+            f"Lap (Performance API): {page['window_ms']:.0f} ms ablak, long task {page['long_tasks']} db / "
+            f"{page['long_task_ms']:.0f} ms, erőforrás {page['resources']} db / {page['resource_ms']:.0f} ms / "
+            f"{page['transfer_bytes'] / 1024:.0f} kB"
+            + (f", heap {page['heap_bytes'] / 2**20:.0f} MB" if page["heap_bytes"] else "")
+        )
+    lines += [f"cProfile (top {PROFILE_TOP_FUNCTIONS}, cumulative):", report["profile"], ""]
+    return "\n".join(lines)
+
+
+# ==========================================
+# FLASK API
+# ==========================================
+
+app = Flask(__name__)
+
+
+def _extract_text_from_content(content):
+    """
+    LiteLLM / OpenAI üzenet `content` mezőből kiszedi a szöveget.
+    """
+    if isinstance(content, str):
+        return content
+
+    if isinstance(content, list):
+        parts = []
+        for item in content:
+            if isinstance(item, str):
+                parts.append(item)
+            elif isinstance(item, dict):
+                txt = (
+                    item.get("text")
+                    or item.get("input_text")
+                    or item.get("content")
+                    or ""
+                )
+                if txt:
+                    parts.append(str(txt))
+            else:
+                parts.append(str(item))
+        return "\n".join(parts)
+
+    return str(content)
+
+
+def _build_prompt_from_messages(messages):
+    """
+    Az egész messages[] tömböt "kilapítja" egy darab nagy prompttá,
+    hogy Aider összes korábbi user/assistant üzenete, fájltartalma stb.
+    ténylegesen eljusson a web felülethez.
+    """
+    blocks = []
+
+    for msg in messages:
+        role = msg.get("role", "user")
+        text = _extract_text_from_content(msg.get("content", ""))
+
+        if not text:
+            continue
+        if role == "tool":
+            continue
+
+        if role == "system":
+            blocks.append(text)
+        elif role == "user":
+            blocks.append(text)
+        elif role == "assistant":
+            blocks.append(f"Assistant: {text}")
+        else:
+            blocks.append(text)
+
+    return _compact_prompt("\n\n".join(blocks).strip())
+
+
+def _compact_prompt(prompt):
+    """
+    Az ismétlődő nagy blokkok (PROMPT_DEDUP_LEVEL szerint kódblokkok / bekezdések)
+    második és további előfordulását rövid visszautalásra cseréli; az első
+    előfordulás változatlanul marad, így a modell a fenti példányt olvassa.
+    """
+    if PROMPT_DEDUP_LEVEL <= 0:
+        return prompt
+
+    seen = {}  # tartalom hash -> az első előfordulás leírása
+    parts = []
+    pos = 0
+    for match in FENCED_BLOCK_RE.finditer(prompt):
+        parts.append(_dedupe_paragraphs(prompt[pos:match.start()], seen))
+
+        # Az Aider a fájl útvonalát a kódblokk előtti sorba írja
+        line_end = prompt.rfind("\n", 0, match.start())
+        line_start = prompt.rfind("\n", 0, line_end) + 1
+        preceding = prompt[line_start:line_end].strip() if line_end > 0 else ""
+        if preceding and " " not in preceding and len(preceding) < 200:
+            label = f"code block of {preceding}"
+        else:
+            label = "code block"
+        parts.append(_dedupe_chunk(match.group(0), label, seen))
+        pos = match.end()
+    parts.append(_dedupe_paragraphs(prompt[pos:], seen))
+
+    compacted = "".join(parts)
+    if len(compacted) < len(prompt):
+        print(f"Prompt tömörítés: {len(prompt)} -> {len(compacted)} karakter.")
+    return compacted
+
+
+def _dedupe_paragraphs(text, seen):
+    """Kódblokkon kívüli szöveg: PROMPT_DEDUP_LEVEL >= 2 esetén bekezdésenként tömörít."""
+    if PROMPT_DEDUP_LEVEL < 2:
+        return text
+    pieces = re.split(r"(\n[ \t]*\n)", text)
+    for index in range(0, len(pieces), 2):
+        first_line = pieces[index].strip().split("\n", 1)[0][:60]
+        pieces[index] = _dedupe_chunk(pieces[index], f'paragraph starting "{first_line}"', seen)
+    return "".join(pieces)
+
+
+def _dedupe_chunk(chunk, label, seen):
+    """A chunk maga, vagy ha (elég hosszú és) már szerepelt, egy rövid visszautalás."""
+    if len(chunk) < PROMPT_DEDUP_MIN_CHARS:
+        return chunk
+    digest = hashlib.sha1(chunk.encode("utf-8")).hexdigest()
+    if digest not in seen:
+        seen[digest] = label
+        return chunk
+
+    _metric_add("prompt_dedup_blocks")
+    _metric_add("prompt_dedup_chars_saved", len(chunk))
+    return f"[Duplicate omitted: identical to the earlier {seen[digest]} above.]"
+
+
+def _build_completion_response(model_id, prompt, results, prompt_tokens=None):
+    """
+    OpenAI chat.completion válasz a [(szöveg, finish_reason), ...] eredményekből.
+    `prompt_tokens`: a kérés üzeneteiből számolt érték (_count_prompt_tokens);
+    ha nincs megadva, a kilapított promptból számoljuk.
+    """
+    if prompt_tokens is None:
+        prompt_tokens = _count_tokens(prompt)
+    completion_tokens = sum(_count_tokens(text) for text, _ in results)
+    return {
+        "id": "chatcmpl-" + str(uuid.uuid4()).replace("-", ""),
+        "object": "chat.completion",
+        "created": int(time.time()),
+        "model": model_id,
+        "choices": [
+            {
+                "index": index,
+                "message": {
+                    "role": "assistant",
+                    "content": text,
+                },
+                "logprobs": None,
+                "finish_reason": finish_reason,
+            }
+            for index, (text, finish_reason) in enumerate(results)
+        ],
+        "usage": {
+            "prompt_tokens": prompt_tokens,
+            "completion_tokens": completion_tokens,
+            "total_tokens": prompt_tokens + completion_tokens,
+        },
+    }
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+@app.route("/chat/completions", methods=["POST"])
+def chat_completions():
+    data = request.json or {}
+    try:
+        print(f"REQUEST PATH: {request.path}")
+    except Exception:
+        pass
+
+    messages = messages_all = data.get("messages", [])
+    system = None
+    if PIN_SYSTEM_PROMPT:
+        # A stabil system prompt külön megy: a böngésző chatben csak egyszer gépeljük be
+        system, messages = _split_system_prompt(messages)
+    prompt = _build_prompt_from_messages(messages)
+
+    if not prompt:
+        return jsonify({"error": "Nincs értelmezhető szöveg a 'messages' mezőben."}), 400
+
+    # Túl hosszú prompt: azonnali 400 a lassú böngészős hiba helyett
+    prompt_tokens, context_error = _check_context_length(data.get("messages", []))
+    if context_error:
+        return (
+            jsonify(
+                {
+                    "error": {
+                        "message": context_error,
+                        "type": "invalid_request_error",
+                        "param": "messages",
+                        "code": "context_length_exceeded",
+                    }
+                }
+            ),
+            400,
+        )
+
+    model = data.get("model") or BACKEND.MODEL_ID
+    if not isinstance(model, str):
+        return jsonify({"error": "A 'model' értéke string kell legyen."}), 400
+    runner = run_hedged if model.endswith(BACKEND.HEDGED_MODEL_ID) else run_with_playwright
+    try:
+        # Backend-specifikus opciók (ChatGPT: UI modell, Gemini: eszközök) és a válasz model id-ja
+        options, response_model = BACKEND._request_options(data, prompt_tokens, runner is run_hedged)
+        limits = _parse_generation_limits(data, request.headers)
+    except ValueError as e:
+        return jsonify({"error": str(e)}), 400
+
+    n = data.get("n")
+    if n is None:
+        n = 1
+    if isinstance(n, bool) or not isinstance(n, int) or not 1 <= n <= MAX_CHOICES:
+        return jsonify({"error": f"Az 'n' értéke 1 és {MAX_CHOICES} közötti egész lehet."}), 400
+
+    print(f"\n--- ÚJ KÉRÉS (összefűzött, {response_model}, n={n}): {prompt[:60]}... ---")
+    _metric_add("requests_total")
+    environ = request.environ
+
+    def should_cancel():
+        return _client_disconnected(environ)
+
+    # Indexelt beszélgetés folytatása: csak a fő tabos, egyszeres generálásnál
+    use_index = bool(CONVERSATION_DB) and n == 1 and runner is run_with_playwright
+    if use_index:
+        conversation_url, new_messages = _find_conversation(messages_all)
+        if conversation_url and _open_conversation(conversation_url):
+            _metric_add("conversation_resumes")
+            # A system prompt és az előzmények már a szálban vannak
+            system, prompt = None, _build_prompt_from_messages(new_messages)
+            print(f"Beszélgetés folytatva, {len(new_messages)} új üzenet ({len(prompt)} karakter).")
+        else:
+            if conversation_url:
+                _metric_add("conversation_resume_failures")
+            # Nincs (használható) találat: a fő tab szála egy másik indexelt beszélgetésé
+            # lehet, ezért új chatben kezdünk – így minden indexelt URL pontosan egy
+            # üzenetláncot tartalmaz
+            error = BACKEND.ensure_browser_session()
+            if not error and not _open_main_chat():
+                error = "HIBA: Nem sikerült új chatet nyitni a fő tabon."
+            if error:
+                _metric_add("requests_failed")
+                return (
+                    jsonify(
+                        {
+                            "error": {
+                                "message": error.replace("HIBA: ", ""),
+                                "type": "browser_error",
+                                "code": "500",
+                            }
+                        }
+                    ),
+                    500,
+                )
+
+    with _profile_phase("generate"):
+        if n == 1:
+            results = [
+                runner(prompt, should_cancel=should_cancel, limits=limits, system=system, **options)
+            ]
+        else:
+            # n > 1: párhuzamos generálás a fő tabon + extra tabokon (friss chatekben)
+            item = {"prompt": prompt, "limits": limits, "system": system, **options}
+            results = run_many([item] * n, should_cancel=should_cancel)
+    print(f"--- KÉSZ, válasz hossza: {[len(text) for text, _ in results]} karakter ---")
+
+    if len(results) < n or any(text == CANCELLED_RESPONSE for text, _ in results):
+        # 499: a kliens bontott, ezt a választ már senki nem olvassa
+        return jsonify({"error": {"message": CANCELLED_RESPONSE, "type": "client_closed"}}), 499
+
+    failed = [text for text, _ in results if text.startswith("HIBA:")]
+    if use_index and not failed:
+        _record_conversation(messages_all, results[0][0])
+    if failed:
+        _metric_add("requests_failed")
+        error_message = failed[0].replace("HIBA: ", "")
+        if failed[0] == DEADLINE_RESPONSE:
+            # 504: a kliens timeoutja előtt nem lett kész válasz (nem csonkolt "length")
+            return jsonify({"error": {"message": error_message, "type": "timeout", "code": "504"}}), 504
+        return (
+            jsonify(
+                {
+                    "error": {
+                        "message": error_message,
+                        "type": "browser_error",
+                        "code": "500",
+                    }
+                }
+            ),
+            500,
+        )
+
+    # OpenAI /v1/chat/completions-szerű válasz – formátum pontosan a doksi szerint
+    response_data = _build_completion_response(
+        response_model,
+        _with_system(system, prompt),
+        results,
+        prompt_tokens,
+    )
+    print(response_data)
+    return jsonify(response_data)
+
+
+@app.route("/v1/models", methods=["GET"])
+@app.route("/models", methods=["GET"])
+def list_models():
+    return jsonify(
+        {
+            "object": "list",
+            "data": [
+                {
+                    "id": model_id,
+                    "object": "model",
+                    "created": int(time.time()),
+                    "owned_by": "user-host",
+                }
+                for model_id in BACKEND.MODEL_IDS
+            ],
+        }
+    )
+
+
+@app.route("/health", methods=["GET"])
+def health():
+    """A router (router.py) ezen figyeli a worker állapotát."""
+    return jsonify(
+        {
+            "status": "ok",
+            "browser": CHAT_PAGE is not None,
+            # Bejelentkezett, működő session a legutóbbi keep-alive szerint: a router csak
+            # ilyen worker profiljából pecsételi vissza a sablont
+            "session_ok": METRICS["session_ok"] == 1 and METRICS["session_authenticated"] is True,
+            "extra_tabs": len(BROWSER_CONTEXT.pages) - 1 if BROWSER_CONTEXT else 0,
+            "requests_total": METRICS["requests_total"],
+        }
+    )
+
+
+@app.route("/metrics", methods=["GET"])
+def metrics():
+    return jsonify(METRICS)
+
+
+@app.before_request
+def _profile_begin():
+    """Élesített profilozásnál a chat kérés cProfile-lal és fázis-számlálással indul."""
+    global PROFILE_ACTIVE
+    if PROFILE_REMAINING <= 0 or request.endpoint != "chat_completions":
+        return
+    now = time.perf_counter()
+    PROFILE_ACTIVE = {
+        "path": f"{request.method} {request.path}",
+        "started": time.time(),
+        "started_perf": now,
+        "phase": "request",
+        "phase_started": now,
+        "phases": {},
+        "calls": {},
+        "profiler": cProfile.Profile(),
+    }
+    with _profile_phase("profiler"):
+        _page_perf(PAGE_PERF_START_JS)
+    PROFILE_ACTIVE["profiler"].enable()
+
+
+@app.after_request
+def _profile_end(response):
+    """A profilozott kérés lezárása: riport a PROFILE_REPORTS-ba."""
+    global PROFILE_ACTIVE, PROFILE_REMAINING
+    active = PROFILE_ACTIVE
+    if active is None:
+        return response
+    active["profiler"].disable()
+    with _profile_phase("profiler"):
+        page_performance = _page_perf(PAGE_PERF_REPORT_JS)
+    _profile_switch(active, "request")
+    PROFILE_ACTIVE = None
+    PROFILE_REMAINING -= 1
+
+    out = io.StringIO()
+    stats = pstats.Stats(active["profiler"], stream=out)
+    stats.sort_stats("cumulative").print_stats(PROFILE_TOP_FUNCTIONS)
+    report = {
+        "id": (PROFILE_REPORTS[-1]["id"] + 1) if PROFILE_REPORTS else 1,
+        "path": active["path"],
+        "status": response.status_code,
+        "started": active["started"],
+        "wall_s": time.perf_counter() - active["started_perf"],
+        "phases": {phase: round(seconds, 4) for phase, seconds in active["phases"].items()},
+        "protocol_calls": active["calls"],
+        "protocol_calls_total": sum(sum(calls.values()) for calls in active["calls"].values()),
+        "page_performance": page_performance,
+        "profile": out.getvalue(),
+        "_stats": stats,
+    }
+    PROFILE_REPORTS.append(report)
+    print(f"Profil #{report['id']} kész ({report['wall_s']:.2f} mp), még {PROFILE_REMAINING} kérés.")
+    return response
+
+
+@app.route("/admin/profile", methods=["GET", "POST"])
+def admin_profile():
+    """
+    POST {"requests": N, "clear": bool}: a következő N chat kérés profilozása (0: kikapcsolás).
+    GET: állapot és a riportok összefoglalója.
+    """
+    global PROFILE_REMAINING
+    if request.method == "POST":
+        data = request.get_json(silent=True) or {}
+        count = data.get("requests", 1)
+        if isinstance(count, bool) or not isinstance(count, int) or not 0 <= count <= PROFILE_MAX_REQUESTS:
+            return jsonify({"error": f"A 'requests' értéke 0 és {PROFILE_MAX_REQUESTS} közötti egész lehet."}), 400
+        if data.get("clear"):
+            PROFILE_REPORTS.clear()
+        _install_protocol_counter()
+        PROFILE_REMAINING = count
+        print(f"Profilozás élesítve a következő {count} kérésre.")
+
+    return jsonify(
+        {
+            "remaining": PROFILE_REMAINING,
+            "protocol_counter": PlaywrightChannel is not None,
+            "reports": [
+                {key: value for key, value in report.items() if key not in ("profile", "_stats")}
+                for report in PROFILE_REPORTS
+            ],
+        }
+    )
+
+
+@app.route("/admin/profile/report", methods=["GET"])
+def admin_profile_report():
+    """
+    Letölthető riport: ?format=text (alapértelmezés), json, vagy pstats (az összes
+    profilozott kérés összevont cProfile adata, pl. snakeviz-hez).
+    """
+    if not PROFILE_REPORTS:
+        return jsonify({"error": "Még nincs profilozott kérés (POST /admin/profile)."}), 404
+
+    fmt = request.args.get("format", "text")
+    if fmt == "json":
+        body = json.dumps(
+            [{key: value for key, value in report.items() if key != "_stats"} for report in PROFILE_REPORTS],
+            ensure_ascii=False,
+            indent=2,
+        )
+        mimetype, filename = "application/json", "profile_report.json"
+    elif fmt == "pstats":
+        stats = pstats.Stats()
+        stats.add(*(report["_stats"] for report in PROFILE_REPORTS))
+        with tempfile.NamedTemporaryFile(suffix=".prof") as f:
+            stats.dump_stats(f.name)
+            body = Path(f.name).read_bytes()
+        mimetype, filename = "application/octet-stream", "profile_report.prof"
+    elif fmt == "text":
+        body = "\n".join(_format_profile_report(report) for report in PROFILE_REPORTS)
+        mimetype, filename = "text/plain; charset=utf-8", "profile_report.txt"
+    else:
+        return jsonify({"error": "A 'format' értéke text, json vagy pstats lehet."}), 400
+
+    return Response(
+        body, mimetype=mimetype, headers={"Content-Disposition": f'attachment; filename="{filename}"'}
+    )
+
+
+# ==========================================
+# INDÍTÁS (A DRIVEREK KÖZÖS PARANCSSORA)
+# ==========================================
+
+def build_arg_parser(description, profile_dir):
+    """A driverek közös kapcsolói; `profile_dir`: a driver alapértelmezett Chrome profilja."""
+    parser = argparse.ArgumentParser(description=description)
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--profile-dir", type=Path, default=profile_dir)
+    parser.add_argument("--spare-tabs", type=int, default=SPARE_TAB_TARGET)
+    parser.add_argument("--keepalive-interval", type=float, default=KEEPALIVE_INTERVAL_S,
+                        help="session keep-alive ellenőrzés gyakorisága (mp)")
+    parser.add_argument("--no-warm-start", action="store_true",
+                        help="a böngészőt csak az első kérésnél indítjuk")
+    parser.add_argument("--pin-system-prompt", action="store_true",
+                        help="a stabil system promptot chatenként csak egyszer küldjük el")
+    parser.add_argument("--conversation-db", type=Path, default=CONVERSATION_DB,
+                        help="SQLite beszélgetés index: újraindítás után a meglévő szál folytatása")
+    parser.add_argument("--account", default=ACCOUNT_ID,
+                        help="a profil bejelentkezett fiókjának azonosítója az indexben")
+    parser.add_argument("--raw-text", action="store_true",
+                        help="a választ nyers innerText-ként olvassuk ki markdown helyett")
+    parser.add_argument("--dedup-level", type=int, choices=(0, 1, 2), default=PROMPT_DEDUP_LEVEL,
+                        help="ismétlődő blokkok tömörítése: 0 ki, 1 kódblokkok, 2 bekezdések is")
+    parser.add_argument("--record-snapshots", type=Path, default=SNAPSHOT_DIR,
+                        help="DOM snapshotok mentése ide (idle/generating/done) a selector_replay.py-hoz")
+    parser.add_argument("--hedge-peer-url", default=HEDGE_PEER_URL,
+                        help="a -hedged modellek második ága ezen a proxyn fut (pl. "
+                             "http://127.0.0.1:5001/v1/chat/completions), nem egy második tabon")
+    return parser
+
+
+def apply_arguments(args):
+    """A build_arg_parser kapcsolóinak érvényesítése a közös beállításokon."""
+    global SPARE_TAB_TARGET, MARKDOWN_EXTRACTION, SNAPSHOT_DIR, KEEPALIVE_INTERVAL_S, WARM_START
+    global PIN_SYSTEM_PROMPT, PROMPT_DEDUP_LEVEL, CONVERSATION_DB, ACCOUNT_ID, HEDGE_PEER_URL
+
+    SPARE_TAB_TARGET = args.spare_tabs
+    MARKDOWN_EXTRACTION = not args.raw_text
+    SNAPSHOT_DIR = args.record_snapshots
+    KEEPALIVE_INTERVAL_S = args.keepalive_interval
+    WARM_START = not args.no_warm_start
+    PIN_SYSTEM_PROMPT = args.pin_system_prompt
+    PROMPT_DEDUP_LEVEL = args.dedup_level
+    CONVERSATION_DB = args.conversation_db
+    ACCOUNT_ID = args.account
+    HEDGE_PEER_URL = args.hedge_peer_url
+
+
+def serve(port):
+    """A Flask app kiszolgálása a háttérfeladatokkal; leálláskor a böngésző rendben zárul."""
+    atexit.register(shutdown_playwright)
+    # A router SIGTERM-mel állítja le a workert: SystemExit -> atexit -> a böngésző
+    # rendben zárul, a cookie-k / session lemezre kerülnek (a profil visszapecsételhető)
+    signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+
+    # A tiktoken kódolás (első futáskor letöltés) ne az első kérés útján töltődjön be
+    _get_token_encoder()
+
+    # app.run helyett saját szerver: a service_actions hookban (kérések között, ugyanazon
+    # a szálon) futnak a háttérfeladatok, pl. a hot-spare tabok feltöltése.
+    server = make_server("127.0.0.1", port, app, threaded=False)
+    server.service_actions = _run_background_tasks
+    server.serve_forever()
@@ -0,0 +1,261 @@
+#!/usr/bin/env python3
+"""
+Profil kezelő a worker pool-hoz: egy "arany", bejelentkezett Chrome profil sablonból
+workerenként izolált klónt készít tmpfs-re (/dev/shm), így a workerek párhuzamosan,
+zár-ütközés és lemez I/O nélkül indulnak. A gazdátlan klónokat takarítja, és egy
+rendben leállított, bejelentkezett worker frissült sessionjét visszapecsételi a sablonba.
+
+A sablon útvonala egy symlink a legutóbbi generációra (<sablon>.gen-<ns>): a
+visszapecsételés új generációt ír, és a symlinket egyetlen os.replace-szel cseréli,
+így egy összeomlás sem hagyhat sablon nélkül.
+
+A klónozás reflinkkel (copy-on-write) megy, ahol a fájlrendszer tudja (btrfs, xfs) és
+a sablon a klónokkal egy fájlrendszeren van; a tmpfs-re (más fájlrendszer) sima, de
+memóriabeli másolás. Az újraépíthető cache könyvtárakat (a profil
+"felfúvódását") és a Chrome zárfájljait kihagyjuk.
+"""
+import os
+import json
+import time
+import shutil
+import sqlite3
+import tempfile
+from pathlib import Path
+
+try:
+    import fcntl
+except ImportError:  # nem Linux: reflink nélkül, sima másolással klónozunk
+    fcntl = None
+
+
+FICLONE = 0x40049409  # Linux ioctl: a cél fájl a forrás blokkjait osztja meg (reflink)
+MANIFEST = ".profile_clone.json"  # a klón tulajdonosa (pid) és eredete, a GC ez alapján dönt
+RESEAL_INTERVAL = 6 * 3600  # mp – ilyen gyakran pecsételjük vissza a sablont
+
+# Újraépíthető cache-ek: nem klónozzuk és nem pecsételjük vissza őket
+BLOAT_DIRS = {
+    "Cache",
+    "Code Cache",
+    "GPUCache",
+    "GrShaderCache",
+    "ShaderCache",
+    "DawnCache",
+    "DawnGraphiteCache",
+    "DawnWebGPUCache",
+    "CacheStorage",
+    "ScriptCache",
+    "Crashpad",
+    "BrowserMetrics",
+    "component_crx_cache",
+    "optimization_guide_model_store",
+}
+SQLITE_HEADER = b"SQLite format 3\x00"
+
+
+def default_clone_root():
+    """tmpfs (/dev/shm), ha van; különben a rendszer temp könyvtára."""
+    shm = Path("/dev/shm")
+    base = shm if shm.is_dir() else Path(tempfile.gettempdir())
+    return base / "playwright-profiles"
+
+
+def _ignore_for_clone(directory, names):
+    # SingletonLock / SingletonSocket / SingletonCookie: egy futó Chrome zárjai
+    return [n for n in names if n in BLOAT_DIRS or n.startswith("Singleton")]
+
+
+def _ignore_for_reseal(directory, names):
+    # A -journal / -wal / -shm fájlok tartalma a backup API-val a fő adatbázisba kerül
+    return _ignore_for_clone(directory, names) + [
+        n for n in names if n == MANIFEST or n.endswith(("-journal", "-wal", "-shm"))
+    ]
+
+
+def _clone_file(src, dst):
+    """Copy-on-write (reflink) másolás, ha a fájlrendszer tudja, különben sima másolás."""
+    if fcntl is not None:
+        try:
+            with open(src, "rb") as fsrc, open(dst, "wb") as fdst:
+                fcntl.ioctl(fdst.fileno(), FICLONE, fsrc.fileno())
+            shutil.copystat(src, dst)
+            return dst
+        except OSError:
+            pass
+    return shutil.copy2(src, dst)
+
+
+def _snapshot_file(src, dst):
+    """
+    Leállított Chrome profil fájljának másolása: az SQLite adatbázisokat (Cookies, Login
+    Data...) a backup API-val (egy megszakadt tranzakció hot journalja így visszagörgetődik),
+    a többit sima másolással.
+    """
+    with open(src, "rb") as f:
+        is_sqlite = f.read(len(SQLITE_HEADER)) == SQLITE_HEADER
+    if not is_sqlite:
+        return shutil.copy2(src, dst)
+
+    source = sqlite3.connect(src, timeout=5)
+    target = sqlite3.connect(dst)
+    try:
+        source.backup(target)
+    finally:
+        target.close()
+        source.close()
+    return dst
+
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        return True
+    return True
+
+
+class ProfileManager:
+    """Arany profil sablon + workerenkénti tmpfs klónok."""
+
+    def __init__(self, template, clone_root=None, reseal_interval=RESEAL_INTERVAL):
+        self.template = Path(template)
+        self.clone_root = Path(clone_root) if clone_root else default_clone_root()
+        self.clone_root.mkdir(parents=True, exist_ok=True)
+        self.reseal_interval = reseal_interval
+        self.last_reseal = time.time()
+        self._recover_template()
+
+    # -------- Sablon generációk --------
+
+    def _generations(self):
+        """A sablon generáció-könyvtárai, a legrégebbitől a legújabbig."""
+        prefix = self.template.name + ".gen-"
+        return sorted(
+            (p for p in self.template.parent.glob(prefix + "*") if p.name[len(prefix):].isdigit()),
+            key=lambda p: int(p.name[len(prefix):]),
+        )
+
+    def _new_generation(self):
+        return self.template.with_name(f"{self.template.name}.gen-{time.time_ns()}")
+
+    def _point_template(self, generation):
+        """A sablon symlink atomi átállítása a `generation` könyvtárra."""
+        link = self.template.with_name(self.template.name + ".link-tmp")
+        if link.is_symlink():
+            link.unlink()
+        os.symlink(generation.name, link)
+        os.replace(link, self.template)
+
+    def _recover_template(self):
+        """
+        Indításkor: a valódi könyvtár sablont generációvá alakítja (symlink mögé), és egy
+        megszakadt átállás után a legújabb teljes generációra állítja vissza a symlinket.
+        A staging könyvtár csak teljes másolás után kap generáció nevet (rename), így
+        minden .gen-* könyvtár használható.
+        """
+        for staging in self.template.parent.glob(self.template.name + ".gen-*.staging"):
+            shutil.rmtree(staging, ignore_errors=True)
+
+        if self.template.is_dir() and not self.template.is_symlink():
+            generation = self._new_generation()
+            os.rename(self.template, generation)
+            self._point_template(generation)
+        elif not self.template.exists():
+            generations = self._generations()
+            if generations:
+                print(f"Profil sablon visszaállítva: {generations[-1]}")
+                self._point_template(generations[-1])
+
+    # -------- Klónozás / takarítás --------
+
+    def clone(self, name):
+        """Friss klón a sablonból `name` néven (a korábbi azonos nevű klón helyére)."""
+        target = self.clone_root / f"{name}-{os.getpid()}"
+        self.discard(target)
+
+        started = time.time()
+        if self.template.exists():
+            # Fájlrendszerek között (lemez -> /dev/shm) a reflink mindig EXDEV-vel bukik:
+            # ilyenkor fájlonként egy felesleges ioctl helyett rögtön sima másolás megy
+            same_fs = os.stat(self.template).st_dev == os.stat(self.clone_root).st_dev
+            shutil.copytree(
+                self.template,
+                target,
+                symlinks=True,
+                ignore=_ignore_for_clone,
+                copy_function=_clone_file if same_fs else shutil.copy2,
+            )
+        else:
+            print(f"FIGYELEM: nincs profil sablon ({self.template}), üres profillal indulunk.")
+            target.mkdir(parents=True)
+
+        (target / MANIFEST).write_text(
+            json.dumps(
+                {"owner_pid": os.getpid(), "created": time.time(), "template": str(self.template)}
+            ),
+            encoding="utf-8",
+        )
+        print(f"Profil klónozva: {target} ({time.time() - started:.2f} mp)")
+        return target
+
+    def discard(self, clone):
+        shutil.rmtree(clone, ignore_errors=True)
+
+    def gc(self, active=()):
+        """
+        A gazdátlan klónok törlése: amelyeket egy már nem futó folyamat (pl. összeomlott
+        router) hozott létre. A manifest nélküli könyvtárakhoz nem nyúlunk.
+        """
+        active = {Path(p) for p in active}
+        removed = 0
+        for path in self.clone_root.iterdir():
+            if path in active:
+                continue
+            try:
+                manifest = json.loads((path / MANIFEST).read_text(encoding="utf-8"))
+                owner = int(manifest["owner_pid"])
+            except (OSError, ValueError, KeyError, TypeError):
+                continue
+            if owner == os.getpid() or _pid_alive(owner):
+                continue
+            print(f"Gazdátlan profil-klón törlése: {path}")
+            shutil.rmtree(path, ignore_errors=True)
+            removed += 1
+        return removed
+
+    # -------- Visszapecsételés --------
+
+    def reseal_due(self):
+        return time.time() - self.last_reseal >= self.reseal_interval
+
+    def reseal(self, source):
+        """
+        Egy LEÁLLÍTOTT klón (frissített cookie-kkal / sessionnel) visszaírása a sablonba:
+        új generáció staging másolatból, majd atomi symlink csere. Az előző generáció
+        tartalékként megmarad, a régebbiek törlődnek.
+        Visszatérés: True, ha sikerült.
+        """
+        generation = self._new_generation()
+        staging = generation.with_name(generation.name + ".staging")
+
+        try:
+            shutil.copytree(
+                source,
+                staging,
+                symlinks=True,
+                ignore=_ignore_for_reseal,
+                copy_function=_snapshot_file,
+            )
+        except (OSError, sqlite3.Error, shutil.Error) as e:
+            print(f"FIGYELEM: a sablon visszapecsételése sikertelen ({source}): {e}")
+            shutil.rmtree(staging, ignore_errors=True)
+            return False
+
+        os.rename(staging, generation)
+        self._point_template(generation)
+        for old in self._generations()[:-2]:
+            shutil.rmtree(old, ignore_errors=True)
+        self.last_reseal = time.time()
+        print(f"Profil sablon visszapecsételve: {source} -> {self.template}")
+        return True
@@ -0,0 +1,456 @@
+#!/usr/bin/env python3
+"""
+Könnyű front router: OpenAI-kompatibilis forgalmat fogad, és N worker folyamat
+(GPT_API.py / GEMINI_API.py, mindegyik saját böngészővel és profil-másolattal)
+között osztja szét. A workerek egyszálúak, ezért a router mindig a legkevésbé
+terhelt (lehetőleg tétlen) workert választja, figyeli az életben létüket és a
+/health végpontjukat, és a leállt workert újraindítja.
+
+Használat:
+    python router.py --backend chatgpt --workers 4 --port 5000
+    python router.py --backend chatgpt --workers 4 -- --spare-tabs 2 --pin-system-prompt
+A `--` utáni argumentumok változatlanul minden workerhez továbbítódnak.
+"""
+import sys
+import json
+import time
+import select
+import socket
+import argparse
+import threading
+import subprocess
+import http.client
+from pathlib import Path
+from flask import Flask, request, Response, jsonify
+
+from profile_manager import ProfileManager, RESEAL_INTERVAL
+from driver_common import DRIVER_SCRIPTS, _client_disconnected
+
+
+BACKENDS = {
+    "chatgpt": (DRIVER_SCRIPTS["chatgpt"], "chrome_profile"),
+    "gemini": (DRIVER_SCRIPTS["gemini"], "gemini_profile"),
+}
+
+HEALTH_INTERVAL = 5.0  # mp – worker életjel / /health ellenőrzés gyakorisága
+HEALTH_TIMEOUT = 2.0  # mp – egy foglalt (generáló) worker ennyi idő alatt nem válaszol
+RESTART_BACKOFF = 10.0  # mp – ennyi idő múlva indítjuk újra a leállt workert
+QUEUE_TIMEOUT = 600.0  # mp – ennyit vár egy kérés szabad workerre
+FORWARD_TIMEOUT = 60000.0  # mp – a workerek generálása akár ~100 percig is tarthat
+DISCONNECT_CHECK_INTERVAL = 0.5  # mp – továbbítás közben ilyen gyakran nézzük a klienst
+
+
+class Worker:
+    """Egy worker folyamat és a router által nyilvántartott állapota."""
+
+    def __init__(self, index, port):
+        self.index = index
+        self.port = port
+        self.profile_dir = None  # a worker saját (tmpfs) profil-klónja
+        self.process = None
+        self.in_flight = 0
+        self.healthy = False
+        self.session_ok = False  # a legutóbbi /health szerint a session ellenőrzés is rendben volt
+        self.last_health = None
+        self.restarts = 0
+        self.died_at = None
+        self.served = 0
+        self.failed = 0
+
+    def status(self):
+        return {
+            "index": self.index,
+            "port": self.port,
+            "pid": self.process.pid if self.process else None,
+            "profile_dir": str(self.profile_dir) if self.profile_dir else None,
+            "alive": self.alive(),
+            "healthy": self.healthy,
+            "session_ok": self.session_ok,
+            "in_flight": self.in_flight,
+            "served": self.served,
+            "failed": self.failed,
+            "restarts": self.restarts,
+            "last_health": self.last_health,
+        }
+
+    def alive(self):
+        return self.process is not None and self.process.poll() is None
+
+
+class WorkerFleet:
+    """A workerek indítása, felügyelete és a kérések kiosztása (least-loaded)."""
+
+    def __init__(self, script, profiles, workers, base_port, worker_args=()):
+        self.script = script
+        self.profiles = profiles  # ProfileManager: arany sablon + workerenkénti klónok
+        self.worker_args = list(worker_args)  # minden workernek átadott extra argumentumok
+        self.workers = [Worker(i, base_port + i) for i in range(workers)]
+        self.cond = threading.Condition()
+        self.stopping = False
+
+    # -------- Indítás / újraindítás --------
+
+    def _prepare_profile(self, worker):
+        """
+        Minden (újra)induló worker friss klónt kap a sablonból (a Chrome profilt nem
+        lehet megosztani). Egy összeomlott worker klónjából nem pecsételünk vissza:
+        sérült vagy kijelentkezett lehet.
+        """
+        if worker.profile_dir is not None:
+            self.profiles.discard(worker.profile_dir)
+        worker.profile_dir = self.profiles.clone(f"worker-{worker.index}")
+
+    def start_worker(self, worker):
+        self._prepare_profile(worker)
+        worker.process = subprocess.Popen(
+            [
+                sys.executable,
+                str(self.script),
+                "--port",
+                str(worker.port),
+                "--profile-dir",
+                str(worker.profile_dir),
+                *self.worker_args,
+            ]
+        )
+        worker.healthy = False
+        worker.session_ok = False
+        worker.died_at = None
+        print(f"Worker #{worker.index} elindítva (pid {worker.process.pid}, port {worker.port}).")
+
+    def start(self):
+        # Egy korábbi (összeomlott) router gazdátlan klónjai
+        self.profiles.gc()
+        for worker in self.workers:
+            self.start_worker(worker)
+        threading.Thread(target=self._monitor, daemon=True).start()
+
+    def _terminate(self, worker):
+        """
+        Rendezett leállítás (SIGTERM: a driver bezárja a böngészőt, a cookie-k lemezre
+        kerülnek). True, ha a worker magától, időben kilépett.
+        """
+        if not worker.alive():
+            return False
+        worker.process.terminate()
+        try:
+            worker.process.wait(timeout=15)
+            return True
+        except subprocess.TimeoutExpired:
+            worker.process.kill()
+            worker.process.wait()
+            return False
+
+    def stop(self):
+        self.stopping = True
+        # A leállításkor még futó, bejelentkezett workerek a visszapecsételés jelöltjei
+        sealable = [w for w in self.workers if w.alive() and w.healthy and w.session_ok]
+        for worker in self.workers:
+            if worker.alive():
+                worker.process.terminate()
+        clean = set()
+        for worker in self.workers:
+            if worker.process is not None:
+                try:
+                    worker.process.wait(timeout=15)
+                    clean.add(worker.index)
+                except subprocess.TimeoutExpired:
+                    worker.process.kill()
+                    worker.process.wait()
+
+        # Csak rendben kilépett, egészséges sessionű worker klónja kerülhet a sablonba
+        for worker in sealable:
+            if worker.index in clean and self.profiles.reseal(worker.profile_dir):
+                break
+        for worker in self.workers:
+            if worker.profile_dir is not None:
+                self.profiles.discard(worker.profile_dir)
+
+    # -------- Egészség figyelés --------
+
+    def _check_health(self, worker):
+        """(elérhető-e, él-e a bejelentkezett session) a worker /health válasza alapján."""
+        conn = http.client.HTTPConnection("127.0.0.1", worker.port, timeout=HEALTH_TIMEOUT)
+        try:
+            conn.request("GET", "/health")
+            resp = conn.getresponse()
+            body = resp.read()
+            if resp.status != 200:
+                return False, False
+            try:
+                health = json.loads(body)
+            except ValueError:
+                return True, False
+            return True, bool(health.get("browser") and health.get("session_ok"))
+        except OSError:
+            return False, False
+        finally:
+            conn.close()
+
+    def _monitor(self):
+        """
+        A felügyelő szál ciklusa. Egy worker (újra)indításának vagy a visszapecsételésnek
+        a hibája (pl. ENOSPC a /dev/shm-en a klónozáskor) csak naplózódik: a szál nem
+        halhat meg, különben több health check és újraindítás nem történne.
+        """
+        while not self.stopping:
+            for worker in self.workers:
+                try:
+                    self._monitor_worker(worker)
+                except Exception as e:
+                    print(f"HIBA a Worker #{worker.index} felügyeletekor: {e}")
+
+            try:
+                if self.profiles.reseal_due():
+                    self._reseal_template()
+            except Exception as e:
+                print(f"HIBA a sablon visszapecsételésekor: {e}")
+            time.sleep(HEALTH_INTERVAL)
+
+    def _monitor_worker(self, worker):
+        """Egy worker életjel / health ellenőrzése, a leállt worker újraindítása."""
+        if not worker.alive():
+            with self.cond:
+                worker.healthy = False
+            if worker.died_at is None:
+                worker.died_at = time.time()
+                code = worker.process.returncode if worker.process else None
+                print(f"FIGYELEM: Worker #{worker.index} leállt (kód: {code}).")
+            elif time.time() - worker.died_at >= RESTART_BACKOFF:
+                worker.restarts += 1
+                # Sikertelen indításnál (pl. a klónozás hibája) a backoff újraindul
+                worker.died_at = time.time()
+                self.start_worker(worker)
+            return
+
+        # Generálás közben az egyszálú worker nem válaszol a /health-re: ez nem hiba
+        if worker.in_flight:
+            return
+
+        healthy, session_ok = self._check_health(worker)
+        with self.cond:
+            worker.healthy = healthy
+            worker.session_ok = session_ok
+            if healthy:
+                worker.last_health = time.time()
+                self.cond.notify_all()
+
+    def _reseal_template(self):
+        """
+        Időszakos visszapecsételés: egy tétlen, bejelentkezett workert kivonunk a
+        kiosztásból, rendben leállítjuk (a futó Chrome kizárólagosan zárolja az SQLite
+        adatbázisait, így csak leállítva másolható konzisztensen), a klónjából
+        visszapecsételünk, majd friss klónnal újraindítjuk. Utána gazdátlan klón takarítás.
+        """
+        with self.cond:
+            candidates = [
+                w for w in self.workers
+                if w.healthy and w.session_ok and w.alive() and not w.in_flight
+            ]
+            worker = candidates[0] if candidates else None
+            if worker is not None:
+                worker.healthy = False  # az acquire már nem adja ki
+
+        # Ha most nincs alkalmas worker, egy teljes intervallum múlva próbáljuk újra
+        self.profiles.last_reseal = time.time()
+        if worker is not None:
+            print(f"Sablon visszapecsételés: Worker #{worker.index} újrahasznosítása...")
+            if self._terminate(worker):
+                self.profiles.reseal(worker.profile_dir)
+            self.start_worker(worker)
+        self.profiles.gc(active=[w.profile_dir for w in self.workers if w.profile_dir])
+
+    # -------- Kiosztás --------
+
+    def acquire(self, exclude=()):
+        """
+        A legkevésbé terhelt egészséges worker lefoglalása. Ha mind foglalt, vár
+        (a workerek egyszálúak, egy másodiknak kiosztott kérés úgyis sorban állna).
+        """
+        deadline = time.time() + QUEUE_TIMEOUT
+        with self.cond:
+            while True:
+                candidates = [
+                    w for w in self.workers
+                    if w.healthy and w.alive() and w.index not in exclude
+                ]
+                idle = [w for w in candidates if w.in_flight == 0]
+                if idle:
+                    worker = min(idle, key=lambda w: w.served)
+                    worker.in_flight += 1
+                    return worker
+
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    return None
+                self.cond.wait(timeout=min(remaining, HEALTH_INTERVAL))
+
+    def release(self, worker, ok):
+        with self.cond:
+            worker.in_flight -= 1
+            if ok:
+                worker.served += 1
+            else:
+                worker.failed += 1
+            self.cond.notify_all()
+
+    def mark_unhealthy(self, worker):
+        with self.cond:
+            worker.healthy = False
+
+
+app = Flask(__name__)
+FLEET = None
+MODELS_RESPONSE = None  # a workerek /v1/models válasza (statikus, elég egyszer lekérni)
+
+
+class ClientDisconnected(Exception):
+    """A router kliense a worker válasza előtt bontotta a kapcsolatot."""
+
+
+def _forward(worker, method, path, body, environ=None):
+    """
+    A kérés továbbítása egy workernek. Visszatérés: (status, headers, body).
+    A válaszra várva figyeli a klienst: ha bontott, a worker kapcsolatot is bezárja
+    (a worker így észleli a lecsatlakozást, és leállítja a generálást), és
+    ClientDisconnected-et dob.
+    """
+    conn = http.client.HTTPConnection("127.0.0.1", worker.port, timeout=FORWARD_TIMEOUT)
+    try:
+        headers = {"Content-Type": "application/json"}
+        # A kliens timeoutja (openai-python: X-Stainless-Timeout) a workerig eljut
+        if environ is not None and environ.get("HTTP_X_STAINLESS_TIMEOUT"):
+            headers["X-Stainless-Timeout"] = environ["HTTP_X_STAINLESS_TIMEOUT"]
+        conn.request(method, path, body=body, headers=headers)
+        deadline = time.time() + FORWARD_TIMEOUT
+        while environ is not None:
+            readable, _, _ = select.select([conn.sock], [], [], DISCONNECT_CHECK_INTERVAL)
+            if readable:
+                break
+            if _client_disconnected(environ):
+                raise ClientDisconnected()
+            if time.time() >= deadline:
+                raise socket.timeout("a worker nem válaszolt időben")
+        resp = conn.getresponse()
+        return resp.status, resp.getheader("Content-Type", "application/json"), resp.read()
+    finally:
+        conn.close()
+
+
+def _route(method, path, body=None, environ=None):
+    """
+    Kiosztás + továbbítás. Ha a worker a válasz előtt elérhetetlenné válik
+    (pl. összeomlott), egyszer egy másik workerrel újrapróbáljuk.
+    Az `environ` (a kliens kérése) megadásakor a kliens lecsatlakozását is figyeljük.
+    """
+    tried = set()
+    for _ in range(2):
+        worker = FLEET.acquire(exclude=tried)
+        if worker is None:
+            break
+        tried.add(worker.index)
+        try:
+            status, content_type, payload = _forward(worker, method, path, body, environ)
+        except ClientDisconnected:
+            print(f"Kliens lecsatlakozott – Worker #{worker.index} kapcsolata bontva.")
+            FLEET.release(worker, ok=True)
+            return (
+                jsonify({"error": {"message": "A kliens bontotta a kapcsolatot.", "type": "client_closed"}}),
+                499,
+            )
+        except OSError as e:
+            print(f"HIBA: Worker #{worker.index} nem érhető el: {e}")
+            FLEET.mark_unhealthy(worker)
+            FLEET.release(worker, ok=False)
+            continue
+
+        FLEET.release(worker, ok=status < 500)
+        return Response(payload, status=status, content_type=content_type)
+
+    return (
+        jsonify(
+            {
+                "error": {
+                    "message": "Nincs elérhető worker a kérés kiszolgálásához.",
+                    "type": "router_error",
+                    "code": "503",
+                }
+            }
+        ),
+        503,
+    )
+
+
+@app.route("/v1/chat/completions", methods=["POST"])
+@app.route("/chat/completions", methods=["POST"])
+def chat_completions():
+    return _route("POST", "/v1/chat/completions", request.get_data(), request.environ)
+
+
+@app.route("/v1/models", methods=["GET"])
+@app.route("/models", methods=["GET"])
+def list_models():
+    global MODELS_RESPONSE
+    if MODELS_RESPONSE is None:
+        response = _route("GET", "/v1/models")
+        if not isinstance(response, Response) or response.status_code != 200:
+            return response
+        MODELS_RESPONSE = response.get_data()
+    return Response(MODELS_RESPONSE, status=200, content_type="application/json")
+
+
+@app.route("/router/status", methods=["GET"])
+def router_status():
+    return jsonify({"workers": [w.status() for w in FLEET.workers]})
+
+
+def main():
+    global FLEET
+
+    parser = argparse.ArgumentParser(description="Front router a Playwright proxy worker folyamatokhoz.")
+    parser.add_argument("--backend", choices=sorted(BACKENDS), default="chatgpt")
+    parser.add_argument("--workers", type=int, default=2)
+    parser.add_argument("--port", type=int, default=5000, help="a router portja")
+    parser.add_argument("--base-port", type=int, default=5101, help="az első worker portja")
+    parser.add_argument("--profile-template", type=Path, default=None,
+                        help="bejelentkezett profil, amiről a workerek másolatot kapnak")
+    parser.add_argument("--profiles-root", type=Path, default=None,
+                        help="a worker profil-klónok helye (alapértelmezés: tmpfs, /dev/shm)")
+    parser.add_argument("--reseal-interval", type=float, default=RESEAL_INTERVAL,
+                        help="a sablon visszapecsételésének gyakorisága (mp)")
+    parser.add_argument("--conversation-db", type=Path, default=None,
+                        help="közös SQLite beszélgetés index: failover után a másik worker folytatja a szálat")
+    parser.epilog = ("A `--` utáni argumentumok minden workerhez továbbítódnak "
+                     "(pl. -- --spare-tabs 2 --hedge-peer-url ...); a --port és --profile-dir a routeré.")
+
+    # A `--` utáni rész a workereké (a driver parancssora), a router nem értelmezi
+    argv = sys.argv[1:]
+    worker_args = []
+    if "--" in argv:
+        split = argv.index("--")
+        argv, worker_args = argv[:split], argv[split + 1:]
+    args = parser.parse_args(argv)
+    if {"--port", "--profile-dir"} & set(worker_args):
+        parser.error("a workerek --port és --profile-dir értékét a router osztja ki")
+
+    if args.conversation_db:
+        worker_args += ["--conversation-db", str(args.conversation_db.resolve())]
+
+    script, default_profile = BACKENDS[args.backend]
+    profiles = ProfileManager(
+        args.profile_template or Path.cwd() / default_profile,
+        args.profiles_root,
+        args.reseal_interval,
+    )
+    FLEET = WorkerFleet(script, profiles, args.workers, args.base_port, worker_args)
+    FLEET.start()
+
+    print(f"🤖 Router indítása a http://127.0.0.1:{args.port} címen, {args.workers} workerrel ({args.backend})...")
+    try:
+        app.run(debug=False, port=args.port, threaded=True)
+    finally:
+        FLEET.stop()
+
+
+if __name__ == "__main__":
+    main()
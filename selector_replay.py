@@ -0,0 +1,189 @@
+#!/usr/bin/env python3
+"""
+Offline szelektor regressziós teszt: a driverek --record-snapshots kapcsolójával mentett
+DOM snapshotokat (idle.html, generating.html, done.html) tölti be egy headless böngészőbe,
+a mellettük lévő <állapot>.json metaadattal (a küldés előtti válasz / kész-jelző szám),
+és a driver (driver_common-ba bekötött) SELECTOR_REGISTRY-jén ellenőrzi, hogy
+- az adott állapotban elvárt elemek (szövegmező, stop gomb, kész-jelző...) megtalálhatók,
+  az elsődleges szelektorral (ha csak fallback talál: figyelmeztetés, --strict esetén hiba),
+- minden keresés belefér a SELECTOR_BUDGET_MS keretbe,
+- a generálás-állapot detektálás a rögzített küldés előtti számokkal helyes, és belefér a
+  GENERATION_STATE_BUDGET_MS keretbe.
+Hibánál 1-es kóddal lép ki: a web UI változása (szelektor-drift) így itt derül ki, nem
+élesben, a nagy timeoutok lejártakor.
+
+A rögzített snapshotok privát beszélgetést tartalmaznak, ezért nem kerülnek a repóba
+(selector_fixtures/). A repóban backendenként egy SZINTETIKUS készlet van
+(fixtures/selectors/<backend>/): kézzel írt HTML, nem élő oldalról rögzítve, ezért a web
+UI valódi változását (szelektor-drift) NEM jelzi – csak a replay és a detektálás
+logikáját ellenőrzi. Könyvtár nélkül ezt játsszuk vissza; drift-ellenőrzéshez friss
+--record-snapshots felvétel kell.
+
+Használat:
+    python selector_replay.py --backend chatgpt                              # szintetikus készlet
+    python ChatGPT/GPT_API.py --record-snapshots selector_fixtures/chatgpt   # rögzítés
+    python selector_replay.py --backend chatgpt selector_fixtures/chatgpt
+    python selector_replay.py --backend gemini --executable-path /usr/bin/chromium   # rendszer böngésző
+"""
+import sys
+import json
+import argparse
+from pathlib import Path
+
+from playwright.sync_api import sync_playwright
+
+sys.path.insert(0, str(Path(__file__).resolve().parent))
+import driver_common as common
+
+
+# A repóban tartott szintetikus (kézzel írt) snapshotok:
+# <könyvtár>/<backend>/{idle,generating,done}.html + {generating,done}.json
+SYNTHETIC_FIXTURES = Path(__file__).parent / "fixtures" / "selectors"
+
+# Állapotonként: mely kulcsoknak kell / nem szabad találniuk, és mit kell mondania a
+# kész-detektálásnak (None: nem vizsgáljuk)
+EXPECTATIONS = {
+    "chatgpt": {
+        "idle": {"present": ["composer", "model_picker"], "absent": ["stop_button", "response"], "done": None},
+        "generating": {"present": ["composer", "response", "stop_button"], "absent": [], "done": False},
+        "done": {"present": ["composer", "response", "completion"], "absent": ["stop_button"], "done": True},
+    },
+    "gemini": {
+        "idle": {"present": ["composer", "account"], "absent": ["stop_button", "response", "sign_in"],
+                 "done": None},
+        "generating": {"present": ["composer", "response", "stop_button", "account"], "absent": ["sign_in"],
+                       "done": False},
+        "done": {"present": ["composer", "response", "completion", "account"],
+                 "absent": ["stop_button", "sign_in"], "done": True},
+    },
+}
+
+
+def probe(page, repeat):
+    """A SELECTOR_PROBE_JS a driver összes regiszter kulcsára; kulcsonként a legjobb lapon belüli idő."""
+    best = {}
+    for _ in range(repeat):
+        for key, hit in page.evaluate(common.SELECTOR_PROBE_JS, common.SELECTOR_REGISTRY).items():
+            if key not in best or hit["ms"] < best[key]["ms"]:
+                best[key] = hit
+    return best
+
+
+def load_metadata(path):
+    """A snapshot <állapot>.json metaadata (a küldés előtti számok), vagy None, ha nincs."""
+    meta_path = path.with_suffix(".json")
+    if not meta_path.exists():
+        return None
+    return json.loads(meta_path.read_text(encoding="utf-8"))
+
+
+def generation_state(driver, backend, page, meta, repeat):
+    """
+    A driver kész-detektálása a snapshoton, ahogy a _poll_generation hívja, a rögzítéskor
+    mentett küldés előtti számokkal (meta). Visszatérés: (körülfordulási idő ms-ben, done).
+    """
+    if backend == "chatgpt":
+        script = driver.GENERATION_STATE_JS
+        arg = [common._sel("stop_button"), common._sel("completion"), common._sel("response"),
+               meta["initial_response_count"], True]
+    else:
+        script = driver.GEMINI_GENERATION_STATE_JS
+        arg = {
+            "markdownSelector": common._sel("response"),
+            "footerSelector": common._sel("completion"),
+            "initialBlockCount": meta["initial_response_count"],
+            "initialFooterCount": meta["initial_completion_count"],
+            "withText": True,
+        }
+    elapsed, result = common.measure(lambda: page.evaluate(script, arg), repeat)
+    return elapsed, result["done"]
+
+
+def check_snapshot(driver, backend, page, path, repeat, strict):
+    """Egy snapshot visszajátszása. Visszatérés: a hibák listája (üres: rendben)."""
+    state = path.stem
+    expected = EXPECTATIONS[backend].get(state)
+    errors = []
+
+    page.set_content(path.read_text(encoding="utf-8"), wait_until="domcontentloaded")
+    hits = probe(page, repeat)
+
+    for key, hit in hits.items():
+        budget = common.SELECTOR_BUDGET_MS[key]
+        if hit["index"] < 0:
+            found = "-"
+        else:
+            found = "elsődleges" if hit["index"] == 0 else f"fallback #{hit['index']}"
+        print(f"  {key:<14} {found:<12} {hit['ms']:>7.2f} ms (keret: {budget} ms)")
+
+        if hit["ms"] > budget:
+            errors.append(f"{state}: '{key}' keresése {hit['ms']:.2f} ms, keret: {budget} ms")
+        if expected is None:
+            continue
+        if key in expected["present"]:
+            if hit["index"] < 0:
+                errors.append(f"{state}: '{key}' egyik jelöltje sem talál: {common.SELECTOR_REGISTRY[key]}")
+            elif hit["index"] > 0:
+                message = f"{state}: '{key}' csak fallback-kel található ({common.SELECTOR_REGISTRY[key][hit['index']]})"
+                if strict:
+                    errors.append(message)
+                else:
+                    print(f"  FIGYELEM: {message}")
+        if key in expected["absent"] and hit["index"] >= 0:
+            errors.append(f"{state}: '{key}' nem szabadna találjon ebben az állapotban")
+
+    if expected is not None and expected["done"] is not None:
+        meta = load_metadata(path)
+        if meta is None:
+            errors.append(f"{state}: nincs metaadat ({path.with_suffix('.json').name}), rögzítsd újra")
+            return errors
+        elapsed, done = generation_state(driver, backend, page, meta, repeat)
+        budget = common.GENERATION_STATE_BUDGET_MS
+        print(f"  {'kész-detektálás':<14} {str(done):<12} {elapsed:>7.2f} ms (keret: {budget} ms)")
+        if done != expected["done"]:
+            errors.append(f"{state}: a kész-detektálás {done}, elvárt: {expected['done']}")
+        if elapsed > budget:
+            errors.append(f"{state}: a kész-detektálás {elapsed:.2f} ms, keret: {budget} ms")
+    return errors
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Szelektor regresszió rögzített DOM snapshotokon.")
+    parser.add_argument("--backend", choices=sorted(common.DRIVER_SCRIPTS), default="chatgpt")
+    parser.add_argument("fixtures", type=Path, nargs="?",
+                        help="a --record-snapshots könyvtár (*.html); alapértelmezés: a szintetikus készlet")
+    parser.add_argument("--repeat", type=int, default=3, help="mérések száma (a legjobb számít)")
+    parser.add_argument("--strict", action="store_true",
+                        help="a fallback-kel talált elsődleges elem is hiba")
+    parser.add_argument("--executable-path", type=Path, default=None,
+                        help="Chromium / Chrome bináris (a `playwright install chromium` helyett)")
+    args = parser.parse_args()
+    if args.fixtures is None:
+        args.fixtures = SYNTHETIC_FIXTURES / args.backend
+        print("FIGYELEM: a szintetikus (kézzel írt) készlet fut – a valódi szelektor-driftet "
+              "csak a --record-snapshots felvétel jelzi.")
+
+    snapshots = sorted(args.fixtures.glob("*.html"))
+    if not snapshots:
+        print(f"HIBA: nincs snapshot a(z) {args.fixtures} könyvtárban (lásd --record-snapshots).")
+        return 1
+
+    driver = common.load_backend(args.backend)
+    errors = []
+    with sync_playwright() as p:
+        browser = p.chromium.launch(headless=True, executable_path=args.executable_path)
+        page = browser.new_page()
+        page.route("**/*", lambda route: route.abort())  # offline: semmi hálózat
+        for path in snapshots:
+            print(f"{path.name}:")
+            errors += check_snapshot(driver, args.backend, page, path, args.repeat, args.strict)
+        browser.close()
+
+    for error in errors:
+        print(f"HIBA: {error}")
+    print(f"{len(snapshots)} snapshot, {len(errors)} hiba.")
+    return 1 if errors else 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())